@@ -1,2 +1,3 @@
 from .read_file import read_file
 from .exporting import export_data
+from .zarr_io import convert_to_zarr
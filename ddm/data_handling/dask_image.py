@@ -1,20 +1,34 @@
 # Copyright (c) 2017-2018, dask-image Developers (see AUTHORS.rst for details)
 # All rights reserved.
 
+import collections
+import contextlib
 import glob
-import threading
 import numbers
+import os
+import threading
 import warnings
 
-from typing import Any
+from typing import Tuple, Union
 
 import dask.array as da
 import numpy as np
-import pims
 from tifffile import natural_sorted
 
+from .readers import open_reader
+from ..scheduling import time_chunks
+
 
-def read_data_into_dask(fname, nframes: int = 1, *, experiment: int = 0):
+def read_data_into_dask(
+    fname,
+    nframes: Union[int, str] = 1,
+    *,
+    experiment: int = 0,
+    max_tau: int = 1,
+    img_selection: slice = slice(None),
+    roi: Tuple[slice, slice] = None,
+    binning: int = 1,
+):
     """Read image data into a Dask Array.
     Provides a simple, fast mechanism to ingest image data into a
     Dask Array.
@@ -25,10 +39,21 @@ def read_data_into_dask(fname, nframes: int = 1, *, experiment: int = 0):
         A glob like string that may match one or multiple filenames.
         Where multiple filenames match, they are sorted using
         natural (as opposed to alphabetical) sort.
-    nframes : int, optional
-        Number of the frames to include in each chunk (default: 1).
+    nframes : int or str, optional
+        Number of the frames to include in each chunk (default: 1). With "auto",
+        the chunk sizes are chosen from max_tau and the available RAM with
+        ddm.scheduling.time_chunks.
     experiment : int, optional
         select experiment if image stack contains multiple measurement series (default: 0)
+    max_tau : int, optional
+        largest lag time (in frames) for nframes="auto". Every chunk is at least
+        max_tau frames long, so lag differences only need the next chunk (default: 1).
+    img_selection : slice, optional
+        range and stride of the frames to read (default: all frames)
+    roi : Tuple[slice, slice], optional
+        (rows, columns) of the region of interest (default: full frames)
+    binning : int, optional
+        sum binning x binning pixels into one pixel, see crop_and_bin (default: 1)
 
     Returns
     -------
@@ -37,21 +62,36 @@ def read_data_into_dask(fname, nframes: int = 1, *, experiment: int = 0):
     """
 
     sfname = str(fname)
-    if not isinstance(nframes, numbers.Integral):
-        raise ValueError("`nframes` must be an integer.")
-    if (nframes != -1) and not (nframes > 0):
+    if not isinstance(nframes, numbers.Integral) and nframes != "auto":
+        raise ValueError("`nframes` must be an integer or 'auto'.")
+    if nframes != "auto" and (nframes != -1) and not (nframes > 0):
         raise ValueError("`nframes` must be greater than zero.")
 
-    arrayfunc = np.asanyarray
+    filenames = natural_sorted(glob.glob(sfname))
+    if not filenames:
+        raise OSError(f"The file {sfname} does not exist")
 
-    with pims.open(sfname) as imgs:
-        shape = (len(imgs),) + imgs.frame_shape
-        dtype = np.dtype(imgs.pixel_type)
+    # A glob matching multiple files is read as one frame per file
+    with _use_handle(filenames[0], experiment) as reader:
+        num_frames = len(filenames) if len(filenames) > 1 else len(reader)
+        frame_shape, pixel_type = tuple(reader.frame_shape), reader.pixel_type
+    start, stop, step = img_selection.indices(num_frames)
+    frames = range(start, stop, step)
+    if len(frames) == 0:
+        raise ValueError(f"img_selection {img_selection} does not select any frames")
 
-    if nframes == -1:
-        nframes = shape[0]
+    # The crop and the binning are applied in the chunk loader, before the frames
+    # of the full image size are kept in memory
+    empty = np.empty((0,) + frame_shape, dtype=pixel_type)
+    frame = crop_and_bin(empty, roi, binning)
+    shape = (len(frames),) + frame.shape[1:]
+    dtype = frame.dtype
 
-    if nframes > shape[0]:
+    if nframes == "auto":
+        nframes = time_chunks(shape[0], shape[1:], max_tau, dtype.itemsize)
+    elif nframes == -1:
+        nframes = shape[0]
+    elif nframes > shape[0]:
         warnings.warn(
             "`nframes` larger than number of frames in file."
             " Will truncate to number of frames in file.",
@@ -64,47 +104,155 @@ def read_data_into_dask(fname, nframes: int = 1, *, experiment: int = 0):
             RuntimeWarning,
         )
 
-    # Check experiment selection
+    # Every block reads its frames from the location of the block, so the graph
+    # only holds the list of files instead of a filename per frame
+    return da.map_blocks(
+        _map_read_frames,
+        filenames=filenames,
+        experiment=experiment,
+        frames=(start, step),
+        roi=roi,
+        binning=binning,
+        chunks=da.core.normalize_chunks((nframes,) + shape[1:], shape),
+        dtype=dtype,
+        meta=np.empty((0,) * len(shape), dtype=dtype),
+    )
 
-    # place source filenames into dask array after sorting
-    filenames = natural_sorted(glob.glob(sfname))
-    if len(filenames) > 1:
-        ar = da.from_array(filenames, chunks=(nframes,))
-        multiple_files = True
-    else:
-        ar = da.from_array(filenames * shape[0], chunks=(nframes,))
-        multiple_files = False
 
-    # read in data using encoded filenames
-    dask_arr = ar.map_blocks(
-        _map_read_frame,
-        chunks=da.core.normalize_chunks((nframes,) + shape[1:], shape),
-        multiple_files=multiple_files,
-        new_axis=list(range(1, len(shape))),
-        experiment=experiment,
-        arrayfunc=arrayfunc,
-        meta=arrayfunc([]).astype(dtype),  # meta overwrites `dtype` argument
+def crop_and_bin(
+    frames: np.ndarray, roi: Tuple[slice, slice] = None, binning: int = 1
+) -> np.ndarray:
+    """Crop frames to a region of interest and bin the pixels
+
+    Parameters
+    ----------
+    frames : np.ndarray
+        frames with shape (frames, height, width)
+    roi : Tuple[slice, slice], optional
+        (rows, columns) of the region of interest, by default the full frames
+    binning : int, optional
+        sum binning x binning pixels into one pixel. Rows and columns that do not
+        fill a bin are dropped. Integer frames are summed in 32 bit integers to
+        avoid overflows. By default 1
+
+    Returns
+    -------
+    np.ndarray
+        cropped and binned frames
+
+    Raises
+    ------
+    ValueError
+        binning is not a positive integer or the roi has a step
+    """
+    if not isinstance(binning, numbers.Integral) or binning < 1:
+        raise ValueError("`binning` must be a positive integer.")
+    if roi is not None:
+        if any(s.step not in (None, 1) for s in roi):
+            raise ValueError("`roi` slices cannot have a step.")
+        frames = frames[(slice(None),) + tuple(roi)]
+    if binning == 1:
+        return frames
+
+    num_frames, height, width = frames.shape
+    height, width = height - height % binning, width - width % binning
+    frames = frames[:, :height, :width].reshape(
+        num_frames, height // binning, binning, width // binning, binning
     )
-    return dask_arr
+    dtype = frames.dtype
+    if dtype.kind in "ui" and dtype.itemsize < 4:
+        dtype = np.dtype(f"{dtype.kind}4")
+    return frames.sum(axis=(2, 4), dtype=dtype)
 
 
-def _map_read_frame(x, multiple_files, block_info=None, **kwargs):
+def close_handles():
+    """Close all cached file handles of this process
 
-    fn = x[0]  # get filename from input chunk
+    read_data_into_dask keeps the image files open between chunks. The handles
+    are closed automatically when more than _MAX_HANDLES files are open, or can be
+    closed explicitly, e.g. before the image files are modified. A handle that is
+    still reading is closed as soon as its last read finishes.
+    """
+    with _handles_lock:
+        while _handles:
+            _, handle = _handles.popitem()
+            _release(handle)
+
+
+class _Handle:
+    """Open reader of an image file, with the number of reads that use it"""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.users = 0
+        self.evicted = False
+
+
+# Open image files per process, keyed by (filename, modification time, experiment)
+_handles = collections.OrderedDict()
+_handles_lock = threading.Lock()
+_MAX_HANDLES = 16
 
-    if multiple_files:
-        i, j = 0, 1
-    else:
-        i, j = block_info[None]["array-location"][0]
 
-    with threading.RLock():
-        return _read_frame(fn=fn, i=slice(i, j), **kwargs)
+@contextlib.contextmanager
+def _use_handle(fn: str, experiment: int = 0):
+    """Cached reader of an image file, locked for the duration of the context
+
+    Opening a file parses the full container (and starts a JVM round trip for
+    Bioformats), so every dask worker opens a file once and reuses the reader for
+    all chunks. Reads from the same reader are serialized by its lock. Readers
+    are reference counted, so a reader that is evicted from the cache while it
+    is in use is only closed after its last read.
+    """
+    key = (os.path.abspath(fn), os.stat(fn).st_mtime_ns, experiment)
+    with _handles_lock:
+        if key in _handles:
+            _handles.move_to_end(key)
+        else:
+            _handles[key] = _Handle(open_reader(fn, experiment))
+        handle = _handles[key]
+        handle.users += 1
+        while len(_handles) > _MAX_HANDLES:
+            _, evicted = _handles.popitem(last=False)
+            _release(evicted)
+
+    try:
+        with handle.lock:
+            yield handle.reader
+    finally:
+        with _handles_lock:
+            handle.users -= 1
+            if handle.evicted and handle.users == 0:
+                handle.reader.close()
+
+
+def _release(handle: _Handle):
+    """Close an evicted handle, or leave it to its last user (under _handles_lock)"""
+    handle.evicted = True
+    if handle.users == 0:
+        handle.reader.close()
+
+
+def _map_read_frames(
+    filenames, experiment=0, frames=(0, 1), roi=None, binning=1, block_info=None
+):
+    # Location of the block in the selected frames
+    first, step = frames
+    start, stop = block_info[None]["array-location"][0]
+    start, stop = first + start * step, first + stop * step
+    if len(filenames) > 1:
+        data = np.stack(
+            [_read_frames(fn, 0, 1, experiment)[0] for fn in filenames[start:stop:step]]
+        )
+    else:
+        data = _read_frames(filenames[0], start, stop, experiment, step)
+    return crop_and_bin(data, roi, binning)
 
 
-def _read_frame(fn, i, *, arrayfunc=np.asanyarray, experiment=0):
-    # with pims.Bioformats(fn, series=experiment, read_mode="jpype") as imgs:
-    # with pims.Bioformats(fn) as imgs:
-    with pims.open(fn) as imgs:
-        data = arrayfunc(imgs[i])
-        data = data.copy()
-        return data
+def _read_frames(
+    fn: str, start: int, stop: int, experiment: int = 0, step: int = 1
+) -> np.ndarray:
+    """Read frames start to stop of a file into a single array"""
+    with _use_handle(fn, experiment) as reader:
+        return reader.read(start, stop, step)
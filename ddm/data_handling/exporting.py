@@ -1,7 +1,13 @@
 import os
+import netCDF4
 import xarray as xr
 import numpy as np
 from datetime import datetime
+from typing import Union
+
+from .zarr_io import read_zarr_group, write_zarr_group
+
+SUPPORTED_EXPORT_TYPES = ["netcdf", "zarr"]
 
 
 def export_data(
@@ -9,8 +15,16 @@ def export_data(
     data: np.ndarray,
     taus: np.ndarray,
     img_pathname: str,
+    counts: np.ndarray = None,
+    export_type: str = "netcdf",
+    A: np.ndarray = None,
+    B: float = None,
+    fits: xr.Dataset = None,
 ) -> xr.DataArray:
-    """Convert data to xr.dataArray and store as netcdf and csv
+    """Convert data to xr.dataArray and store as netcdf and csv, or as a Zarr group
+
+    With export_type="zarr", the DDM matrix, A(q), B and the fit results are
+    stored together in a single Zarr group, which is written in parallel chunks.
 
     Parameters
     ----------
@@ -22,23 +36,55 @@ def export_data(
         array of lag times
     img_pathname : str
         pathname of microscopy source data
+    counts : np.ndarray, optional
+        number of frame pairs per lag time, stored as the coordinate "pairs"
     export_type : str, optional
-        export protocol, defaults to netcdf.
+        export protocol, "netcdf" or "zarr", defaults to netcdf.
+    A : np.ndarray, optional
+        A(q) as calculated with compute_AB, only stored with export_type="zarr"
+    B : float, optional
+        B as calculated with compute_AB, only stored with export_type="zarr"
+    fits : xr.Dataset, optional
+        fit results, e.g. of fit_all_q, only stored with export_type="zarr"
 
     Returns
     -------
     xr.dataArray
         data as xarray dataArray
+
+    Raises
+    ------
+    ValueError
+        export_type is not supported, or A, B or fits are exported as netcdf
     """
+    if export_type not in SUPPORTED_EXPORT_TYPES:
+        raise ValueError(
+            f"{export_type} is not a supported export type. The currently supported export types are {SUPPORTED_EXPORT_TYPES}."
+        )
+    if export_type == "netcdf" and not (A is None and B is None and fits is None):
+        raise ValueError("A, B and fit results can only be exported with zarr")
 
     # Create output folder if it doesn't exist
     if not os.path.isdir(os.path.abspath(pathname)):
         os.mkdir(os.path.abspath(pathname))
 
-    arr = create_data_array(data, taus, os.path.abspath(img_pathname))
+    arr = create_data_array(data, taus, os.path.abspath(img_pathname), counts)
 
     # Create file names
     save_file_base = os.path.splitext(os.path.basename(img_pathname))[0]
+    if export_type == "zarr":
+        save_file_zarr = os.path.join(
+            os.path.abspath(pathname), f"{save_file_base}_matrix.zarr"
+        )
+        if os.path.exists(save_file_zarr):
+            stored = read_zarr_group(save_file_zarr)
+            arr = update_stored_data_array(stored["ddm"], arr)
+            A = stored.get("A") if A is None else A
+            B = stored.get("B") if B is None else B
+            fits = stored.get("fits") if fits is None else fits
+        write_zarr_group(save_file_zarr, arr, A, B, fits)
+        return arr
+
     save_file_nc = os.path.join(
         os.path.abspath(pathname), f"{save_file_base}_matrix.nc"
     )
@@ -50,13 +96,133 @@ def export_data(
         arr = update_stored_data_array(save_file_nc, arr)
 
     # Write dataArray to file
-    arr.to_netcdf(save_file_nc)
-    arr.to_pandas().to_csv(save_file_csv)
+    write_data_array(save_file_nc, arr)
+    return arr
+
+
+def write_data_array(pathname: str, arr: xr.DataArray):
+    """Store DDM matrix as netcdf and csv
+
+    The lag time dimension of the netcdf file is unlimited, so lag times can be
+    appended in place with append_lag_times.
+
+    Parameters
+    ----------
+    pathname : str
+        location of the netcdf file, the csv file is stored next to it
+    arr : xr.DataArray
+        DDM matrix as created by create_data_array
+    """
+    arr.to_netcdf(pathname, unlimited_dims=["tau"])
+    arr.to_pandas().to_csv(f"{os.path.splitext(pathname)[0]}.csv")
+
+
+def stored_lag_times(pathname: str) -> np.ndarray:
+    """Lag times stored in a netcdf file
+
+    Parameters
+    ----------
+    pathname : str
+        location of the netcdf file
+
+    Returns
+    -------
+    np.ndarray
+        stored lag times, empty if the file does not exist
+    """
+    if not os.path.exists(pathname):
+        return np.arange(0)
+    with xr.open_dataarray(pathname) as arr_stored:
+        return arr_stored.tau.values
+
+
+def append_lag_times(
+    pathname: str,
+    data: np.ndarray,
+    taus: np.ndarray,
+    img_pathname: str = "",
+    counts: np.ndarray = None,
+) -> xr.DataArray:
+    """Append lag times to a stored DDM matrix in place
+
+    The rows of the new lag times are written to the end of the netcdf and csv
+    files, without rewriting the stored lag times. Lag times that are already
+    stored are skipped. Files written without an unlimited lag time dimension are
+    merged and rewritten once instead. The file is created if it does not exist.
+
+    Parameters
+    ----------
+    pathname : str
+        location of the netcdf file
+    data : np.ndarray
+        ddmMatrix of the new lag times
+    taus : np.ndarray
+        array of new lag times
+    img_pathname : str, optional
+        pathname of microscopy source data
+    counts : np.ndarray, optional
+        number of frame pairs per lag time, stored as the coordinate "pairs".
+        Required if the stored file has pair counts, and only allowed if it has.
+
+    Returns
+    -------
+    xr.DataArray
+        data array of the appended lag times
+
+    Raises
+    ------
+    ValueError
+        counts are given for a file without pair counts or vice versa
+    """
+    arr = create_data_array(data, taus, img_pathname, counts)
+    if not os.path.exists(pathname):
+        write_data_array(pathname, arr)
+        return arr
+
+    with netCDF4.Dataset(pathname, "a") as nc:
+        (name,) = [
+            key for key, var in nc.variables.items() if var.dimensions == ("tau", "q")
+        ]
+        assert not img_pathname or (
+            getattr(nc[name], "file", img_pathname) == img_pathname
+        ), "Data arrays have different source data files"
+        assert nc.dimensions["q"].size == data.shape[1], "Number of q values differs"
+        # Validate everything before writing, so a failure leaves the file intact
+        if "pairs" in nc.variables and counts is None:
+            raise ValueError(
+                f"{pathname} stores the number of frame pairs per lag time, counts must be given"
+            )
+        if "pairs" not in nc.variables and counts is not None:
+            raise ValueError(
+                f"{pathname} does not store the number of frame pairs per lag time, counts cannot be appended"
+            )
+        arr = arr.isel(tau=~np.isin(arr.tau.values, nc["tau"][:]))
+        if len(arr.tau) == 0:
+            return arr
+
+        unlimited = nc.dimensions["tau"].isunlimited()
+        if unlimited:
+            start = nc.dimensions["tau"].size
+            stop = start + len(arr.tau)
+            nc["tau"][start:stop] = arr.tau.values
+            nc[name][start:stop, :] = arr.values
+            if counts is not None:
+                nc["pairs"][start:stop] = arr.pairs.values
+
+    if unlimited:
+        arr.to_pandas().to_csv(
+            f"{os.path.splitext(pathname)[0]}.csv", mode="a", header=False
+        )
+    else:
+        write_data_array(pathname, update_stored_data_array(pathname, arr))
     return arr
 
 
 def create_data_array(
-    data: np.ndarray, taus: np.ndarray, img_pathname: str = ""
+    data: np.ndarray,
+    taus: np.ndarray,
+    img_pathname: str = "",
+    counts: np.ndarray = None,
 ) -> xr.DataArray:
     """Create xarray dataArray
 
@@ -68,28 +234,36 @@ def create_data_array(
         array of lag times
     img_pathfile : str
         pathname of microscopy source data
+    counts : np.ndarray, optional
+        number of frame pairs per lag time, stored as the coordinate "pairs"
 
     Returns
     -------
     xr.dataArray
     """
+    coords = dict(tau=taus, q=np.arange(data.shape[1]))
+    if counts is not None:
+        coords["pairs"] = ("tau", counts)
+
     return xr.DataArray(
         data=data,
         dims=["tau", "q"],
-        coords=dict(tau=taus, q=np.arange(data.shape[1])),
+        coords=coords,
         attrs=dict(
             file=img_pathname, datetime=datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
         ),
     )
 
 
-def update_stored_data_array(pathname: str, xr_arr: xr.DataArray) -> xr.DataArray:
+def update_stored_data_array(
+    pathname: Union[str, xr.DataArray], xr_arr: xr.DataArray
+) -> xr.DataArray:
     """Update dataArray with new lag times
 
     Parameters
     ----------
-    pathname : str
-        file location of stored data array
+    pathname : Union[str, xr.DataArray]
+        file location of stored data array, or the stored data array
     xr_arr : xr.dataArray
         _description_
 
@@ -98,7 +272,10 @@ def update_stored_data_array(pathname: str, xr_arr: xr.DataArray) -> xr.DataArra
     xr.dataArray
         Combined data arrays
     """
-    arr_stored = xr.open_dataarray(pathname)
+    if isinstance(pathname, xr.DataArray):
+        arr_stored = pathname.rename(xr_arr.name)
+    else:
+        arr_stored = xr.open_dataarray(pathname)
     assert (
         arr_stored.file == xr_arr.file
     ), "Data arrays have different source data files"
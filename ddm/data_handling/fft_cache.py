@@ -0,0 +1,152 @@
+import hashlib
+import os
+from typing import Union
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray
+
+
+class FFTCache:
+    """Memory-mapped on-disk cache of the Fourier transformed frames of an image file
+
+    The spectra are stored as a .npy file per source file. The cache key includes
+    the path and modification time of the source file, the experiment, the frame
+    selection, region of interest and binning, the chunking, the data type, the
+    subtracted background and whether the real-input FFT was used, so a cached
+    file is never reused for different data. Cached spectra are read zero-copy
+    through a numpy memmap.
+
+    Parameters
+    ----------
+    cache_dir : str
+        folder to store the cached spectra in, created if it doesn't exist
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def path(self, data: xarray.DataArray, rfft: bool = False) -> str:
+        """Location of the cached spectra of an image stack
+
+        Parameters
+        ----------
+        data : xarray.DataArray
+            image stack as returned by read_file
+        rfft : bool, optional
+            spectra of the real-input FFT, by default False
+
+        Returns
+        -------
+        str
+            path of the .npy file
+
+        Raises
+        ------
+        ValueError
+            data has no source file
+        """
+        filename = data.attrs.get("file")
+        if not filename:
+            raise ValueError(
+                "The FFT cache requires data with a source file, please load the data with read_file"
+            )
+
+        chunks = data.chunks[0] if data.chunks is not None else None
+        key = (
+            os.path.abspath(filename),
+            os.stat(filename).st_mtime_ns,
+            data.attrs.get("experiment"),
+            data.attrs.get("selection"),
+            chunks,
+            str(data.dtype),
+            data.attrs.get("background"),
+            rfft,
+        )
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        base = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.cache_dir, f"{base}_{digest}.npy")
+
+    def load(
+        self, data: xarray.DataArray, rfft: bool = False
+    ) -> Union[dask.array.core.Array, None]:
+        """Cached spectra of an image stack
+
+        Parameters
+        ----------
+        data : xarray.DataArray
+            image stack as returned by read_file
+        rfft : bool, optional
+            spectra of the real-input FFT, by default False
+
+        Returns
+        -------
+        Union[dask.array.core.Array, None]
+            memory-mapped spectra with the time chunks of data, or None if the
+            spectra are not cached
+        """
+        path = self.path(data, rfft)
+        if not os.path.exists(path):
+            return None
+
+        spectra = np.load(path, mmap_mode="r")
+        chunks = data.chunks[0] if data.chunks is not None else -1
+        return da.from_array(spectra, chunks=(chunks, -1, -1), asarray=False)
+
+    def store(
+        self,
+        data: xarray.DataArray,
+        img_fft: Union[dask.array.core.Array, np.ndarray],
+        rfft: bool = False,
+    ) -> dask.array.core.Array:
+        """Write spectra to the cache, computing and writing the chunks in parallel
+
+        Parameters
+        ----------
+        data : xarray.DataArray
+            image stack as returned by read_file
+        img_fft : Union[dask.array.core.Array, np.ndarray]
+            Fourier transform of every frame of data
+        rfft : bool, optional
+            img_fft is the output of a real-input FFT, by default False
+
+        Returns
+        -------
+        dask.array.core.Array
+            memory-mapped spectra read back from the cache
+        """
+        path = self.path(data, rfft)
+        # Write to a temporary file first, so an interrupted run leaves no partial cache
+        tmp_path = f"{path}.tmp"
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=img_fft.dtype, shape=img_fft.shape
+        )
+        if isinstance(img_fft, dask.array.core.Array):
+            del out
+            # Chunks are written to disjoint regions of the file, so no lock is needed
+            da.store(img_fft, _NpyTarget(tmp_path), lock=False)
+        else:
+            out[:] = img_fft
+            out.flush()
+            del out
+        os.replace(tmp_path, path)
+        return self.load(data, rfft)
+
+
+class _NpyTarget:
+    """Writable target of da.store that opens the .npy file in every task
+
+    The memmap is opened by every task, so the chunks are also written by the
+    workers of the "processes" scheduler and dask.distributed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __setitem__(self, key, value):
+        out = np.load(self.path, mmap_mode="r+")
+        out[key] = value
+        out.flush()
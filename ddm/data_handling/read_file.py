@@ -4,25 +4,29 @@ import warnings
 import dask
 import numpy as np
 import xarray
-from typing import Dict, Union
-import pims
+from typing import Dict, Tuple, Union
 
 from .read_metadata import read_metadata
-from .dask_image import read_data_into_dask
+from .dask_image import crop_and_bin, read_data_into_dask
+from .readers import open_reader
+from .zarr_io import read_zarr
 from ..utils import verify_bioformats_jar
 
 
-SUPPORTED_FORMATS = [".lif", ".nd2", ".tif", ".tiff"]
+SUPPORTED_FORMATS = [".lif", ".nd2", ".tif", ".tiff", ".zarr"]
 
 
 def read_file(
     filename: str,
     delayed: bool = True,
-    chunk_size: int = 25,
+    chunk_size: Union[int, str] = 25,
     img_selection: slice = slice(0, None, 1),
     xscale: float = None,
     tscale: float = None,
     experiment: int = None,
+    max_tau: int = 1,
+    roi: Tuple[slice, slice] = None,
+    binning: int = 1,
 ) -> xarray.DataArray:
     """A function to read in a generic microscopy series.
 
@@ -32,16 +36,24 @@ def read_file(
         the path and name of the file which is to be loaded in
     delayed : bool, optional
         Lazy import of data as a dask array. Defaults is True.
-    chunk_size : int, optional
-        Number of the frames to include in each dask chunk. Default is 25.
+    chunk_size : int or str, optional
+        Number of the frames to include in each dask chunk. With "auto", the chunk
+        size is chosen from max_tau and the available RAM. Default is 25.
     img_selection : slice, optional
-        Selection of images to load if delayed=False. Default is all images.
+        Range and stride of the images to load. Default is all images.
     xscale : float, optional
         the resolution of the image in microns per pixel. Default is None.
     tscale : float, optional
         the time per frame of the image series in milliseconds. Default is None
     experiment : int, optional
         selected experiment in a multi-experiment lif file
+    max_tau : int, optional
+        largest lag time (in frames) that will be calculated, used for
+        chunk_size="auto" so every chunk is at least max_tau frames. Default is 1.
+    roi : Tuple[slice, slice], optional
+        (rows, columns) of the region of interest to load. Default is the full frames.
+    binning : int, optional
+        Sum binning x binning pixels into one pixel. Default is 1.
 
     Returns
     -------
@@ -59,11 +71,12 @@ def read_file(
     TypeError
         user input is of wrong type
     """
-    # Catch potential problems with jar_file from Bioformats
-    verify_bioformats_jar()
-
     # Define supported files
-    extension = os.path.splitext(filename)[-1]
+    extension = os.path.splitext(str(filename).rstrip("/\\"))[-1]
+
+    # Catch potential problems with jar_file from Bioformats, only used for .lif
+    if extension == ".lif":
+        verify_bioformats_jar()
 
     if extension in SUPPORTED_FORMATS:
         if not os.path.exists(filename):
@@ -71,12 +84,23 @@ def read_file(
 
         try:
             return load_data(
-                filename, delayed, chunk_size, img_selection, xscale, tscale, experiment
+                filename,
+                delayed,
+                chunk_size,
+                img_selection,
+                xscale,
+                tscale,
+                experiment,
+                max_tau,
+                roi,
+                binning,
             )
         except IndexError:
             raise
         except TypeError:
             raise
+        except ValueError:
+            raise
         except BaseException as err:
             print(f"Unknown error: {err}")
 
@@ -89,30 +113,43 @@ def read_file(
 def load_data(
     filename: str,
     delayed: bool = True,
-    chunk_size: int = 1,
+    chunk_size: Union[int, str] = 1,
     img_selection: slice = slice(0, None, 1),
     xscale: float = None,
     tscale: float = None,
     experiment: int = None,
+    max_tau: int = 1,
+    roi: Tuple[slice, slice] = None,
+    binning: int = 1,
 ):
     """Read image data
 
+    The frame selection, the region of interest and the binning are applied while
+    the frames are read, so only the selected data is kept in memory.
+
     Parameters
     ----------
     filename : string
         the path and name of the file which is to be loaded in
     delayed : bool, optional
         Lazy import of data as a dask array. Default is True.
-    chunk_size : int, optional
-        Number of the frames to include in each dask chunk. Default is 1.
+    chunk_size : int or str, optional
+        Number of the frames to include in each dask chunk, or "auto" to choose
+        it from max_tau and the available RAM. Default is 1.
     img_selection : slice, optional
-        Selection of images to load if delayed=False. Default is all images.
+        Range and stride of the images to load. Default is all images.
     xscale : float, optional
         the resolution of the image in microns per pixel. Default is None.
     tscale : float, optional
         the time per frame of the image series in milliseconds. Default is None
     experiment : int, optional
         selected experiment in a multi-experiment lif file
+    max_tau : int, optional
+        largest lag time (in frames), used for chunk_size="auto". Default is 1.
+    roi : Tuple[slice, slice], optional
+        (rows, columns) of the region of interest. Default is the full frames.
+    binning : int, optional
+        Sum binning x binning pixels into one pixel. Default is 1.
 
     Returns
     -------
@@ -126,21 +163,45 @@ def load_data(
     tscale = metadata["tscale"] if tscale is None else tscale
 
     # Handle multiple experiments for lif files
-    extension = os.path.splitext(filename)[-1]
+    extension = os.path.splitext(str(filename).rstrip("/\\"))[-1]
     if extension == ".lif":
         experiment = select_experiment(metadata, experiment)
     else:
         experiment = 0
 
     # Load delayed dask array or numpy array
-    if delayed:
-        arr = read_data_into_dask(filename, chunk_size, experiment=experiment)
+    if extension == ".zarr":
+        # Zarr stores are read with their own chunks
+        arr = read_zarr(filename, img_selection, roi, binning)
+        arr = arr if delayed else arr.compute()
+    elif delayed:
+        arr = read_data_into_dask(
+            filename,
+            chunk_size,
+            experiment=experiment,
+            max_tau=max_tau,
+            img_selection=img_selection,
+            roi=roi,
+            binning=binning,
+        )
     else:
-        with pims.Bioformats(filename, series=experiment) as imgs:
-            arr = np.stack([np.asarray(img) for img in imgs[img_selection]])
+        with open_reader(filename, experiment) as reader:
+            arr = reader.read(*img_selection.indices(len(reader)))
+        arr = crop_and_bin(arr, roi, binning)
 
     # Return xarray
-    return create_xarray(arr, xscale, tscale)
+    x_arr = create_xarray(
+        arr,
+        xscale,
+        tscale,
+        os.path.abspath(filename),
+        experiment,
+        binning=binning,
+        frame_step=img_selection.step or 1,
+    )
+    if img_selection != slice(0, None, 1) or roi is not None or binning > 1:
+        x_arr.attrs["selection"] = repr((img_selection, roi, binning))
+    return x_arr
 
 
 def select_experiment(metadata: Dict, experiment: int = None) -> int:
@@ -182,7 +243,13 @@ def select_experiment(metadata: Dict, experiment: int = None) -> int:
 
 
 def create_xarray(
-    arr: Union[dask.array.core.Array, np.ndarray], xscale: float, tscale: float
+    arr: Union[dask.array.core.Array, np.ndarray],
+    xscale: float,
+    tscale: float,
+    filename: str = "",
+    experiment: int = 0,
+    binning: int = 1,
+    frame_step: int = 1,
 ) -> xarray.DataArray:
     """Create xarray DataFrame with delayed dataset
 
@@ -194,22 +261,35 @@ def create_xarray(
         size of a pixel in the image in micron
     tscale : float
         frametime in ms
+    filename : str, optional
+        pathname of the source file, by default ""
+    experiment : int, optional
+        selected experiment in the source file, by default 0
+    binning : int, optional
+        number of source pixels per pixel of arr along each axis, which multiplies
+        xscale, by default 1
+    frame_step : int, optional
+        number of source frames per frame of arr, which multiplies tscale, by
+        default 1
 
     Returns
     -------
     xarray.DataArray
 
     """
+    xscale = xscale * binning
+    tscale = tscale * frame_step
+
     # Create coordinates
-    t_coords = np.arange(0.0, arr.shape[0] * tscale, tscale)
-    x_coords = np.arange(0.0, arr.shape[1] * xscale, xscale)
-    y_coords = np.arange(0.0, arr.shape[2] * xscale, xscale)
+    t_coords = np.arange(arr.shape[0]) * tscale
+    y_coords = np.arange(arr.shape[1]) * xscale
+    x_coords = np.arange(arr.shape[2]) * xscale
 
     # Create data array
     x_arr = xarray.DataArray(
         data=arr,
         dims=["T", "Y", "X"],
         coords=(t_coords, y_coords, x_coords),
-        attrs=dict(xyScale=xscale, tScale=tscale),
+        attrs=dict(xyScale=xscale, tScale=tscale, file=filename, experiment=experiment),
     )
     return x_arr
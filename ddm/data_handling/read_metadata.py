@@ -1,7 +1,12 @@
 import os
+import warnings
+import xml.etree.ElementTree as ET
 import pims
 import nd2
-from typing import Dict
+import tifffile
+from typing import Dict, Tuple
+
+from .zarr_io import read_metadata_zarr
 
 
 def read_metadata(filename: str) -> Dict:
@@ -23,12 +28,13 @@ def read_metadata(filename: str) -> Dict:
         file extension is not supported
     """
 
-    extension = os.path.splitext(filename)[-1]
+    extension = os.path.splitext(str(filename).rstrip("/\\"))[-1]
     formats_metadata = {
         ".lif": read_metadata_lif,
         ".nd2": read_metadata_nd2,
         ".tif": read_metadata_tif,
         ".tiff": read_metadata_tif,
+        ".zarr": read_metadata_zarr,
     }
 
     if extension in formats_metadata.keys():
@@ -87,6 +93,10 @@ def read_metadata_lif(filename: str) -> Dict:
 def read_metadata_tif(filename: str) -> Dict:
     """Read metadata from tif file
 
+    The pixel size and frame time are read from the OME-XML (any schema version),
+    the ImageJ metadata or the resolution tags, in that order, and converted to
+    micron and ms. A value that is not available defaults to 1.0 with a warning.
+
     Parameters
     ----------
     filename : str
@@ -97,14 +107,109 @@ def read_metadata_tif(filename: str) -> Dict:
     Dict
         image metadata
     """
-    metadata = {}
-    with pims.Bioformats(filename) as imgs:
-        try:
-            metadata["xscale"] = imgs.metadata.PixelsPhysicalSizeX(0)
-        except AttributeError:
-            metadata["xscale"] = 1.0
-        try:
-            metadata["tscale"] = imgs.metadata.PixelsTimeIncrement(0) * 1000.0
-        except AttributeError:
-            metadata["tscale"] = 1.0
-    return metadata
+    xscale, tscale = None, None
+    with tifffile.TiffFile(filename) as tif:
+        page = tif.pages[0]
+        if tif.is_ome:
+            xscale, tscale = _ome_scales(tif.ome_metadata)
+        if tif.is_imagej:
+            imagej = tif.imagej_metadata
+            if xscale is None and "XResolution" in page.tags:
+                # Resolution in pixels per unit of the ImageJ metadata
+                xscale = _pixel_size(page, imagej.get("unit", "micron"))
+            if tscale is None and "finterval" in imagej:
+                tscale = _to_unit(
+                    imagej["finterval"], imagej.get("tunit", "sec"), _TIME_UNITS
+                )
+        elif xscale is None and "XResolution" in page.tags:
+            # Resolution in pixels per inch, centimeter, ... of the ResolutionUnit tag
+            unit = _RESOLUTION_UNITS.get(int(page.tags.valueof("ResolutionUnit", 1)))
+            if unit is not None:
+                xscale = _pixel_size(page, unit)
+
+    if xscale is None:
+        warnings.warn(
+            f"No pixel size found in {filename}, using 1.0 micron", RuntimeWarning
+        )
+    if tscale is None:
+        warnings.warn(
+            f"No frame time found in {filename}, using 1.0 ms", RuntimeWarning
+        )
+    return {
+        "xscale": 1.0 if xscale is None else xscale,
+        "tscale": 1.0 if tscale is None else tscale,
+    }
+
+
+# Units in micron and ms, with the OME, ImageJ and TIFF spellings
+_LENGTH_UNITS = {
+    "m": 1e6,
+    "cm": 1e4,
+    "mm": 1e3,
+    "µm": 1.0,
+    "μm": 1.0,
+    "um": 1.0,
+    "\\u00B5m": 1.0,
+    "micron": 1.0,
+    "microns": 1.0,
+    "nm": 1e-3,
+    "pm": 1e-6,
+    "Å": 1e-4,
+    "inch": 25400.0,
+}
+_TIME_UNITS = {
+    "h": 3.6e6,
+    "min": 6e4,
+    "s": 1e3,
+    "sec": 1e3,
+    "ms": 1.0,
+    "msec": 1.0,
+    "µs": 1e-3,
+    "μs": 1e-3,
+    "us": 1e-3,
+    "ns": 1e-6,
+}
+_RESOLUTION_UNITS = {2: "inch", 3: "cm", 4: "mm", 5: "µm"}
+
+
+def _ome_scales(ome_metadata: str) -> Tuple[float, float]:
+    """Pixel size (micron) and frame time (ms) of the first OME image, or None"""
+    root = ET.fromstring(ome_metadata)
+    # The namespace differs between the OME schema versions
+    pixels = next((el for el in root.iter() if el.tag.split("}")[-1] == "Pixels"), None)
+    if pixels is None:
+        return None, None
+
+    xscale, tscale = None, None
+    if "PhysicalSizeX" in pixels.attrib:
+        xscale = _to_unit(
+            float(pixels.get("PhysicalSizeX")),
+            pixels.get("PhysicalSizeXUnit", "µm"),
+            _LENGTH_UNITS,
+        )
+    if "TimeIncrement" in pixels.attrib:
+        tscale = _to_unit(
+            float(pixels.get("TimeIncrement")),
+            pixels.get("TimeIncrementUnit", "s"),
+            _TIME_UNITS,
+        )
+    return xscale, tscale
+
+
+def _pixel_size(page: tifffile.TiffPage, unit: str) -> float:
+    """Pixel size (micron) from the XResolution tag in pixels per unit, or None"""
+    numerator, denominator = page.tags["XResolution"].value
+    if numerator == 0:
+        return None
+    return _to_unit(denominator / numerator, unit, _LENGTH_UNITS)
+
+
+def _to_unit(value: float, unit: str, units: Dict[str, float]) -> float:
+    """Convert a value in unit to micron or ms, None for unknown units"""
+    factor = units.get(str(unit).strip())
+    if factor is None:
+        warnings.warn(
+            f"Unknown unit {unit}, the value {value} is ignored", RuntimeWarning
+        )
+        return None
+    return float(value) * factor
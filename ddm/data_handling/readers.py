@@ -0,0 +1,240 @@
+import os
+from typing import Tuple, Union
+
+import nd2
+import numpy as np
+import pims
+import tifffile
+
+
+class ImageReader:
+    """Open image file from which frames are read in blocks
+
+    The readers expose the number of frames with len(), the frame_shape and the
+    pixel_type like pims readers, and read a range of frames into a single array.
+    """
+
+    frame_shape: Tuple[int, int]
+    pixel_type: np.dtype
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def read(self, start: int, stop: int, step: int = 1) -> np.ndarray:
+        """Read frames start to stop with step
+
+        Parameters
+        ----------
+        start : int
+            index of the first frame
+        stop : int
+            index after the last frame
+        step : int, optional
+            step between the frames, by default 1
+
+        Returns
+        -------
+        np.ndarray
+            frames with shape (frames, height, width)
+        """
+        indices = range(start, stop, step)
+        data = np.empty((len(indices),) + self.frame_shape, dtype=self.pixel_type)
+        for i, index in enumerate(indices):
+            data[i] = self._read_frame(index)
+        return data
+
+    def _read_frame(self, index: int) -> np.ndarray:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TiffReader(ImageReader):
+    """Native reader of .tif files with tifffile, every page of the first series is a frame
+
+    Uncompressed pages are memory-mapped: the frames are a strided view of the file,
+    with the distance between the page offsets as the frame stride, so reading a
+    block of frames copies no data.
+
+    Parameters
+    ----------
+    filename : str
+        path of the .tif file
+    memmap : bool, optional
+        Memory-map uncompressed pages, by default True
+    """
+
+    def __init__(self, filename: str, memmap: bool = True):
+        self._tif = tifffile.TiffFile(filename)
+        self._series = 0
+        series = self._tif.series[0]
+        if series.ndim == 2 and len(self._tif.series) > 1:
+            # Every page is stored as a separate series, read all pages as frames
+            self._series = None
+        self.frame_shape = tuple(series.shape[-2:])
+        self.pixel_type = np.dtype(series.dtype)
+        if self._series is None:
+            self._num_frames = len(self._tif.pages)
+        else:
+            self._num_frames = int(np.prod(series.shape[:-2], dtype=int))
+        self._memmap = self._map_pages() if memmap else None
+
+    def __len__(self) -> int:
+        return self._num_frames
+
+    @property
+    def is_memmapped(self) -> bool:
+        """True if the frames are read zero-copy from a memory map of the file"""
+        return self._memmap is not None
+
+    def read(self, start: int, stop: int, step: int = 1) -> np.ndarray:
+        if self._memmap is not None:
+            return np.asarray(self._memmap[start:stop:step])
+
+        indices = range(start, stop, step)
+        if len(indices) == 0:
+            return np.empty((0,) + self.frame_shape, dtype=self.pixel_type)
+        # All pages of the block are decoded in a single call
+        data = self._tif.asarray(key=indices, series=self._series)
+        return data.reshape((len(indices),) + self.frame_shape)
+
+    def _map_pages(self) -> Union[np.ndarray, None]:
+        """Strided view of the uncompressed frames in a memory map of the file"""
+        path = self._tif.filehandle.path
+        shape = (self._num_frames,) + self.frame_shape
+        dtype = self.pixel_type.newbyteorder(self._tif.byteorder)
+        if not dtype.isnative:
+            return None
+        if self._series is not None:
+            offset = self._tif.series[0].dataoffset
+            if offset is not None:
+                # All frames are stored contiguously
+                return np.memmap(
+                    path, dtype=dtype, mode="r", offset=offset, shape=shape
+                )
+
+        pages = self._tif.pages if self._series is None else self._tif.series[0].pages
+        pages = [pages[i] for i in range(self._num_frames)]
+        if not all(page.is_memmappable for page in pages):
+            return None
+        offsets = np.array([page.dataoffsets[0] for page in pages], dtype=np.int64)
+        frame_bytes = int(np.prod(self.frame_shape)) * dtype.itemsize
+        strides = np.diff(offsets)
+        page_stride = int(strides[0]) if len(strides) > 0 else frame_bytes
+        if np.any(strides != page_stride) or page_stride < frame_bytes:
+            return None
+
+        size = (self._num_frames - 1) * page_stride + frame_bytes
+        buffer = np.memmap(
+            path, dtype=np.uint8, mode="r", offset=offsets[0], shape=size
+        )
+        return np.ndarray(
+            shape,
+            dtype=dtype,
+            buffer=buffer,
+            strides=(page_stride, self.frame_shape[1] * dtype.itemsize, dtype.itemsize),
+        )
+
+    def close(self):
+        self._tif.close()
+
+
+class ND2Reader(ImageReader):
+    """Native reader of .nd2 time series with nd2
+
+    Like pims, the frames of multichannel, multiposition and z-stack files are
+    the time points of the first channel, position and z plane.
+
+    Parameters
+    ----------
+    filename : str
+        path of the .nd2 file
+    """
+
+    def __init__(self, filename: str):
+        self._file = nd2.ND2File(filename)
+        # Frames in the file of the first position and z plane of every time point
+        self._frames = [
+            i
+            for i, loops in enumerate(self._file.loop_indices or ({},))
+            if all(index == 0 for axis, index in loops.items() if axis != "T")
+        ]
+        self.frame_shape = (self._file.sizes["Y"], self._file.sizes["X"])
+        self.pixel_type = np.dtype(self._file.dtype)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def _read_frame(self, index: int) -> np.ndarray:
+        frame = self._file.read_frame(self._frames[index])
+        if frame.shape[-2:] != self.frame_shape:
+            # First component of RGB frames (Y, X, S)
+            frame = frame[..., 0]
+        # First channel of multichannel frames (C, Y, X)
+        return frame.reshape((-1,) + self.frame_shape)[0]
+
+    def close(self):
+        self._file.close()
+
+
+class PimsReader(ImageReader):
+    """Reader of .lif files (and other formats supported by pims) through pims
+
+    Parameters
+    ----------
+    filename : str
+        path of the image file
+    experiment : int, optional
+        selected series of a .lif file, by default 0
+    """
+
+    def __init__(self, filename: str, experiment: int = 0):
+        if os.path.splitext(filename)[-1] == ".lif":
+            # Only .lif files require the Bioformats JVM
+            self._imgs = pims.Bioformats(filename, series=experiment)
+        else:
+            self._imgs = pims.open(filename)
+        self.frame_shape = tuple(self._imgs.frame_shape)
+        self.pixel_type = np.dtype(self._imgs.pixel_type)
+
+    def __len__(self) -> int:
+        return len(self._imgs)
+
+    def _read_frame(self, index: int) -> np.ndarray:
+        return self._imgs[index]
+
+    def close(self):
+        self._imgs.close()
+
+
+def open_reader(filename: str, experiment: int = 0) -> ImageReader:
+    """Open an image file with the native reader of its format
+
+    .tif and .tiff files are read with tifffile and .nd2 files with nd2. Bioformats
+    (through pims) is only used for .lif files and other formats.
+
+    Parameters
+    ----------
+    filename : str
+        path of the image file
+    experiment : int, optional
+        selected experiment in a multi-experiment .lif file, by default 0
+
+    Returns
+    -------
+    ImageReader
+        open reader, to be closed after use
+    """
+    extension = os.path.splitext(str(filename))[-1]
+    if extension in (".tif", ".tiff"):
+        return TiffReader(filename)
+    if extension == ".nd2":
+        return ND2Reader(filename)
+    return PimsReader(str(filename), experiment)
@@ -0,0 +1,212 @@
+import multiprocessing
+import os
+import warnings
+from typing import Dict, Tuple, Union
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+from .dask_image import crop_and_bin
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def read_zarr(
+    filename: str,
+    img_selection: slice = slice(None),
+    roi: Tuple[slice, slice] = None,
+    binning: int = 1,
+) -> da.Array:
+    """Open a Zarr image stack as a dask array with the chunks of the store
+
+    Every dask chunk reads its own Zarr chunks, so many workers can read the store
+    concurrently without a shared file handle.
+
+    Parameters
+    ----------
+    filename : str
+        path of the .zarr store, as written by convert_to_zarr
+    img_selection : slice, optional
+        range and stride of the frames to read, by default all frames
+    roi : Tuple[slice, slice], optional
+        (rows, columns) of the region of interest, by default the full frames
+    binning : int, optional
+        sum binning x binning pixels into one pixel, by default 1
+
+    Returns
+    -------
+    da.Array
+        image stack with shape (frames, height, width)
+    """
+    _check_zarr()
+    arr = da.from_zarr(str(filename))[img_selection]
+    if roi is None and binning == 1:
+        return arr
+
+    frame = crop_and_bin(np.empty((0,) + arr.shape[1:], dtype=arr.dtype), roi, binning)
+    arr = arr.rechunk({1: -1, 2: -1})
+    return arr.map_blocks(
+        crop_and_bin,
+        roi,
+        binning,
+        chunks=(arr.chunks[0],) + tuple((n,) for n in frame.shape[1:]),
+        dtype=frame.dtype,
+    )
+
+
+def read_metadata_zarr(filename: str) -> Dict:
+    """Read metadata from the attributes of a Zarr image stack
+
+    Parameters
+    ----------
+    filename : str
+        path of the .zarr store
+
+    Returns
+    -------
+    Dict
+        image metadata
+    """
+    _check_zarr()
+    attrs = zarr.open_array(str(filename), mode="r").attrs
+    if "xyScale" not in attrs:
+        warnings.warn(
+            f"No pixel size found in {filename}, using 1.0 micron", RuntimeWarning
+        )
+    if "tScale" not in attrs:
+        warnings.warn(
+            f"No frame time found in {filename}, using 1.0 ms", RuntimeWarning
+        )
+    return {
+        "xscale": float(attrs.get("xyScale", 1.0)),
+        "tscale": float(attrs.get("tScale", 1.0)),
+    }
+
+
+def convert_to_zarr(
+    filename: str,
+    zarr_path: str = None,
+    chunk_size: Union[int, str] = "auto",
+    experiment: int = None,
+    max_tau: int = 1,
+) -> str:
+    """Convert an image file to a chunked and compressed Zarr image stack
+
+    The source file is parsed once, and its chunks are written in parallel. The
+    pixel size, frame time and source file are stored as attributes, so read_file
+    reads the .zarr store like the source file.
+
+    Parameters
+    ----------
+    filename : str
+        path of the source image file (.lif, .nd2, .tif or .tiff)
+    zarr_path : str, optional
+        path of the .zarr store, by default the source path with extension .zarr
+    chunk_size : Union[int, str], optional
+        number of frames per Zarr chunk, or "auto" to choose it from max_tau and
+        the available RAM, by default "auto"
+    experiment : int, optional
+        selected experiment in a multi-experiment lif file
+    max_tau : int, optional
+        largest lag time (in frames), used for chunk_size="auto", by default 1
+
+    Returns
+    -------
+    str
+        path of the .zarr store
+    """
+    from .read_file import read_file
+
+    _check_zarr()
+    data = read_file(
+        filename, chunk_size=chunk_size, experiment=experiment, max_tau=max_tau
+    )
+    if zarr_path is None:
+        base = os.path.splitext(os.path.abspath(filename))[0]
+        suffix = f"_{data.attrs['experiment']}" if data.attrs["experiment"] else ""
+        zarr_path = f"{base}{suffix}.zarr"
+
+    da.to_zarr(data.data, zarr_path, overwrite=True)
+    zarr.open_array(zarr_path, mode="r+").attrs.update(
+        xyScale=data.attrs["xyScale"],
+        tScale=data.attrs["tScale"],
+        file=data.attrs["file"],
+        experiment=data.attrs["experiment"],
+    )
+    print(f"Converted {filename} to {zarr_path}")
+    return zarr_path
+
+
+def write_zarr_group(
+    pathname: str,
+    arr: xr.DataArray,
+    A: np.ndarray = None,
+    B: float = None,
+    fits: xr.Dataset = None,
+):
+    """Store a DDM matrix, A(q), B and fit results in a Zarr group
+
+    The DDM matrix is split into blocks of lag times that are written in
+    parallel. The fit results are stored in the subgroup "fits".
+
+    Parameters
+    ----------
+    pathname : str
+        location of the .zarr group
+    arr : xr.DataArray
+        DDM matrix as created by create_data_array
+    A : np.ndarray, optional
+        A(q), by default not stored
+    B : float, optional
+        B, by default not stored
+    fits : xr.Dataset, optional
+        fit results, e.g. of fit_all_q or fit_parallel, by default not stored
+    """
+    _check_zarr()
+    ds = xr.Dataset({"ddm": arr}, attrs=arr.attrs)
+    if A is not None:
+        ds["A"] = ("q", np.asarray(A))
+    if B is not None:
+        ds["B"] = B
+    block = max(1, -(-len(arr.tau) // multiprocessing.cpu_count()))
+    ds.chunk({"tau": block}).to_zarr(pathname, mode="w", consolidated=False)
+    if fits is not None:
+        fits.to_zarr(pathname, group="fits", mode="w", consolidated=False)
+
+
+def read_zarr_group(pathname: str) -> Dict:
+    """Load a DDM matrix, A(q), B and fit results stored with write_zarr_group
+
+    Parameters
+    ----------
+    pathname : str
+        location of the .zarr group
+
+    Returns
+    -------
+    Dict
+        "ddm" data array and, if stored, "A", "B" and "fits"
+    """
+    _check_zarr()
+    with xr.open_zarr(pathname, consolidated=False) as ds:
+        ds = ds.load()
+    stored = {"ddm": ds["ddm"]}
+    if "A" in ds:
+        stored["A"] = ds["A"].values
+    if "B" in ds:
+        stored["B"] = float(ds["B"])
+    if "fits" in zarr.open_group(pathname, mode="r"):
+        with xr.open_zarr(pathname, group="fits", consolidated=False) as fits:
+            stored["fits"] = fits.load()
+    return stored
+
+
+def _check_zarr():
+    if zarr is None:
+        raise ImportError(
+            "Zarr support requires zarr, install it with `pip install zarr`"
+        )
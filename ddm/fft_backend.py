@@ -0,0 +1,277 @@
+import contextlib
+import multiprocessing
+import time
+from typing import Dict, List, Tuple, Union
+
+import dask
+import dask.array as da
+import numpy as np
+import scipy.fft
+
+SUPPORTED_BACKENDS = ["numpy", "scipy", "pyfftw"]
+
+# Seconds an unused pyFFTW plan is kept in the cache
+_FFTW_KEEPALIVE = 10.0
+
+_settings = {"backend": "scipy", "workers": None}
+
+
+def set_backend(backend: str = "scipy", workers: int = None):
+    """Select the FFT backend for the 2D Fourier transforms of the frames
+
+    The backend is used by ddm, compute_AB and StreamingDDM. "scipy" and "pyfftw"
+    use several threads per call, "pyfftw" also reuses its plans between calls.
+    "scipy" and "pyfftw" transform single precision frames in single precision on
+    every supported numpy version, numpy only does so from numpy 2.0 on.
+
+    Parameters
+    ----------
+    backend : str, optional
+        "numpy", "scipy" or "pyfftw", by default "scipy"
+    workers : int, optional
+        number of threads per FFT call for "scipy" and "pyfftw", by default the
+        number of CPU cores, or 1 for dask arrays, whose chunks dask already
+        transforms in parallel
+
+    Raises
+    ------
+    ValueError
+        backend is not supported
+    ImportError
+        pyfftw is selected but not installed
+    """
+    _check_backend(backend)
+    _settings.update(backend=backend, workers=workers)
+
+
+def get_backend() -> Tuple[str, int]:
+    """Currently selected FFT backend
+
+    Returns
+    -------
+    Tuple[str, int]
+        name of the backend and the number of threads per FFT call
+    """
+    return _settings["backend"], _resolve_workers(_settings["workers"])
+
+
+@contextlib.contextmanager
+def use_backend(backend: str, workers: int = None):
+    """Temporarily select an FFT backend
+
+    Examples
+    --------
+    >>> with use_backend("scipy", workers=8):
+    ...     ddmMatrix = ddm(data, taus)
+    """
+    previous = dict(_settings)
+    set_backend(backend, workers)
+    try:
+        yield
+    finally:
+        _settings.update(previous)
+
+
+def fft2(
+    data: Union[dask.array.core.Array, np.ndarray],
+    rfft: bool = False,
+    backend: str = None,
+    workers: int = None,
+) -> Union[dask.array.core.Array, np.ndarray]:
+    """2D Fourier transform of every frame with the selected backend
+
+    Integer and float32 frames are transformed in single precision, without a
+    double precision intermediate (except with the numpy backend on numpy < 2.0).
+    float64 frames are transformed in double precision.
+
+    The backends only transform NumPy arrays (and dask arrays of NumPy chunks).
+    Other arrays, e.g. CuPy arrays on the GPU, are transformed on their own
+    device by the fft module of their array library, backend and workers do not
+    apply to them.
+
+    Parameters
+    ----------
+    data : Union[dask.array.core.Array, np.ndarray]
+        image stack
+    rfft : bool, optional
+        Use the real-input FFT, which only returns the non-negative frequencies
+        along the last axis, by default False
+    backend : str, optional
+        "numpy", "scipy" or "pyfftw", by default the backend selected with set_backend
+    workers : int, optional
+        number of threads per FFT call, by default the setting of set_backend. If
+        neither sets it, the number of CPU cores, or 1 for dask arrays
+
+    Returns
+    -------
+    Union[dask.array.core.Array, np.ndarray]
+        complex64 Fourier transform of every frame, complex128 for float64 frames
+    """
+    if backend is None:
+        backend, workers = _settings["backend"], _settings["workers"]
+    _check_backend(backend)
+
+    if isinstance(data, dask.array.core.Array):
+        # dask runs a task per core, more threads per call would oversubscribe them
+        workers = 1 if workers is None else workers
+        # The backend is stored in the graph, so workers in other processes use it too
+        data = data.rechunk({-2: -1, -1: -1})
+        height, width = data.shape[-2:]
+        return data.map_blocks(
+            _fft2_block,
+            rfft,
+            backend,
+            workers,
+            chunks=data.chunks[:-1] + ((width // 2 + 1 if rfft else width,),),
+            dtype=spectra_dtype(data.dtype),
+            meta=da.utils.meta_from_array(data, dtype=spectra_dtype(data.dtype)),
+        )
+    if not _is_device_array(data):
+        data = np.asarray(data)
+    return _fft2_block(data, rfft, backend, _resolve_workers(workers))
+
+
+def benchmark(
+    shape: Tuple[int, int] = (512, 512),
+    num_frames: int = 64,
+    backends: List[str] = None,
+    workers: int = None,
+    rfft: bool = False,
+    repeat: int = 3,
+) -> Dict[str, float]:
+    """Measure the FFT throughput of the backends in frames per second
+
+    Parameters
+    ----------
+    shape : Tuple[int, int], optional
+        (height, width) of the frames, by default (512, 512)
+    num_frames : int, optional
+        number of frames transformed per call, by default 64
+    backends : List[str], optional
+        backends to measure, by default all installed backends
+    workers : int, optional
+        number of threads per FFT call, by default the number of CPU cores
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    repeat : int, optional
+        number of timed calls, the fastest is reported, by default 3
+
+    Returns
+    -------
+    Dict[str, float]
+        frames per second per backend
+    """
+    if backends is None:
+        backends = [name for name in SUPPORTED_BACKENDS if _is_installed(name)]
+    rng = np.random.default_rng(0)
+    frames = rng.poisson(100, (num_frames,) + tuple(shape)).astype(np.uint16)
+
+    results = {}
+    for backend in backends:
+        fft2(frames[:1], rfft, backend, workers)  # warm up and create plans
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fft2(frames, rfft, backend, workers)
+            timings.append(time.perf_counter() - start)
+        results[backend] = num_frames / min(timings)
+        print(f"{backend}: {results[backend]:.0f} frames/s")
+    return results
+
+
+def spectra_dtype(dtype) -> np.dtype:
+    """Data type of the Fourier transform of frames of type dtype
+
+    Parameters
+    ----------
+    dtype : np.dtype
+        data type of the frames
+
+    Returns
+    -------
+    np.dtype
+        complex128 for float64 and complex128 frames, complex64 otherwise
+    """
+    if np.dtype(dtype) in (np.float64, np.complex128):
+        return np.dtype(np.complex128)
+    return np.dtype(np.complex64)
+
+
+def _fft2_block(data: np.ndarray, rfft: bool, backend: str, workers: int):
+    out_dtype = spectra_dtype(data.dtype)
+    if data.dtype.kind != "c":
+        # Cast integer frames directly to the real type of the transform
+        data = data.astype(
+            np.float64 if out_dtype == np.complex128 else np.float32, copy=False
+        )
+    else:
+        data = data.astype(out_dtype, copy=False)
+
+    return _transform(data, rfft, backend, workers).astype(out_dtype, copy=False)
+
+
+def _transform(data: np.ndarray, rfft: bool, backend: str, workers: int):
+    """Transform of data in its own precision, without casting the output"""
+    if _is_device_array(data):
+        # The backends only accept NumPy arrays, e.g. CuPy arrays stay on the GPU
+        xp = _fft_module(data)
+        return xp.rfft2(data) if rfft else xp.fft2(data)
+    if backend == "numpy":
+        # numpy < 2.0 transforms single precision input in double precision
+        return np.fft.rfft2(data) if rfft else np.fft.fft2(data)
+    if backend == "scipy":
+        transform = scipy.fft.rfft2 if rfft else scipy.fft.fft2
+        return transform(data, workers=workers)
+
+    import pyfftw.interfaces.cache
+    import pyfftw.interfaces.scipy_fft
+
+    # Plans are reused between calls, and released after a few idle seconds
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(_FFTW_KEEPALIVE)
+    transform = (
+        pyfftw.interfaces.scipy_fft.rfft2 if rfft else pyfftw.interfaces.scipy_fft.fft2
+    )
+    return transform(data, workers=workers, planner_effort="FFTW_MEASURE")
+
+
+def _is_device_array(data) -> bool:
+    """True for arrays of other libraries than NumPy that define their own fft"""
+    return not isinstance(data, np.ndarray) and (
+        hasattr(data, "__array_namespace__") or hasattr(data, "__array_function__")
+    )
+
+
+def _fft_module(data):
+    """fft module of the array library of data"""
+    if hasattr(data, "__array_namespace__"):
+        xp = data.__array_namespace__()
+        if hasattr(xp, "fft"):
+            return xp.fft
+    # np.fft dispatches to the library of data through __array_function__
+    return np.fft
+
+
+def _check_backend(backend: str):
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(
+            f"{backend} is not a supported FFT backend. The currently supported backends are {SUPPORTED_BACKENDS}."
+        )
+    if not _is_installed(backend):
+        raise ImportError(
+            f"The {backend} FFT backend requires {backend} to be installed"
+        )
+
+
+def _is_installed(backend: str) -> bool:
+    if backend != "pyfftw":
+        return True
+    try:
+        import pyfftw
+    except ImportError:
+        return False
+    return True
+
+
+def _resolve_workers(workers: int = None) -> int:
+    return multiprocessing.cpu_count() if workers is None else workers
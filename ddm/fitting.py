@@ -1,20 +1,49 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from scipy.optimize import curve_fit
 import xarray as xr
 import dask.array as da
 import dask
-from typing import Tuple
-from .processing import radial_profile
-
-
-def compute_AB(dData: xr.DataArray) -> Tuple[np.ndarray, float]:
+from typing import Tuple, Union
+from .processing import calc_AB, fft2, mean_power, prepare_frames, spectra
+
+
+def compute_AB(
+    dData: xr.DataArray,
+    rfft: bool = False,
+    fft_cache: str = None,
+    img_fft: Union[dask.array.core.Array, np.ndarray] = None,
+    dtype: str = "float32",
+    background: Union[str, float, np.ndarray] = None,
+) -> Tuple[np.ndarray, float]:
     """
     Function to calculate the parameters A and B
 
+    The mean of |F|^2 is accumulated chunk by chunk, so the memory usage does not
+    scale with the number of frames. ddm(..., return_AB=True) computes A and B in
+    the same pass as the ddm matrix.
+
     Parameters
     ----------
     dData : xarray.DataArray
         xarray containing the raw image data
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames, shared with
+        ddm. By default no cache is used.
+    img_fft : Union[dask.array.core.Array, np.ndarray], optional
+        Fourier transform of every frame, as returned by processing.spectra, to
+        avoid transforming the data again. By default the data is transformed.
+    dtype : str, optional
+        Precision of the frames and their Fourier transforms, "float32" or
+        "float64", by default "float32"
+    background : Union[str, float, np.ndarray], optional
+        Background subtracted from every frame, "mean" for the mean frame, or a
+        value or frame, see processing.prepare_frames. By default None
 
     Returns
     -------
@@ -24,60 +53,87 @@ def compute_AB(dData: xr.DataArray) -> Tuple[np.ndarray, float]:
         the magnitude of the noise of the image data
     """
 
-    if isinstance(dData.data, np.ndarray):
-        sqFFTmean = findMeanSqFFT_numpy(dData)
+    if img_fft is None:
+        dData = prepare_frames(dData, dtype, background)
+    if img_fft is not None or fft_cache is not None:
+        img_fft = spectra(dData, rfft, fft_cache) if img_fft is None else img_fft
+        power = mean_power(img_fft)
+    elif isinstance(dData.data, np.ndarray):
+        power = _mean_power_numpy(dData, rfft)
     elif isinstance(dData.data, dask.array.core.Array):
-        sqFFTmean = findMeanSqFFT(dData)
+        power = mean_power(fft2(dData.data, rfft))
     else:
         raise TypeError(f"Type {type(dData)} is not supported")
 
-    sqFFTrad = radial_profile(
-        sqFFTmean, (np.shape(sqFFTmean)[0] / 2, np.shape(sqFFTmean)[1] / 2)
-    )
-    b = np.mean(sqFFTrad[-100:-50])  # change depending on size of array
-    a = sqFFTrad - b
-    return a, b
+    power = power.compute() if hasattr(power, "compute") else power
+    return calc_AB(power, dData.shape[1:], rfft)
 
 
-def findMeanSqFFT(dData: dask.array) -> np.ndarray:
+def findMeanSqFFT(dData: dask.array, rfft: bool = False) -> np.ndarray:
     """
     Function to calculate the mean of the square of the FFT over all frames
 
+    Every chunk is reduced to the sum of its squared spectra before the chunks are
+    combined, so only one frame-sized array per chunk is kept in memory.
+
     Parameters
     ----------
     dData : dask.array
         dask array containing the raw image data
+    rfft : bool, optional
+        Use the real-input FFT, which returns the unshifted half-plane, by default False
 
     Returns
     -------
     sqFFTmean : the mean over all frames of the square of the fourier transform
     """
 
-    sqFFT = 2 * da.abs(da.fft.fft2(dData.data).astype(np.complex64)) ** 2
-    sqFFT = da.fft.fftshift(sqFFT)
-    sqFFTmean = da.mean(sqFFT, axis=0).compute()
+    sqFFTmean = 2 * mean_power(fft2(dData.data, rfft)).compute()
+    if not rfft:
+        sqFFTmean = np.fft.fftshift(sqFFTmean, axes=(-2, -1))
     return sqFFTmean
 
 
-def findMeanSqFFT_numpy(dData: np.array) -> np.ndarray:
+def findMeanSqFFT_numpy(
+    dData: np.array, rfft: bool = False, block_frames: int = 64
+) -> np.ndarray:
     """
     Function to calculate the mean of the square of the FFT over all frames
 
+    The frames are transformed block by block into a running sum, so the squared
+    spectra of the full stack are never held in memory.
+
     Parameters
     ----------
     dData : dask.array
         dask array containing the raw image data
+    rfft : bool, optional
+        Use the real-input FFT, which returns the unshifted half-plane, by default False
+    block_frames : int, optional
+        number of frames transformed at once, by default 64
 
     Returns
     -------
     sqFFTmean : the mean over all frames of the square of the fourier transform
     """
-    sqFFT = 2 * np.abs(np.fft.fft2(dData).astype(np.complex64)) ** 2
-    sqFFT = np.fft.fftshift(sqFFT)
-    sqFFTmean = np.mean(sqFFT, axis=0)
+    sqFFTmean = 2 * _mean_power_numpy(dData, rfft, block_frames)
+    if not rfft:
+        sqFFTmean = np.fft.fftshift(sqFFTmean, axes=(-2, -1))
     return sqFFTmean
 
 
+def _mean_power_numpy(
+    dData: np.array, rfft: bool = False, block_frames: int = 64
+) -> np.ndarray:
+    """Unshifted mean of |F|^2 over all frames, transforming block_frames frames at a time"""
+    dData = np.asarray(dData)
+    total = np.zeros(fft2(dData[:1], rfft).shape[1:], dtype=np.float64)
+    for start in range(0, len(dData), block_frames):
+        block_fft = fft2(dData[start : start + block_frames], rfft)
+        total += np.sum(np.abs(block_fft) ** 2, axis=0)
+    return total / len(dData)
+
+
 def singleExp(t, tau, S):
     """
     Function for single exponential DDM fits
@@ -158,6 +214,144 @@ def schultz(lagtime, tau1, tau2, n, S, Z):
     return np.exp(-1.0 * (lagtime / tau1) ** S) * ((1.0 - n) + n * VDist)
 
 
+def _stretched_exp_derivatives(t, tau, S):
+    """Stretched exponential exp(-(t/tau)^S) and its derivatives to tau and S"""
+    x = t / tau
+    u = x**S
+    f = np.exp(-u)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u_log = np.where(x > 0, u * np.log(x), 0.0)
+    return f, f * S * u / tau, -f * u_log
+
+
+def singleExp_jacobian(t, tau, S):
+    """
+    Jacobian of singleExp with respect to (tau, S)
+
+    Parameters
+    ----------
+    t : array_like
+        array of the lag times
+    tau : array_like
+        decay time, broadcast against t
+    S : array_like
+        stretching exponent, broadcast against t
+
+    Returns
+    -------
+    np.ndarray
+        derivatives with the parameters along the last axis
+    """
+    _, dtau, dS = _stretched_exp_derivatives(t, tau, S)
+    return np.stack([dtau, dS], axis=-1)
+
+
+def doubleExp_jacobian(t, tau1, tau2, n, S1, S2):
+    """
+    Jacobian of doubleExp with respect to (tau1, tau2, n, S1, S2)
+
+    Parameters
+    ----------
+    t : array_like
+        array of the lag times
+    tau1, tau2, n, S1, S2 : array_like
+        parameters of doubleExp, broadcast against t
+
+    Returns
+    -------
+    np.ndarray
+        derivatives with the parameters along the last axis
+    """
+    f1, dtau1, dS1 = _stretched_exp_derivatives(t, tau1, S1)
+    f2, dtau2, dS2 = _stretched_exp_derivatives(t, tau2, S2)
+    return np.stack(
+        [n * dtau1, (1 - n) * dtau2, f1 - f2, n * dS1, (1 - n) * dS2], axis=-1
+    )
+
+
+def schultz_jacobian(lagtime, tau1, tau2, n, S, Z):
+    """
+    Jacobian of schultz with respect to (tau1, tau2, n, S, Z)
+
+    Parameters
+    ----------
+    lagtime : array_like
+        array of the lag times
+    tau1, tau2, n, S, Z : array_like
+        parameters of schultz, broadcast against lagtime
+
+    Returns
+    -------
+    np.ndarray
+        derivatives with the parameters along the last axis
+    """
+    E, dE_dtau1, dE_dS = _stretched_exp_derivatives(lagtime, tau1, S)
+
+    # VDist = pre * sin(Z * phi) * (1 + theta^2)^(-Z/2)
+    theta = (lagtime / tau2) / (Z + 1.0)
+    phi = np.arctan(theta)
+    pre = ((Z + 1.0) * tau2) / (Z * lagtime)
+    sine = np.sin(Z * phi)
+    damping = (1.0 + theta**2) ** (-Z / 2.0)
+    VDist = pre * sine * damping
+
+    # Derivatives of the three factors to tau2
+    dtheta = -theta / tau2
+    dphi = dtheta / (1.0 + theta**2)
+    dV_dtau2 = (
+        (pre / tau2) * sine * damping
+        + pre * Z * np.cos(Z * phi) * dphi * damping
+        - pre * sine * damping * Z * theta * dtheta / (1.0 + theta**2)
+    )
+
+    # Derivatives of the three factors to Z
+    dtheta = -theta / (Z + 1.0)
+    dphi = dtheta / (1.0 + theta**2)
+    dV_dZ = (
+        -(tau2 / (Z**2 * lagtime)) * sine * damping
+        + pre * np.cos(Z * phi) * (phi + Z * dphi) * damping
+        + pre
+        * sine
+        * damping
+        * (-0.5 * np.log(1.0 + theta**2) - Z * theta * dtheta / (1.0 + theta**2))
+    )
+
+    mix = (1.0 - n) + n * VDist
+    return np.stack(
+        [
+            dE_dtau1 * mix,
+            E * n * dV_dtau2,
+            E * (VDist - 1.0),
+            dE_dS * mix,
+            E * n * dV_dZ,
+        ],
+        axis=-1,
+    )
+
+
+# Model function, Jacobian, parameter names and (lower, upper) bounds per fit model
+FIT_MODELS = {
+    "singleExp": (
+        singleExp,
+        singleExp_jacobian,
+        ("tau", "S"),
+        ([0.0, 0.0], [np.inf, np.inf]),
+    ),
+    "doubleExp": (
+        doubleExp,
+        doubleExp_jacobian,
+        ("tau1", "tau2", "n", "S1", "S2"),
+        ([0.0, 0.0, 0.0, 1.0, 1.0], [np.inf, np.inf, 1.0, 2.0, 2.0]),
+    ),
+    "schultz": (
+        schultz,
+        schultz_jacobian,
+        ("tau1", "tau2", "n", "S", "Z"),
+        ([0.0, 0.0, -np.inf, 0.0, 0.0], [np.inf, np.inf, np.inf, np.inf, np.inf]),
+    ),
+}
+
+
 def test_linear(isf, taus):
     """ """
     linGrad = (isf[-1] - isf[0]) / (taus[-1] - taus[0])
@@ -169,7 +363,7 @@ def test_linear(isf, taus):
         return False
 
 
-def genFit(isf, taus, fitFunc):
+def genFit(isf, taus, fitFunc, p0=None, return_nfev=False):
     """
     Generalised fitting function to fit the ISF
 
@@ -181,6 +375,10 @@ def genFit(isf, taus, fitFunc):
         decay time
     fitFunc: string
         stretching exponent
+    p0 : array_like, optional
+        initial guess of the parameters, by default all ones
+    return_nfev : bool, optional
+        Also return the number of function evaluations, by default False
 
     Returns
     -------
@@ -199,18 +397,275 @@ def genFit(isf, taus, fitFunc):
             )
         else:
             if fitFunc == "doubleExp":
-                popt, pcov = curve_fit(
+                popt, pcov, infodict, _, _ = curve_fit(
                     supported[fitFunc],
                     taus,
                     isf,
+                    p0=p0,
                     bounds=([0.0, 0.0, 0.0, 1.0, 1.0], [np.inf, np.inf, 1.0, 2.0, 2.0]),
+                    full_output=True,
                 )
             else:
-                popt, pcov = curve_fit(supported[fitFunc], taus, isf)
+                popt, pcov, infodict, _, _ = curve_fit(
+                    supported[fitFunc], taus, isf, p0=p0, full_output=True
+                )
             errs = np.sqrt(np.diag(pcov))
+            if return_nfev:
+                return popt, errs, infodict["nfev"]
             return popt, errs
 
 
+def fit_parallel(
+    isf: np.ndarray,
+    taus: np.ndarray,
+    fitFunc: str = "singleExp",
+    q: np.ndarray = None,
+    n_workers: int = None,
+) -> xr.Dataset:
+    """
+    Fit the ISF of every q value with genFit on a pool of processes
+
+    The q values are split into contiguous blocks, one per process. Within a block
+    every fit is warm-started from the solution of its neighbouring q value, with
+    the decay times scaled by the expected 1/q^2 dependence. The first q value of a
+    block starts from the lag time at which the ISF drops below 1/e.
+
+    Parameters
+    ----------
+    isf : np.ndarray
+        ISF with shape (q, taus), as returned by compute_ISF
+    taus : np.ndarray
+        array of the lag times
+    fitFunc : str, optional
+        fitting function, one of "singleExp", "doubleExp" and "schultz", by default "singleExp"
+    q : np.ndarray, optional
+        q values used to scale the warm start, by default the q index
+    n_workers : int, optional
+        number of processes, by default the number of CPU cores. With 1 the fits
+        run in the current process.
+
+    Returns
+    -------
+    xr.Dataset
+        fitted parameters, their standard errors (suffix "_err"), success flags,
+        number of function evaluations and wall time per q value
+    """
+    if fitFunc not in FIT_MODELS.keys():
+        raise ValueError(
+            f"{fitFunc} is not a supported fitting function. The currently supported functions are {[name for name in FIT_MODELS.keys()]}."
+        )
+    isf = np.atleast_2d(np.asarray(isf, dtype=np.float64))
+    taus = np.asarray(taus, dtype=np.float64)
+    n_q = isf.shape[0]
+    q = np.arange(n_q, dtype=np.float64) if q is None else np.asarray(q, dtype=float)
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    n_workers = max(1, min(n_workers, n_q))
+
+    blocks = [
+        (isf[block], taus, fitFunc, q[block])
+        for block in np.array_split(np.arange(n_q), n_workers)
+    ]
+    start = time.perf_counter()
+    if n_workers == 1:
+        results = [_fit_block(*args) for args in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_fit_block, *zip(*blocks)))
+    print(
+        f"Fitted {n_q} q values with {n_workers} processes in {time.perf_counter() - start:.2f} s"
+    )
+
+    params, errs, nfev, elapsed = [np.concatenate(arr) for arr in zip(*results)]
+    names = FIT_MODELS[fitFunc][2]
+    data_vars = {}
+    for i, name in enumerate(names):
+        data_vars[name] = ("q", params[:, i])
+        data_vars[f"{name}_err"] = ("q", errs[:, i])
+    data_vars["success"] = ("q", np.isfinite(params).all(axis=1))
+    data_vars["nfev"] = ("q", nfev)
+    data_vars["time"] = ("q", elapsed)
+    return xr.Dataset(
+        data_vars, coords=dict(q=np.arange(n_q)), attrs=dict(model=fitFunc)
+    )
+
+
+def _fit_block(
+    isf: np.ndarray, taus: np.ndarray, fitFunc: str, q: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Fit a contiguous block of q values, warm-starting every fit from the previous one"""
+    names = FIT_MODELS[fitFunc][2]
+    is_tau = np.array([name.startswith("tau") for name in names])
+    params = np.full((len(q), len(names)), np.nan)
+    errs = np.full((len(q), len(names)), np.nan)
+    nfev = np.zeros(len(q), dtype=int)
+    elapsed = np.zeros(len(q))
+
+    p0 = None
+    for i in range(len(q)):
+        if p0 is None:
+            p0 = _initial_guess(isf[i : i + 1], taus, fitFunc)[0]
+        elif q[i] > 0 and q[i - 1] > 0:
+            p0 = np.where(is_tau, p0 * (q[i - 1] / q[i]) ** 2, p0)
+
+        start = time.perf_counter()
+        try:
+            params[i], errs[i], nfev[i] = genFit(
+                isf[i], taus, fitFunc, p0=p0, return_nfev=True
+            )
+            p0 = params[i]
+        except (ValueError, RuntimeError):
+            p0 = None
+        elapsed[i] = time.perf_counter() - start
+    return params, errs, nfev, elapsed
+
+
+def fit_all_q(
+    isf: np.ndarray,
+    taus: np.ndarray,
+    model: str = "singleExp",
+    p0: np.ndarray = None,
+    max_iter: int = 200,
+    tol: float = 1e-10,
+) -> xr.Dataset:
+    """
+    Fit the ISF of all q values at once with a vectorized Levenberg-Marquardt solver
+
+    All q values are iterated together with the analytic Jacobian of the model,
+    every q keeps its own damping factor and stops iterating once converged.
+    Parameters are kept within the bounds of the model, and NaN values in the
+    ISF are ignored.
+
+    Parameters
+    ----------
+    isf : np.ndarray
+        ISF with shape (q, taus), as returned by compute_ISF
+    taus : np.ndarray
+        array of the lag times
+    model : str, optional
+        fitting function, one of "singleExp", "doubleExp" and "schultz", by default "singleExp"
+    p0 : np.ndarray, optional
+        initial parameters with shape (n_params,) or (q, n_params), by default
+        estimated from the lag time at which the ISF drops below 1/e
+    max_iter : int, optional
+        maximum number of iterations, by default 200
+    tol : float, optional
+        relative decrease of the sum of squared residuals below which a fit is
+        converged, by default 1e-10
+
+    Returns
+    -------
+    xr.Dataset
+        fitted parameters, their standard errors (suffix "_err"), convergence
+        flags, number of iterations and sum of squared residuals, indexed by q
+    """
+    if model not in FIT_MODELS.keys():
+        raise ValueError(
+            f"{model} is not a supported fitting function. The currently supported functions are {[name for name in FIT_MODELS.keys()]}."
+        )
+    func, jacobian, names, (lower, upper) = FIT_MODELS[model]
+    lower, upper = np.asarray(lower), np.asarray(upper)
+
+    isf = np.atleast_2d(np.asarray(isf, dtype=np.float64))
+    taus = np.asarray(taus, dtype=np.float64)
+    n_q, n_params = isf.shape[0], len(names)
+    valid = np.isfinite(isf)
+
+    if p0 is None:
+        p0 = _initial_guess(isf, taus, model)
+    params = np.clip(
+        np.broadcast_to(np.asarray(p0, dtype=np.float64), (n_q, n_params)).copy(),
+        np.nextafter(lower, np.inf),
+        upper,
+    )
+
+    def residuals(p, idx=slice(None)):
+        with np.errstate(all="ignore"):
+            res = func(taus, *np.moveaxis(p[:, :, np.newaxis], 1, 0)) - isf[idx]
+        # Non-finite model values give an infinite cost, so such steps are rejected
+        return np.where(valid[idx], res, 0.0)
+
+    def jac(p, idx=slice(None)):
+        with np.errstate(all="ignore"):
+            J = jacobian(taus, *np.moveaxis(p[:, :, np.newaxis], 1, 0))
+        return np.where(valid[idx, :, np.newaxis] & np.isfinite(J), J, 0.0)
+
+    res = residuals(params)
+    cost = np.sum(res**2, axis=1)
+    damping = np.full(n_q, 1e-3)
+    active = np.ones(n_q, dtype=bool)
+    converged = np.zeros(n_q, dtype=bool)
+    n_iter = np.zeros(n_q, dtype=int)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        J = jac(params[idx], idx)
+        JtJ = np.einsum("qti,qtj->qij", J, J)
+        grad = np.einsum("qti,qt->qi", J, res[idx])
+
+        # Marquardt scaling of the damping with the diagonal of JtJ
+        diag = np.einsum("qii->qi", JtJ)
+        lhs = JtJ + (damping[idx, np.newaxis] * np.maximum(diag, 1e-12))[
+            ..., np.newaxis
+        ] * np.eye(n_params)
+        step = -np.linalg.solve(lhs, grad[..., np.newaxis])[..., 0]
+        # Parameters that would cross a bound move halfway towards it instead
+        trial = params[idx] + step
+        trial = np.where(trial <= lower, (params[idx] + lower) / 2, trial)
+        trial = np.where(trial > upper, (params[idx] + upper) / 2, trial)
+
+        trial_res = residuals(trial, idx)
+        trial_cost = np.sum(trial_res**2, axis=1)
+        trial_cost[~np.isfinite(trial_cost)] = np.inf
+        better = trial_cost < cost[idx]
+        n_iter[idx] += 1
+
+        done = better & (cost[idx] - trial_cost <= tol * cost[idx])
+        accept = idx[better]
+        params[accept] = trial[better]
+        res[accept] = trial_res[better]
+        cost[accept] = trial_cost[better]
+        damping[accept] /= 10.0
+        damping[idx[~better]] *= 10.0
+
+        # Converged on a small cost decrease, or when no step decreases the cost
+        converged[idx[done]] = True
+        stalled = idx[~better][damping[idx[~better]] > 1e10]
+        converged[stalled] = True
+        active[idx[done]] = False
+        active[stalled] = False
+
+    # Standard errors from the covariance matrix, as in scipy.optimize.curve_fit
+    J = jac(params)
+    dof = np.maximum(valid.sum(axis=1) - n_params, 1)
+    cov = np.linalg.pinv(np.einsum("qti,qtj->qij", J, J))
+    errs = np.sqrt(np.abs(np.einsum("qii->qi", cov)) * (cost / dof)[:, np.newaxis])
+
+    data_vars = {}
+    for i, name in enumerate(names):
+        data_vars[name] = ("q", params[:, i])
+        data_vars[f"{name}_err"] = ("q", errs[:, i])
+    data_vars["converged"] = ("q", converged & np.isfinite(cost))
+    data_vars["n_iter"] = ("q", n_iter)
+    data_vars["residual"] = ("q", cost)
+    return xr.Dataset(data_vars, coords=dict(q=np.arange(n_q)), attrs=dict(model=model))
+
+
+def _initial_guess(isf: np.ndarray, taus: np.ndarray, model: str) -> np.ndarray:
+    """Initial parameters per q from the lag time at which the ISF drops below 1/e"""
+    below = isf < np.exp(-1)
+    tau_e = np.where(below.any(axis=1), taus[np.argmax(below, axis=1)], taus[-1])
+    ones = np.ones_like(tau_e)
+    if model == "singleExp":
+        guess = [tau_e, ones]
+    elif model == "doubleExp":
+        guess = [tau_e / 2.0, tau_e * 2.0, 0.5 * ones, 1.5 * ones, 1.5 * ones]
+    else:
+        guess = [tau_e, tau_e, 0.5 * ones, ones, 10.0 * ones]
+    return np.stack(guess, axis=-1)
+
+
 def DDM_Matrix(ISF, A, B):
     """
     Function to calculate the DDM matrix from a given ISF
@@ -0,0 +1,116 @@
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# Number of contiguous pixels per block, all lag times are accumulated per block
+_BLOCK_PIXELS = 1024
+
+
+def diff_sq_sums(
+    frames: np.ndarray,
+    taus: np.ndarray,
+    n_pairs: np.ndarray = None,
+    starts: List[np.ndarray] = None,
+    parallel: bool = True,
+) -> np.ndarray:
+    """Sum of the squared frame differences sum_t |F(t + tau) - F(t)|^2 for many lag times
+
+    With Numba, the differences are accumulated in a single compiled loop without
+    temporary arrays. The compiled loop releases the GIL, so it runs on all cores
+    with a thread per range of pixels. Without Numba, every lag time is
+    calculated with numpy.
+
+    Parameters
+    ----------
+    frames : np.ndarray
+        Fourier transformed frames with shape (frames, height, width)
+    taus : np.ndarray
+        array of lag times (in frames)
+    n_pairs : np.ndarray, optional
+        number of frame pairs per lag time, starting at the first frame, by
+        default all frame pairs within frames
+    starts : List[np.ndarray], optional
+        first frames of the frame pairs per lag time, used instead of n_pairs
+    parallel : bool, optional
+        Run the Numba kernel on all cores. Use False when the caller already runs
+        in parallel, e.g. in dask tasks. By default True
+
+    Returns
+    -------
+    np.ndarray
+        float64 sums with shape (taus, height, width)
+    """
+    taus = np.asarray(taus, dtype=np.int64)
+    if n_pairs is None:
+        n_pairs = np.maximum(len(frames) - taus, 0)
+    n_pairs = np.asarray(n_pairs, dtype=np.int64)
+
+    if not NUMBA_AVAILABLE:
+        return _diff_sq_sums_numpy(frames, taus, n_pairs, starts)
+
+    if starts is None:
+        flat_starts = np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(taus) + 1, dtype=np.int64)
+    else:
+        flat_starts = np.concatenate([np.zeros(0, dtype=np.int64)] + list(starts))
+        flat_starts = flat_starts.astype(np.int64)
+        offsets = np.cumsum([0] + [len(s) for s in starts]).astype(np.int64)
+
+    flat = np.ascontiguousarray(frames).reshape(len(frames), -1)
+    out = np.zeros((len(taus), flat.shape[1]), dtype=np.float64)
+    args = (flat, taus, n_pairs, flat_starts, offsets, starts is not None, out)
+    n_pixels = flat.shape[1]
+    n_threads = min(multiprocessing.cpu_count(), n_pixels // _BLOCK_PIXELS)
+    if not parallel or n_threads < 2:
+        _kernel(*args, 0, n_pixels)
+    else:
+        # Every thread writes to its own pixels of out
+        bounds = np.linspace(0, n_pixels, n_threads + 1).astype(int)
+        with ThreadPoolExecutor(n_threads) as pool:
+            list(
+                pool.map(lambda lo, hi: _kernel(*args, lo, hi), bounds[:-1], bounds[1:])
+            )
+    return out.reshape((len(taus),) + frames.shape[1:])
+
+
+def _diff_sq_sums_numpy(
+    frames: np.ndarray,
+    taus: np.ndarray,
+    n_pairs: np.ndarray,
+    starts: List[np.ndarray] = None,
+) -> np.ndarray:
+    sums = np.zeros((len(taus),) + frames.shape[1:], dtype=np.float64)
+    for i, tau in enumerate(taus):
+        if starts is None:
+            img_diff = frames[tau : tau + n_pairs[i]] - frames[: n_pairs[i]]
+        else:
+            img_diff = frames[starts[i] + tau] - frames[starts[i]]
+        if len(img_diff) > 0:
+            sums[i] = np.sum(np.abs(img_diff) ** 2, axis=0)
+    return sums
+
+
+def _kernel(frames, taus, n_pairs, starts, offsets, use_starts, out, start, stop):
+    for lo in range(start, stop, _BLOCK_PIXELS):
+        hi = min(lo + _BLOCK_PIXELS, stop)
+        for i in range(len(taus)):
+            tau = taus[i]
+            n = offsets[i + 1] - offsets[i] if use_starts else n_pairs[i]
+            for j in range(n):
+                t = starts[offsets[i] + j] if use_starts else j
+                for p in range(lo, hi):
+                    diff = frames[t + tau, p] - frames[t, p]
+                    out[i, p] += diff.real * diff.real + diff.imag * diff.imag
+
+
+if NUMBA_AVAILABLE:
+    _kernel = numba.njit(nogil=True, cache=True)(_kernel)
@@ -1,10 +1,19 @@
-from typing import Union
+import contextlib
+import functools
+import hashlib
+from typing import Callable, Tuple, Union
 import numpy as np
+import scipy.sparse
+import xarray
 import dask
 from dask.diagnostics import ProgressBar
 import dask.array as da
 from tqdm import tqdm
 
+from . import fft_backend, kernels
+from .data_handling.exporting import append_lag_times, stored_lag_times
+from .data_handling.fft_cache import FFTCache
+from .scheduling import frame_pairs, lag_times, schedule_lags
 from .utils import is_gpu_available
 
 try:
@@ -12,84 +21,362 @@ try:
 except ImportError:
     pass
 
+SUPPORTED_DTYPES = ["float32", "float64"]
+
 
 def ddm(
     data: Union[dask.array.core.Array, np.ndarray],
-    taus: np.ndarray = np.arange(0),
+    taus: Union[np.ndarray, str] = np.arange(0),
     bulk: bool = False,
+    method: str = "difference",
+    rfft: bool = False,
+    max_memory: float = None,
+    max_pairs: int = None,
+    pair_stride: int = 1,
+    pair_sampling: str = "even",
+    return_counts: bool = False,
+    fft_cache: str = None,
+    resume_from: str = None,
+    return_AB: bool = False,
+    scheduler: str = None,
+    client=None,
+    tile_size: Union[int, Tuple[int, int]] = None,
+    tile_overlap: int = 0,
+    dtype: str = "float32",
+    background: Union[str, float, np.ndarray] = None,
 ) -> np.ndarray:
     """_summary_
 
     Parameters
     ----------
     data : Union[dask.array.core.Array, np.ndarray]
-    taus : np.ndarray, optional
-        array of lag times (in frames), by default half of number of frames
+    taus : Union[np.ndarray, str], optional
+        array of lag times (in frames), or a lag time scheme supported by
+        ddm.scheduling.lag_times ("linear", "log", "quasi-log", "multi-tau"),
+        by default every lag time up to half of number of frames
     bulk : bool, optional
         Call dask.compute on entire tau range for GPU processing, by default False
+    method : str, optional
+        "difference" computes every lag time separately from the frame differences,
+        "fft" computes all lag times at once from the temporal autocorrelation of
+        every pixel (Wiener-Khinchin), by default "difference"
+    rfft : bool, optional
+        Use the real-input FFT and only process the non-negative frequencies along
+        the last axis, which halves the FFT work and memory, by default False
+    max_memory : float, optional
+        Split the lag times into batches with an estimated peak memory below
+        max_memory bytes, which share a single Fourier transformed image stack.
+        For dask arrays, every chunk processed concurrently holds float64 partial
+        sums of all lag times of its batch (len(taus) x height x width x 8 bytes),
+        so by default the lag times are split into batches if the estimated peak
+        memory exceeds half of the available RAM.
+    max_pairs : int, optional
+        Maximum number of frame pairs averaged per lag time, by default all frame pairs
+    pair_stride : int, optional
+        Step between the first frames of consecutive frame pairs, by default 1
+    pair_sampling : str, optional
+        "even" for evenly spaced or "random" for randomly selected frame pairs when
+        a lag time has more than max_pairs frame pairs, by default "even"
+    return_counts : bool, optional
+        Also return the number of frame pairs averaged per lag time, by default False
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames. The spectra
+        are read from the cache if available and written to it otherwise. Requires
+        data loaded with read_file. By default no cache is used.
+    resume_from : str, optional
+        Location of a stored DDM matrix (netcdf). Only the lag times that are not
+        stored yet are calculated, and they are appended to the file in place after
+        every batch of lag times. The file is created if it does not exist.
+    return_AB : bool, optional
+        Also return A(q) and B, estimated from the mean power spectrum of the frames
+        in the same pass as the ddm matrix, by default False
+    scheduler : str, optional
+        dask scheduler used for the calculation, e.g. "threads", "processes" or
+        "single-threaded", by default the current dask scheduler
+    client : distributed.Client, optional
+        dask.distributed client to run the calculation on a (local) cluster, see
+        ddm.utils.start_local_cluster. Every worker computes partial sums over its
+        time chunks, which are added in a tree reduction. Takes precedence over
+        scheduler. By default no cluster is used.
+    tile_size : Union[int, Tuple[int, int]], optional
+        Split every frame into tiles of tile_size pixels (or (height, width)) and
+        calculate the ddm matrix of every tile separately and in parallel. By
+        default the full frames are used.
+    tile_overlap : int, optional
+        Number of pixels shared by neighbouring tiles, by default 0
+    dtype : str, optional
+        Precision of the frames and their Fourier transforms, "float32" (complex64
+        spectra) or "float64" (complex128 spectra). Integer frames are cast
+        directly to this type chunk by chunk. By default "float32"
+    background : Union[str, float, np.ndarray], optional
+        Background subtracted from every frame before the Fourier transform,
+        "mean" for the mean frame of the data, or a value or frame. By default
+        no background is subtracted.
 
     Returns
     -------
     np.ndarray
+        ddm matrix, or with tile_size an xarray.Dataset with the ddm matrix of
+        every tile ("tiles") and their average ("average"), see ddm_tiled
+    np.ndarray, optional
+        number of frame pairs per lag time, only returned if return_counts is True
+    np.ndarray, optional
+        A(q), only returned if return_AB is True
+    float, optional
+        B, only returned if return_AB is True
 
     Raises
     ------
     TypeError
         Data type is not supported. Supported types are np.ndarray and dask.array.core.Array.
+    ValueError
+        Lag time range, method or dtype is not supported.
     """
     # Check lag time range
+    if isinstance(taus, str):
+        taus = lag_times(len(data), taus)
     taus = np.arange(1, len(data) // 2) if taus.size == 0 else taus
     if taus[0] == 0:
         raise ValueError("Cannot calculate 0 lag time, please start range at 1")
 
+    supported_methods = ["difference", "fft"]
+    if method not in supported_methods:
+        raise ValueError(
+            f"{method} is not a supported method. The currently supported methods are {supported_methods}."
+        )
+
+    # Select frame pairs per lag time
+    pairs = None
+    if max_pairs is not None or pair_stride > 1:
+        if method == "fft":
+            raise ValueError("Frame pair selection is not supported for method 'fft'")
+        pairs = {
+            tau: frame_pairs(len(data), tau, max_pairs, pair_stride, pair_sampling)
+            for tau in taus
+        }
+    counts = pair_counts(len(data), taus, pairs)
+    data = prepare_frames(data, dtype, background)
+
+    if tile_size is not None and (
+        method == "fft" or return_AB or resume_from is not None
+    ):
+        raise ValueError(
+            "Tiles are not supported for method 'fft', return_AB and resume_from"
+        )
+
+    if client is not None:
+        scheduler = client
+        print(f"Running analysis on {client}")
+    with (
+        dask.config.set(scheduler=scheduler)
+        if scheduler is not None
+        else contextlib.nullcontext()
+    ):
+        result = _dispatch(
+            data,
+            taus,
+            bulk,
+            method,
+            rfft,
+            max_memory,
+            pairs,
+            fft_cache,
+            resume_from,
+            return_AB,
+            client is not None,
+            tile_size,
+            tile_overlap,
+        )
+
+    out = (result,)
+    if return_counts:
+        out += (counts,)
+    if return_AB:
+        if isinstance(result, tuple):
+            out = (result[0],) + out[1:]
+            power = result[1]
+        else:
+            # The GPU and resume paths do not accumulate the power spectrum
+            power = mean_power(spectra(data, rfft, fft_cache))
+            power = power.compute() if hasattr(power, "compute") else power
+        out += calc_AB(power, data.shape[1:], rfft)
+    return out if len(out) > 1 else result
+
+
+def _dispatch(
+    data,
+    taus: np.ndarray,
+    bulk: bool,
+    method: str,
+    rfft: bool,
+    max_memory: float,
+    pairs: dict,
+    fft_cache: str,
+    resume_from: str,
+    return_AB: bool,
+    distributed: bool,
+    tile_size: Union[int, Tuple[int, int]] = None,
+    tile_overlap: int = 0,
+):
+    """Select the implementation of ddm for the data type and options"""
+
+    def report(device):
+        # ddm already reported the cluster the analysis runs on
+        if not distributed:
+            print(f"Running analysis on {device}")
+
     data_type = data.data
-    if isinstance(data_type, np.ndarray):
-        return ddm_numpy(data, taus)
+    if tile_size is not None:
+        report("CPU")
+        result = ddm_tiled(data, taus, tile_size, tile_overlap, rfft, pairs)
+    elif resume_from is not None:
+        report("CPU")
+        result = ddm_resume(
+            data, taus, resume_from, method, rfft, max_memory, pairs, fft_cache
+        )
+    elif method == "fft":
+        report("CPU")
+        result = ddm_fft(data, taus, rfft, fft_cache, return_AB)
+    elif max_memory is not None or pairs is not None:
+        report("CPU")
+        result = ddm_batched(
+            data, taus, max_memory, rfft, pairs, fft_cache, return_power=return_AB
+        )
+    elif isinstance(data_type, np.ndarray):
+        result = ddm_numpy(data, taus, rfft, fft_cache, return_AB)
     elif isinstance(data_type, dask.array.core.Array):
-        if is_gpu_available:
+        if is_gpu_available and fft_cache is None and not distributed:
             try:
                 import cupy as cp
 
-                print("Running analysis on GPU")
-                return ddm_dask_gpu(data, taus, bulk)
+                report("GPU")
+                result = ddm_dask_gpu(data, taus, bulk, rfft)
             except ImportError:
-                print("Running analysis on CPU")
-                return ddm_dask_cpu(data, taus)
+                report("CPU")
+                result = ddm_dask_cpu(data, taus, rfft, fft_cache, return_AB)
         else:
-            print("Running analysis on CPU")
-            return ddm_dask_cpu(data, taus)
+            report("CPU")
+            result = ddm_dask_cpu(data, taus, rfft, fft_cache, return_AB)
     else:
         raise (TypeError, f"Data of type {data_type} is not supported")
+    return result
 
 
-def ddm_numpy(data, taus: np.ndarray):
+def ddm_resume(
+    data,
+    taus: np.ndarray,
+    pathname: str,
+    method: str = "difference",
+    rfft: bool = False,
+    max_memory: float = None,
+    pairs: dict = None,
+    fft_cache: str = None,
+) -> np.ndarray:
+    """Calculate the lag times missing from a stored DDM matrix and append them
+
+    Parameters
+    ----------
+    data : xarray.DataArray
+        image stack
+    taus : np.ndarray
+        array of lag times (in frames)
+    pathname : str
+        location of the stored DDM matrix (netcdf)
+    method : str, optional
+        "difference" or "fft", by default "difference"
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    max_memory : float, optional
+        memory budget per batch in bytes, by default half of the available RAM
+    pairs : dict, optional
+        first frames of the frame pairs per lag time, by default all frame pairs
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames, by default None
+
+    Returns
+    -------
+    np.ndarray
+        ddm matrix of all requested lag times, read from the stored file
+    """
+    missing = taus[~np.isin(taus, stored_lag_times(pathname))]
+    print(f"Calculating {len(missing)} of {len(taus)} lag times")
+
+    def store(batch_taus, result):
+        counts = pair_counts(len(data), batch_taus, pairs)
+        append_lag_times(
+            pathname, result, batch_taus, data.attrs.get("file", ""), counts
+        )
+
+    if len(missing) > 0:
+        if method == "fft":
+            store(missing, ddm_fft(data, missing, rfft, fft_cache))
+        else:
+            ddm_batched(data, missing, max_memory, rfft, pairs, fft_cache, store)
+
+    with xarray.open_dataarray(pathname) as stored:
+        return stored.sel(tau=taus).values
+
+
+def pair_counts(num_frames: int, taus: np.ndarray, pairs: dict = None) -> np.ndarray:
+    """Number of frame pairs averaged per lag time
+
+    Parameters
+    ----------
+    num_frames : int
+        number of frames in the image stack
+    taus : np.ndarray
+        array of lag times (in frames)
+    pairs : dict, optional
+        first frames of the frame pairs per lag time, by default all frame pairs
+
+    Returns
+    -------
+    np.ndarray
+        number of frame pairs per lag time
+    """
+    if pairs is None:
+        return num_frames - np.asarray(taus)
+    return np.array([len(pairs[tau]) for tau in taus])
+
+
+def ddm_numpy(
+    data,
+    taus: np.ndarray,
+    rfft: bool = False,
+    fft_cache: str = None,
+    return_power: bool = False,
+):
     """_summary_
 
     Parameters
     ----------
     data : np.array
         image stack
+    taus : np.ndarray
+        array of lag times (in frames)
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames, by default None
+    return_power : bool, optional
+        Also return the mean power spectrum of the frames, by default False
 
     Returns
     -------
     np.array
         ddm matrix
     """
-    num_frames, height, width = data.shape
-    results = []
+    img_fft = spectra(data, rfft, fft_cache)
+    return ddm_from_fft(img_fft, taus, data.shape[1:], rfft, return_power=return_power)
 
-    img_fft = np.fft.fft2(data).astype(np.complex64)
 
-    for tau in taus:
-        result = dask.delayed(calc_matrix)(img_fft, tau, num_frames, height, width)
-        results.append(result)
-
-    with ProgressBar():
-        out = dask.compute(*results)
-    return np.asarray(out)
-
-
-def ddm_dask_cpu(data, taus: np.ndarray):
+def ddm_dask_cpu(
+    data,
+    taus: np.ndarray,
+    rfft: bool = False,
+    fft_cache: str = None,
+    return_power: bool = False,
+):
     """_summary_
 
     Parameters
@@ -98,30 +385,295 @@ def ddm_dask_cpu(data, taus: np.ndarray):
         _description_
     taus : _type_, optional
         _description_, by default np.arange(0)
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames, by default None
+    return_power : bool, optional
+        Also return the mean power spectrum of the frames, by default False
 
     Returns
     -------
     _type_
         _description_
     """
-    num_frames, _, _ = data.shape
+    # Every concurrent chunk holds float64 partial sums of all lag times, so lag
+    # times that do not fit into the RAM at once are calculated in batches
+    return ddm_batched(
+        data, taus, None, rfft, fft_cache=fft_cache, return_power=return_power
+    )
+
+
+def ddm_from_fft(
+    img_fft: Union[dask.array.core.Array, np.ndarray],
+    taus: np.ndarray,
+    shape: tuple,
+    rfft: bool = False,
+    pairs: dict = None,
+    return_power: bool = False,
+) -> np.ndarray:
+    """Calculate the DDM matrix from a Fourier transformed image stack
+
+    Parameters
+    ----------
+    img_fft : Union[dask.array.core.Array, np.ndarray]
+        Fourier transform of every frame, as returned by fft2
+    taus : np.ndarray
+        array of lag times (in frames)
+    shape : tuple
+        (height, width) of the frames
+    rfft : bool, optional
+        img_fft is the output of a real-input FFT, by default False
+    pairs : dict, optional
+        first frames of the frame pairs per lag time, by default all frame pairs
+    return_power : bool, optional
+        Also return the mean power spectrum of the frames, computed in the same
+        pass as the ddm matrix, by default False
+
+    Returns
+    -------
+    np.ndarray
+        ddm matrix
+    np.ndarray, optional
+        mean of |F|^2 over all frames, only returned if return_power is True
+    """
+    num_frames = img_fft.shape[0]
+    height, width = shape
+    pairs = {} if pairs is None else pairs
     results = []
 
-    fft_data = da.fft.fft2(data.data).astype(np.complex64)
+    if isinstance(img_fft, dask.array.core.Array):
+        img_sum, power_sum = dask.compute(lag_sums(img_fft, taus, pairs or None))[0]
+        power = power_sum / num_frames
+        fft_shift = img_sum if rfft else np.fft.fftshift(img_sum, axes=(-2, -1))
+        binner = get_radial_binner((height, width), rfft=rfft)
+        counts = pair_counts(num_frames, taus, pairs or None)
+        result = calc_radial_stack(fft_shift, num_frames, taus, binner, counts)
+        return (result, power) if return_power else result
+
+    if kernels.NUMBA_AVAILABLE:
+        # All lag times in a single compiled pass without temporary arrays
+        starts = [pairs[tau] for tau in taus] if pairs else None
+        img_sum = kernels.diff_sq_sums(img_fft, taus, starts=starts)
+        fft_shift = img_sum if rfft else np.fft.fftshift(img_sum, axes=(-2, -1))
+        binner = get_radial_binner((height, width), rfft=rfft)
+        counts = pair_counts(num_frames, taus, pairs or None)
+        result = calc_radial_stack(fft_shift, num_frames, taus, binner, counts)
+        return (result, mean_power(img_fft)) if return_power else result
 
     for tau in taus:
-        result = calc_matrix_dask(fft_data, tau)
+        result = dask.delayed(calc_matrix)(
+            img_fft, tau, num_frames, height, width, rfft, pairs.get(tau)
+        )
         results.append(result)
+    if return_power:
+        results.append(dask.delayed(mean_power)(img_fft))
+
+    with ProgressBar():
+        out = dask.compute(*results)
+    result = np.asarray(out[: len(taus)])
+    return (result, out[-1]) if return_power else result
+
+
+def ddm_batched(
+    data,
+    taus: np.ndarray,
+    max_memory: float = None,
+    rfft: bool = False,
+    pairs: dict = None,
+    fft_cache: str = None,
+    on_batch: Callable[[np.ndarray, np.ndarray], None] = None,
+    return_power: bool = False,
+):
+    """Calculate the DDM matrix in memory-bounded batches of lag times
+
+    The Fourier transform of the image stack is computed once and kept in memory,
+    every batch of lag times is then calculated from the same spectra.
 
-    fft_shift = dask.compute(*results)
+    Parameters
+    ----------
+    data : xarray.DataArray
+        image stack
+    taus : np.ndarray
+        array of lag times (in frames)
+    max_memory : float, optional
+        memory budget per batch in bytes, by default half of the available RAM
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    pairs : dict, optional
+        first frames of the frame pairs per lag time, by default all frame pairs
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames, by default None
+    on_batch : Callable[[np.ndarray, np.ndarray], None], optional
+        function called with the lag times and the ddm matrix of every finished batch
+    return_power : bool, optional
+        Also return the mean power spectrum of the frames, computed together with
+        the first batch, by default False
+
+    Returns
+    -------
+    np.ndarray
+        ddm matrix
+    """
+    num_frames, height, width = data.shape
+    delayed = isinstance(data.data, dask.array.core.Array)
+    chunk_frames = data.data.chunksize[0] if delayed else num_frames
+
+    # Without a budget, batches only split lag times that do not fit into the RAM
+    batches = schedule_lags(
+        taus, num_frames, (height, width), max_memory, chunk_frames, rfft
+    )
+    if max_memory is not None or len(batches) > 1:
+        for i, batch in enumerate(batches):
+            print(
+                f"Batch {i + 1}/{len(batches)}: {len(batch.taus)} lag times "
+                f"({batch.taus[0]}-{batch.taus[-1]}), estimated peak memory {batch.memory / 1024**3:.2f} GB"
+            )
+
+    img_fft = spectra(data, rfft, fft_cache)
+    if delayed and fft_cache is None and len(batches) > 1:
+        img_fft = img_fft.persist()
 
     out = []
-    for row, tau in zip(fft_shift, taus):
-        out.append(calc_radial(row, num_frames, tau))
-    return np.asarray(out)
+    power = None
+    for i, batch in enumerate(batches):
+        result = ddm_from_fft(
+            img_fft,
+            batch.taus,
+            (height, width),
+            rfft,
+            pairs,
+            return_power=return_power and i == 0,
+        )
+        if return_power and i == 0:
+            result, power = result
+        if on_batch is not None:
+            on_batch(batch.taus, result)
+        out.append(result)
+    result = np.concatenate(out)
+    return (result, power) if return_power else result
+
+
+def ddm_tiled(
+    data,
+    taus: np.ndarray,
+    tile_size: Union[int, Tuple[int, int]],
+    tile_overlap: int = 0,
+    rfft: bool = False,
+    pairs: dict = None,
+) -> xarray.Dataset:
+    """Calculate the DDM matrix of every tile of the frames
+
+    Every frame is split into tiles of tile_size pixels. The tiles are Fourier
+    transformed and reduced to partial sums per time chunk independently, and all
+    tiles are calculated in a single dask.compute call. The memory per task is
+    bounded by the tile size, and the result resolves the dynamics spatially.
+
+    Parameters
+    ----------
+    data : xarray.DataArray
+        image stack
+    taus : np.ndarray
+        array of lag times (in frames)
+    tile_size : Union[int, Tuple[int, int]]
+        (height, width) of the tiles in pixels, or a single size for square tiles
+    tile_overlap : int, optional
+        number of pixels shared by neighbouring tiles, by default 0
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    pairs : dict, optional
+        first frames of the frame pairs per lag time, by default all frame pairs
+
+    Returns
+    -------
+    xarray.Dataset
+        "tiles" with the ddm matrix of every tile (tile, tau, q) and "average" with
+        the mean over all tiles (tau, q). The coordinates y and x hold the top left
+        pixel of every tile.
+    """
+    num_frames, height, width = data.shape
+    tile_height, tile_width = (
+        (tile_size, tile_size) if np.isscalar(tile_size) else tuple(tile_size)
+    )
+    origins = tile_origins((height, width), (tile_height, tile_width), tile_overlap)
+
+    arr = data.data if hasattr(data, "dims") else data
+    if not isinstance(arr, dask.array.core.Array):
+        arr = da.from_array(arr, chunks=-1)
+
+    results = []
+    for y, x in origins:
+        tile = arr[:, y : y + tile_height, x : x + tile_width]
+        img_fft = fft2(tile.rechunk({1: -1, 2: -1}), rfft)
+        results.append(lag_sums(img_fft, taus, pairs))
+    with ProgressBar():
+        results = dask.compute(*results)
+
+    binner = get_radial_binner((tile_height, tile_width), rfft=rfft)
+    counts = pair_counts(num_frames, taus, pairs)
+    tiles = []
+    for img_sum, _ in results:
+        fft_shift = img_sum if rfft else np.fft.fftshift(img_sum, axes=(-2, -1))
+        tiles.append(calc_radial_stack(fft_shift, num_frames, taus, binner, counts))
+    tiles = np.asarray(tiles)
+
+    return xarray.Dataset(
+        {
+            "tiles": (("tile", "tau", "q"), tiles),
+            "average": (("tau", "q"), tiles.mean(axis=0)),
+        },
+        coords=dict(
+            tau=np.asarray(taus),
+            q=np.arange(tiles.shape[-1]),
+            y=("tile", origins[:, 0]),
+            x=("tile", origins[:, 1]),
+        ),
+        attrs=dict(
+            tile_height=tile_height, tile_width=tile_width, tile_overlap=tile_overlap
+        ),
+    )
+
+
+def tile_origins(
+    shape: Tuple[int, int], tile_size: Tuple[int, int], overlap: int = 0
+) -> np.ndarray:
+    """Top left pixels of the tiles that fit in a frame
+
+    Parameters
+    ----------
+    shape : Tuple[int, int]
+        (height, width) of the frames
+    tile_size : Tuple[int, int]
+        (height, width) of the tiles
+    overlap : int, optional
+        number of pixels shared by neighbouring tiles, by default 0
 
+    Returns
+    -------
+    np.ndarray
+        (y, x) of every tile, with shape (tiles, 2)
 
-def ddm_dask_gpu(data, taus: np.ndarray = np.arange(0), bulk: bool = False):
+    Raises
+    ------
+    ValueError
+        tiles do not fit in the frame or the overlap is not smaller than the tiles
+    """
+    if any(t > s for t, s in zip(tile_size, shape)):
+        raise ValueError(f"Tiles of {tile_size} do not fit in frames of {shape}")
+    if overlap < 0 or overlap >= min(tile_size):
+        raise ValueError(
+            f"Tile overlap should be between 0 and the tile size, not {overlap}"
+        )
+    ys, xs = [
+        np.arange(0, size - tile + 1, tile - overlap)
+        for size, tile in zip(shape, tile_size)
+    ]
+    return np.stack(np.meshgrid(ys, xs, indexing="ij"), axis=-1).reshape(-1, 2)
+
+
+def ddm_dask_gpu(
+    data, taus: np.ndarray = np.arange(0), bulk: bool = False, rfft: bool = False
+):
     """_summary_
 
     Parameters
@@ -132,6 +684,8 @@ def ddm_dask_gpu(data, taus: np.ndarray = np.arange(0), bulk: bool = False):
         _description_, by default np.arange(0)
     bulk : bool, optional
         Call dask.compute on entire tau range, by default False
+    rfft : bool, optional
+        Use the real-input FFT, by default False
 
     Returns
     -------
@@ -139,19 +693,19 @@ def ddm_dask_gpu(data, taus: np.ndarray = np.arange(0), bulk: bool = False):
         _description_
     """
     taus = np.arange(1, len(data) // 2) if taus.size == 0 else taus
-    num_frames, width, height = data.shape
+    num_frames, height, width = data.shape
     results = []
 
-    chunk_size = (data.chunks[0][0], width, height)
+    chunk_size = (data.chunks[0][0], height, width)
 
     data_gpu = da.from_array(cp.asarray(data.data), chunks=chunk_size, asarray=False)
-    fft_data = da.fft.fft2(data_gpu).astype(cp.complex64)
+    fft_data = fft2(data_gpu, rfft)
     del data_gpu
 
     if not bulk:  # compute taus in separate steps
 
         for tau in tqdm(taus):
-            result = calc_matrix_dask(fft_data, tau)
+            result = calc_matrix_dask(fft_data, tau, rfft)
             out = dask.compute(result, scheduler="single-threaded")
             results.append(cp.asnumpy(out[0]))
             del result, out
@@ -160,12 +714,10 @@ def ddm_dask_gpu(data, taus: np.ndarray = np.arange(0), bulk: bool = False):
         del fft_data
         cp._default_memory_pool.free_all_blocks()
 
-        out = []
-        for data, tau in zip(results, taus):
-            out.append(calc_radial(data, num_frames, tau))
+        fft_shift = np.asarray(results)
     else:  # compute all taus in one step
         for tau in taus:
-            result = calc_matrix_dask(fft_data, tau)
+            result = calc_matrix_dask(fft_data, tau, rfft)
             results.append(result)
             del result
             cp._default_memory_pool.free_all_blocks()
@@ -175,15 +727,444 @@ def ddm_dask_gpu(data, taus: np.ndarray = np.arange(0), bulk: bool = False):
         cp._default_memory_pool.free_all_blocks()
 
         fft_shift = np.asarray([cp.asnumpy(x) for x in out])
-        # return fft_shift
-        out = []
-        for data, tau in zip(fft_shift, taus):
-            out.append(calc_radial(data, num_frames, tau))
 
-    return np.asarray(out)
+    binner = get_radial_binner((height, width), rfft=rfft)
+    return calc_radial_stack(fft_shift, num_frames, taus, binner)
+
+
+def ddm_fft(
+    data,
+    taus: np.ndarray,
+    rfft: bool = False,
+    fft_cache: str = None,
+    return_power: bool = False,
+):
+    """Calculate the DDM matrix for all lag times in one pass
+
+    The sum of the squared frame differences for lag time tau follows from the
+    temporal autocorrelation of every pixel of the Fourier transformed images:
+
+        sum_t |F(t + tau) - F(t)|^2 = sum_t |F(t)|^2 + |F(t + tau)|^2 - 2 Re[F*(t) F(t + tau)]
+
+    The first two terms are prefix sums of |F|^2, the last term is obtained for
+    every lag time at once with a zero-padded FFT along the time axis. The cost is
+    O(N log N) per pixel, independent of the number of lag times.
+
+    Parameters
+    ----------
+    data : Union[xarray.DataArray, dask.array.core.Array, np.ndarray]
+        image stack
+    taus : np.ndarray
+        array of lag times (in frames)
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames, by default None
+    return_power : bool, optional
+        Also return the mean power spectrum of the frames, by default False
+
+    Returns
+    -------
+    np.ndarray
+        ddm matrix
+    """
+    taus = np.asarray(taus)
+    num_frames, height, width = data.shape
+    if taus.max() >= num_frames:
+        raise ValueError(
+            f"Lag time {taus.max()} exceeds the number of frames ({num_frames})"
+        )
+
+    # Number of image rows that keeps a zero-padded temporal FFT within the block size
+    nfft = _next_pow_2(2 * num_frames - 1)
+    rows = int(max(1, min(height, _FFT_BLOCK_BYTES // (nfft * width * 16))))
+
+    img_fft = spectra(data, rfft, fft_cache)
+    if isinstance(img_fft, dask.array.core.Array):
+        fft_data = img_fft.rechunk({0: -1, 1: rows, 2: -1})
+        img_sum = fft_data.map_blocks(
+            calc_matrix_fft,
+            taus,
+            chunks=((len(taus),), fft_data.chunks[1], fft_data.chunks[2]),
+            dtype=np.float64,
+        )
+        with ProgressBar():
+            img_sum, power = dask.compute(
+                img_sum, mean_power(img_fft) if return_power else None
+            )
+    else:
+        power = mean_power(img_fft) if return_power else None
+        img_sum = np.empty((len(taus),) + img_fft.shape[1:], dtype=np.float64)
+        for start in range(0, height, rows):
+            img_sum[:, start : start + rows] = calc_matrix_fft(
+                img_fft[:, start : start + rows], taus
+            )
+
+    fft_shift = img_sum if rfft else np.fft.fftshift(img_sum, axes=(-2, -1))
+    binner = get_radial_binner((height, width), rfft=rfft)
+    result = calc_radial_stack(fft_shift, num_frames, taus, binner)
+    return (result, power) if return_power else result
+
+
+def lag_sums(
+    img_fft: dask.array.core.Array, taus: np.ndarray, pairs: dict = None
+) -> dask.delayed:
+    """Fused dask graph of the summed squared frame differences for all lag times
+
+    Every time chunk of the spectra is combined with a halo of the next max(taus)
+    frames and reduced to partial sums of |F(t + tau) - F(t)|^2 for all lag times
+    with t in the chunk. The partial sums are added in a binary tree. The spectra
+    of every chunk are therefore computed once, and the number of tasks scales with
+    the number of chunks instead of chunks x lag times.
+
+    Parameters
+    ----------
+    img_fft : dask.array.core.Array
+        Fourier transform of every frame, as returned by fft2
+    taus : np.ndarray
+        array of lag times (in frames)
+    pairs : dict, optional
+        first frames of the frame pairs per lag time, by default all frame pairs
+
+    Returns
+    -------
+    dask.delayed
+        delayed tuple of the unshifted sums with shape (taus, height, width) and
+        the sum of |F|^2 over all frames
+    """
+    taus = np.asarray(taus)
+    num_frames = img_fft.shape[0]
+    max_tau = int(taus.max())
+    bounds = np.cumsum((0,) + img_fft.chunks[0])
+    blocks = img_fft.to_delayed().ravel()
+
+    # With chunks of at least max_tau frames, every chunk carries its own halo
+    chunk_local = min(img_fft.chunks[0]) >= max_tau
+    if chunk_local:
+        blocks = time_halo(img_fft, max_tau).to_delayed().ravel()
+
+    partials = []
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if chunk_local:
+            halo = []
+        else:
+            # Following chunks that hold the halo of max_tau frames after this chunk
+            halo = [
+                blocks[j]
+                for j in range(i + 1, len(blocks))
+                if bounds[j] < stop + max_tau
+            ]
+        starts = None
+        if pairs is not None:
+            starts = [
+                pairs[tau][(pairs[tau] >= start) & (pairs[tau] < stop)] - start
+                for tau in taus
+            ]
+        partials.append(
+            dask.delayed(calc_block_sums)(
+                blocks[i], halo, taus, num_frames - start, starts, stop - start
+            )
+        )
+
+    while len(partials) > 1:
+        partials = [
+            (
+                dask.delayed(_add_partials)(*partials[i : i + 2])
+                if i + 1 < len(partials)
+                else partials[i]
+            )
+            for i in range(0, len(partials), 2)
+        ]
+    return partials[0]
+
+
+def time_halo(arr: dask.array.core.Array, depth: int) -> dask.array.core.Array:
+    """Extend every time chunk with the first depth frames of the next chunk
 
+    Parameters
+    ----------
+    arr : dask.array.core.Array
+        image stack or spectra, with every time chunk at least depth frames long
+    depth : int
+        number of halo frames, usually the largest lag time
+
+    Returns
+    -------
+    dask.array.core.Array
+        array with overlapping time chunks, the last chunk has no halo
+
+    Raises
+    ------
+    ValueError
+        a time chunk is shorter than depth, which would require a rechunk
+    """
+    if min(arr.chunks[0]) < depth:
+        raise ValueError(
+            f"Time chunks {arr.chunks[0]} are shorter than the halo of {depth} frames,"
+            " please use ddm.scheduling.time_chunks"
+        )
+    return da.overlap.overlap(
+        arr, depth={0: (0, depth)}, boundary="none", allow_rechunk=False
+    )
+
+
+def calc_block_sums(
+    block: np.ndarray,
+    halo: list,
+    taus: np.ndarray,
+    remaining: int,
+    starts: list = None,
+    n_block: int = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Partial sums of the squared frame differences of a single time chunk
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Fourier transformed frames of the chunk
+    halo : list
+        Fourier transformed frames of the following chunks
+    taus : np.ndarray
+        array of lag times (in frames)
+    remaining : int
+        number of frames from the start of the chunk to the end of the stack
+    starts : list, optional
+        first frames of the frame pairs within the chunk per lag time, relative to
+        the start of the chunk, by default all frame pairs
+    n_block : int, optional
+        number of frames of the chunk when block already includes its halo, by
+        default all frames of block
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        sums over the frame pairs starting in the chunk with shape (taus, height,
+        width), and the sum of |F|^2 over the frames of the chunk
+    """
+    frames = np.concatenate([block] + list(halo)) if len(halo) > 0 else block
+    n_block = len(block) if n_block is None else n_block
+    n_pairs = np.clip(remaining - np.asarray(taus), 0, n_block)
+    # dask already runs the chunks in parallel, so the kernel runs serially
+    sums = kernels.diff_sq_sums(frames, taus, n_pairs, starts, parallel=False)
+    power = np.sum(np.abs(block[:n_block]) ** 2, axis=0, dtype=np.float64)
+    return sums, power
+
+
+def _add_partials(a: tuple, b: tuple) -> tuple:
+    return tuple(x + y for x, y in zip(a, b))
+
+
+def calc_matrix_fft(img_fft: np.ndarray, taus: np.ndarray) -> np.ndarray:
+    """Sum of the squared frame differences for all lag times through the temporal autocorrelation
+
+    Parameters
+    ----------
+    img_fft : np.ndarray
+        Fourier transformed image stack (or a spatial block of it) with the full time axis
+    taus : np.ndarray
+        array of lag times (in frames)
+
+    Returns
+    -------
+    np.ndarray
+        sum over all frame pairs of |F(t + tau) - F(t)|^2, with shape (taus, height, width)
+    """
+    num_frames = img_fft.shape[0]
+    img_fft = img_fft.astype(np.complex128)
+
+    # Prefix sums of the power for the sum_t |F(t)|^2 and sum_t |F(t + tau)|^2 terms
+    power_cumsum = np.cumsum(np.abs(img_fft) ** 2, axis=0)
+    head = power_cumsum[num_frames - taus - 1]
+    tail = power_cumsum[-1] - power_cumsum[taus - 1]
+
+    # Autocorrelation sum_t F*(t) F(t + tau) from a zero-padded FFT along time
+    spectrum = np.fft.fft(img_fft, n=_next_pow_2(2 * num_frames - 1), axis=0)
+    autocorr = np.fft.ifft(np.abs(spectrum) ** 2, axis=0)[taus].real
+
+    # Clip negative values from round-off errors at small lag times
+    return np.clip(head + tail - 2 * autocorr, 0, None)
+
+
+def _next_pow_2(n: int) -> int:
+    return 1 << (int(n) - 1).bit_length()
+
+
+# Target size in bytes of a zero-padded time axis block in ddm_fft
+_FFT_BLOCK_BYTES = 2**28
 
-def calc_matrix(img_fft, tau, num_frames, height, width):
+
+def prepare_frames(
+    data,
+    dtype: str = "float32",
+    background: Union[str, float, np.ndarray] = None,
+):
+    """Cast the frames to the working precision and subtract a background
+
+    For dask arrays, the cast and the subtraction are applied lazily per chunk, so
+    integer frames are converted directly to dtype when they are loaded.
+
+    Parameters
+    ----------
+    data : Union[xarray.DataArray, dask.array.core.Array, np.ndarray]
+        image stack
+    dtype : str, optional
+        "float32" or "float64", by default "float32"
+    background : Union[str, float, np.ndarray], optional
+        "mean" to subtract the mean frame, computed in a separate pass over the
+        data, or a value or frame to subtract from every frame, by default None
+
+    Returns
+    -------
+    Union[xarray.DataArray, dask.array.core.Array, np.ndarray]
+        frames of type dtype. The attrs of an xarray.DataArray store a hash of the
+        subtracted background as "background", which is part of the FFT cache key.
+
+    Raises
+    ------
+    ValueError
+        dtype or background is not supported
+    """
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(
+            f"{dtype} is not a supported dtype. The currently supported dtypes are {SUPPORTED_DTYPES}."
+        )
+    arr = data.data if hasattr(data, "dims") else data
+    if isinstance(background, str):
+        if background != "mean":
+            raise ValueError(
+                f"{background} is not a supported background. The currently supported backgrounds are ['mean']."
+            )
+        background = arr.mean(axis=0, dtype=np.float64)
+        background = np.asarray(
+            background.compute() if hasattr(background, "compute") else background
+        )
+    if arr.dtype == dtype and background is None:
+        return data
+
+    arr = arr.astype(dtype)
+    if background is not None:
+        background = np.asarray(background, dtype=dtype)
+        arr = arr - background
+    if not hasattr(data, "dims"):
+        return arr
+
+    frames = data.copy(data=arr)
+    if background is not None:
+        digest = hashlib.sha1(np.ascontiguousarray(background).tobytes())
+        frames.attrs["background"] = digest.hexdigest()[:16]
+    return frames
+
+
+def spectra(data, rfft: bool = False, fft_cache: str = None):
+    """Fourier transform of every frame, optionally through an on-disk cache
+
+    Parameters
+    ----------
+    data : Union[xarray.DataArray, dask.array.core.Array, np.ndarray]
+        image stack
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+    fft_cache : str, optional
+        Folder of an on-disk cache of the Fourier transformed frames. Requires an
+        xarray.DataArray loaded with read_file. By default no cache is used.
+
+    Returns
+    -------
+    Union[dask.array.core.Array, np.ndarray]
+        complex64 Fourier transform of every frame, complex128 for float64 frames
+    """
+    arr = data.data if hasattr(data, "dims") else data
+    if fft_cache is None:
+        return fft2(arr, rfft)
+
+    cache = FFTCache(fft_cache)
+    img_fft = cache.load(data, rfft)
+    if img_fft is None:
+        img_fft = cache.store(data, fft2(arr, rfft), rfft)
+    return img_fft
+
+
+def fft2(data, rfft: bool = False):
+    """2D Fourier transform of every frame in an image stack
+
+    The transform uses the backend selected with ddm.fft_backend.set_backend.
+    Integer and float32 frames are transformed in single precision.
+
+    Parameters
+    ----------
+    data : Union[dask.array.core.Array, np.ndarray]
+        image stack
+    rfft : bool, optional
+        Use the real-input FFT, which only returns the non-negative frequencies
+        along the last axis, by default False
+
+    Returns
+    -------
+    Union[dask.array.core.Array, np.ndarray]
+        complex64 Fourier transform of every frame, complex128 for float64 frames
+    """
+    return fft_backend.fft2(data, rfft)
+
+
+def mean_power(img_fft, block_frames: int = 64):
+    """Mean of |F|^2 over all frames, accumulated block by block
+
+    Only a single frame-sized accumulator and one block of squared magnitudes are
+    kept in memory, instead of the squared magnitude of the full stack.
+
+    Parameters
+    ----------
+    img_fft : Union[dask.array.core.Array, np.ndarray]
+        Fourier transform of every frame, as returned by fft2
+    block_frames : int, optional
+        number of frames per block for numpy arrays, by default 64
+
+    Returns
+    -------
+    Union[dask.array.core.Array, np.ndarray]
+        mean power spectrum, lazy for dask arrays so it can be computed together
+        with the ddm matrix
+    """
+    if isinstance(img_fft, dask.array.core.Array):
+        return (da.abs(img_fft) ** 2).mean(axis=0, dtype=np.float64)
+
+    total = np.zeros(img_fft.shape[1:], dtype=np.float64)
+    for start in range(0, len(img_fft), block_frames):
+        total += np.sum(np.abs(img_fft[start : start + block_frames]) ** 2, axis=0)
+    return total / len(img_fft)
+
+
+def calc_AB(
+    power: np.ndarray, shape: tuple, rfft: bool = False
+) -> Tuple[np.ndarray, float]:
+    """Calculate A(q) and B from the mean power spectrum of the frames
+
+    Parameters
+    ----------
+    power : np.ndarray
+        mean of |F|^2 over all frames, as returned by mean_power
+    shape : tuple
+        (height, width) of the frames
+    rfft : bool, optional
+        power is the half-plane of a real-input FFT, by default False
+
+    Returns
+    -------
+    A : np.ndarray
+        array containing A(q), the pre-factor of the image structure function
+    B : float
+        the magnitude of the noise of the image data
+    """
+    sqFFTmean = 2 * np.asarray(power)
+    if not rfft:
+        sqFFTmean = np.fft.fftshift(sqFFTmean, axes=(-2, -1))
+    sqFFTrad = get_radial_binner(tuple(shape), rfft=rfft)(sqFFTmean)
+    b = np.mean(sqFFTrad[-100:-50])  # change depending on size of array
+    a = sqFFTrad - b
+    return a, b
+
+
+def calc_matrix(img_fft, tau, num_frames, height, width, rfft=False, starts=None):
     """_summary_
 
     Parameters
@@ -198,22 +1179,31 @@ def calc_matrix(img_fft, tau, num_frames, height, width):
         _description_
     width : _type_
         _description_
+    rfft : bool, optional
+        img_fft is the unshifted output of a real-input FFT, by default False
+    starts : np.ndarray, optional
+        first frames of the frame pairs, by default all frame pairs
 
     Returns
     -------
     _type_
         _description_
     """
-    img_diff = img_fft[:-tau, :, :] - img_fft[tau:, :, :]
+    if starts is None:
+        img_diff = img_fft[:-tau, :, :] - img_fft[tau:, :, :]
+        n_pairs = num_frames - tau
+    else:
+        img_diff = img_fft[starts, :, :] - img_fft[starts + tau, :, :]
+        n_pairs = len(starts)
     img_fft_sq = np.abs(img_diff) ** 2
     img_sum = np.sum(img_fft_sq, axis=0)
-    fft_shift = np.fft.fftshift(img_sum)
-    gTau = fft_shift / (num_frames - tau)
-    gTauRadial = radial_profile(gTau, (width / 2.0, height / 2.0))
+    fft_shift = img_sum if rfft else np.fft.fftshift(img_sum)
+    gTau = fft_shift / n_pairs
+    gTauRadial = get_radial_binner((height, width), rfft=rfft)(gTau)
     return gTauRadial
 
 
-def calc_matrix_dask(img_fft, tau):
+def calc_matrix_dask(img_fft, tau, rfft=False, starts=None):
     """_summary_
 
     Parameters
@@ -222,15 +1212,24 @@ def calc_matrix_dask(img_fft, tau):
         _description_
     tau : _type_
         _description_
+    rfft : bool, optional
+        img_fft is the output of a real-input FFT, which is not shifted, by default False
+    starts : np.ndarray, optional
+        first frames of the frame pairs, by default all frame pairs
 
     Returns
     -------
     _type_
         _description_
     """
-    img_diff = img_fft[:-tau, :, :] - img_fft[tau:, :, :]
+    if starts is None:
+        img_diff = img_fft[:-tau, :, :] - img_fft[tau:, :, :]
+    else:
+        img_diff = img_fft[starts, :, :] - img_fft[starts + tau, :, :]
     img_fft_sq = da.abs(img_diff) ** 2
     img_sum = da.sum(img_fft_sq, axis=0)
+    if rfft:
+        return img_sum
     fft_shift = da.fft.fftshift(img_sum)
     return fft_shift
 
@@ -252,12 +1251,45 @@ def calc_radial(fft_shift: np.ndarray, num_frames, tau):
     _type_
         _description_
     """
-    width, height = fft_shift.shape
     gTau = fft_shift / (num_frames - tau)
-    gTauRadial = radial_profile(gTau, (width / 2.0, height / 2.0))
+    gTauRadial = get_radial_binner(fft_shift.shape)(gTau)
     return gTauRadial
 
 
+def calc_radial_stack(
+    fft_shift: np.ndarray,
+    num_frames: int,
+    taus: np.ndarray,
+    binner: "RadialBinner" = None,
+    counts: np.ndarray = None,
+):
+    """Normalise and radially average the summed spectra of all lag times at once
+
+    Parameters
+    ----------
+    fft_shift : np.ndarray
+        fftshifted sum of the squared frame differences with shape (taus, height, width)
+    num_frames : int
+        number of frames in the image stack
+    taus : np.ndarray
+        array of lag times (in frames)
+    binner : RadialBinner, optional
+        radial binner matching the spectra, by default the full-plane binner for
+        the shape of fft_shift
+    counts : np.ndarray, optional
+        number of frame pairs per lag time, by default num_frames - taus
+
+    Returns
+    -------
+    np.ndarray
+        ddm matrix with shape (taus, q)
+    """
+    binner = get_radial_binner(fft_shift.shape[-2:]) if binner is None else binner
+    counts = num_frames - np.asarray(taus) if counts is None else np.asarray(counts)
+    gTau = fft_shift / counts[:, np.newaxis, np.newaxis]
+    return binner.apply(gTau)
+
+
 def calc_radial_gpu(fft_shift: np.ndarray, num_frames, tau):
     """_summary_
 
@@ -282,27 +1314,142 @@ def calc_radial_gpu(fft_shift: np.ndarray, num_frames, tau):
 
 
 def radial_profile(data: np.ndarray, centre: tuple):
-    """_summary_
+    """Azimuthal average of 2D data around a centre
 
     Parameters
     ----------
     data : np.ndarray
-        _description_
+        2D data, e.g. a fftshifted power spectrum
     centre : tuple
-        _description_
+        (row, column) coordinate of the centre
 
     Returns
     -------
-    _type_
-        _description_
+    np.ndarray
+        average of the data per integer radius
     """
-    x, y = np.indices((data.shape))
-    r = np.sqrt((x - centre[0]) ** 2 + (y - centre[1]) ** 2)
-    r = r.astype(np.int)
-    tbin = np.bincount(r.ravel(), data.ravel())
-    nr = np.bincount(r.ravel())
-    radialprofile = tbin / nr
-    return radialprofile
+    binner = get_radial_binner(data.shape, tuple(float(c) for c in centre))
+    return binner(data)
+
+
+class RadialBinner:
+    """Radial bin index for 2D data of a fixed shape
+
+    The integer radius of every pixel, the number of pixels per bin and a sparse
+    bin-assignment matrix are computed once. The binner can then be applied to a
+    single 2D array or to a stack of 2D arrays, e.g. all lag times of a DDM
+    calculation, in one vectorized call.
+
+    Parameters
+    ----------
+    shape : tuple
+        (height, width) of the data
+    centre : tuple, optional
+        (row, column) coordinate of the centre, by default (height / 2, width / 2)
+    bin_width : float, optional
+        width of the radial bins in pixels, by default 1.0
+    rfft : bool, optional
+        Bin the unshifted half-plane output of a real-input FFT of data with the
+        given shape. Every half-plane pixel is weighted by the number of pixels it
+        represents in the fftshifted full plane, by default False
+    """
+
+    def __init__(
+        self,
+        shape: tuple,
+        centre: tuple = None,
+        bin_width: float = 1.0,
+        rfft: bool = False,
+    ):
+        self.shape = tuple(shape)
+        self.centre = (
+            (self.shape[0] / 2.0, self.shape[1] / 2.0) if centre is None else centre
+        )
+        self.bin_width = bin_width
+        self.rfft = rfft
+
+        x, y = np.indices(self.shape)
+        r = np.sqrt((x - self.centre[0]) ** 2 + (y - self.centre[1]) ** 2)
+        self.radius = (r / bin_width).astype(np.intp)
+        self.counts = np.bincount(self.radius.ravel())
+
+        # Pixel of the input data that holds the value of every full-plane pixel
+        height, width = self.shape
+        if rfft:
+            self.input_shape = (height, width // 2 + 1)
+            row, col = np.indices(self.shape)
+            mirror = col > width // 2
+            row[mirror] = -row[mirror] % height
+            col[mirror] = -col[mirror] % width
+            source = np.ravel_multi_index((row, col), self.input_shape)
+            radius = np.fft.ifftshift(self.radius)
+        else:
+            self.input_shape = self.shape
+            source = np.arange(self.radius.size)
+            radius = self.radius
+
+        # Sparse (bins, pixels) assignment matrix that averages the pixels per bin
+        with np.errstate(divide="ignore"):
+            weights = 1.0 / self.counts
+        self.matrix = scipy.sparse.csr_matrix(
+            (weights[radius.ravel()], (radius.ravel(), source.ravel())),
+            shape=(self.n_bins, np.prod(self.input_shape)),
+        )
+
+    @property
+    def n_bins(self) -> int:
+        return len(self.counts)
+
+    def __call__(self, data: np.ndarray) -> np.ndarray:
+        return self.apply(data[np.newaxis])[0]
+
+    def apply(self, stack: np.ndarray) -> np.ndarray:
+        """Radial average of a stack of 2D arrays in a single sparse matrix product
+
+        Parameters
+        ----------
+        stack : np.ndarray
+            data with shape (..., height, width), or (..., height, width // 2 + 1)
+            for a real-input FFT
+
+        Returns
+        -------
+        np.ndarray
+            radial averages with shape (..., n_bins). Empty bins are NaN.
+        """
+        stack = np.asarray(stack)
+        if stack.shape[-2:] != self.input_shape:
+            raise ValueError(
+                f"Data with shape {stack.shape[-2:]} does not match binner shape {self.input_shape}"
+            )
+        flat = stack.reshape((-1, self.matrix.shape[1]))
+        profile = np.asarray(self.matrix @ flat.T).T
+        profile[:, self.counts == 0] = np.nan
+        return profile.reshape(stack.shape[:-2] + (self.n_bins,))
+
+
+@functools.lru_cache(maxsize=32)
+def get_radial_binner(
+    shape: tuple, centre: tuple = None, bin_width: float = 1.0, rfft: bool = False
+) -> RadialBinner:
+    """Cached RadialBinner for a (shape, centre, bin width, rfft) combination
+
+    Parameters
+    ----------
+    shape : tuple
+        (height, width) of the data
+    centre : tuple, optional
+        (row, column) coordinate of the centre, by default (height / 2, width / 2)
+    bin_width : float, optional
+        width of the radial bins in pixels, by default 1.0
+    rfft : bool, optional
+        Bin the half-plane output of a real-input FFT, by default False
+
+    Returns
+    -------
+    RadialBinner
+    """
+    return RadialBinner(tuple(shape), centre, bin_width, rfft)
 
 
 def radial_profile_gpu(data: np.ndarray, centre: tuple):
@@ -322,7 +1469,7 @@ def radial_profile_gpu(data: np.ndarray, centre: tuple):
     """
     x, y = cp.indices((data.shape))
     r = cp.sqrt((x - centre[0]) ** 2 + (y - centre[1]) ** 2)
-    r = r.astype(cp.int)
+    r = r.astype(int)
     tbin = cp.bincount(r.ravel(), data.ravel())
     nr = cp.bincount(r.ravel())
     radialprofile = tbin / nr
@@ -0,0 +1,310 @@
+import multiprocessing
+import warnings
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from .utils import get_available_ram
+
+SUPPORTED_SCHEMES = ["linear", "log", "quasi-log", "multi-tau"]
+SUPPORTED_PAIR_SAMPLING = ["even", "random"]
+
+
+class LagBatch(NamedTuple):
+    """Batch of lag times that is calculated in a single dask.compute call"""
+
+    taus: np.ndarray
+    memory: int
+
+
+def lag_times(
+    num_frames: int,
+    scheme: str = "linear",
+    max_tau: int = None,
+    points_per_decade: int = 10,
+    channels: int = 16,
+) -> np.ndarray:
+    """Generate lag times (in frames) following a sampling scheme
+
+    Parameters
+    ----------
+    num_frames : int
+        number of frames in the image stack
+    scheme : str, optional
+        "linear" for every lag time, "log" for logarithmically spaced lag times,
+        "quasi-log" for the steps 1-9 of every decade (1, 2, ..., 9, 10, 20, ..., 90, 100, ...),
+        "multi-tau" for the lag times of a multi-tau correlator, by default "linear"
+    max_tau : int, optional
+        largest lag time, by default half of the number of frames
+    points_per_decade : int, optional
+        number of lag times per decade for the "log" scheme, by default 10
+    channels : int, optional
+        number of channels in the first level of the "multi-tau" scheme. Every next
+        level has channels / 2 lag times with a doubled spacing, by default 16
+
+    Returns
+    -------
+    np.ndarray
+        sorted array of unique lag times
+
+    Raises
+    ------
+    ValueError
+        scheme is not supported
+    """
+    max_tau = num_frames // 2 - 1 if max_tau is None else max_tau
+    if max_tau < 1:
+        raise ValueError(f"Maximum lag time should be at least 1, not {max_tau}")
+
+    if scheme == "linear":
+        taus = np.arange(1, max_tau + 1)
+    elif scheme == "log":
+        n_points = int(np.ceil(np.log10(max_tau) * points_per_decade)) + 1
+        taus = np.round(np.logspace(0, np.log10(max_tau), n_points))
+    elif scheme == "quasi-log":
+        decades = 10 ** np.arange(int(np.log10(max_tau)) + 1)
+        taus = np.outer(decades, np.arange(1, 10)).ravel()
+    elif scheme == "multi-tau":
+        taus = [np.arange(1, channels + 1)]
+        spacing = 1
+        while taus[-1][-1] < max_tau:
+            spacing *= 2
+            start = taus[-1][-1] + spacing
+            taus.append(start + spacing * np.arange(channels // 2))
+        taus = np.concatenate(taus)
+    else:
+        raise ValueError(
+            f"{scheme} is not a supported lag time scheme. The currently supported schemes are {SUPPORTED_SCHEMES}."
+        )
+
+    taus = np.unique(taus.astype(int))
+    return taus[taus <= max_tau]
+
+
+def estimate_memory(
+    num_frames: int,
+    shape: Tuple[int, int],
+    n_taus: int,
+    chunk_frames: int = None,
+    rfft: bool = False,
+    n_workers: int = None,
+    max_tau: int = None,
+) -> int:
+    """Estimate the peak memory of a DDM calculation for a number of lag times
+
+    The estimate follows the fused graph of ddm.processing.lag_sums. It includes
+    the cached complex64 spectra of all frames and, for every chunk processed
+    concurrently, the chunk together with its halo of max_tau frames and its
+    float64 partial sums of all lag times. The partial sums that wait in the
+    binary tree reduction and the final sums are added as well.
+
+    Parameters
+    ----------
+    num_frames : int
+        number of frames in the image stack
+    shape : Tuple[int, int]
+        (height, width) of the frames
+    n_taus : int
+        number of lag times calculated at once
+    chunk_frames : int, optional
+        number of frames per chunk, by default all frames
+    rfft : bool, optional
+        spectra are calculated with the real-input FFT, by default False
+    n_workers : int, optional
+        number of chunks processed concurrently, by default the number of CPU cores
+    max_tau : int, optional
+        largest lag time (in frames), by default n_taus
+
+    Returns
+    -------
+    int
+        estimated peak memory in bytes
+    """
+    chunk_frames = num_frames if chunk_frames is None else chunk_frames
+    n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+    max_tau = n_taus if max_tau is None else max_tau
+    height, width = shape
+    n_pixels = height * (width // 2 + 1 if rfft else width)
+    frame_bytes = n_pixels * np.dtype(np.complex64).itemsize
+    n_chunks = int(np.ceil(num_frames / chunk_frames))
+
+    spectra = num_frames * frame_bytes
+    sums = n_taus * n_pixels * np.dtype(np.float64).itemsize
+    # A chunk is concatenated with the (whole) chunks that hold its halo
+    halo_chunks = int(np.ceil((chunk_frames + max_tau) / chunk_frames))
+    task_frames = min(halo_chunks * chunk_frames, num_frames) if n_chunks > 1 else 0
+    # partial sums, chunk with halo and the float32 |F|^2 temporaries of the chunk
+    task = sums + task_frames * frame_bytes + chunk_frames * n_pixels * 8
+    # Partial sums per level of the reduction tree and the (shifted) final sums
+    reduction = (int(np.ceil(np.log2(n_chunks))) + 1) * sums
+    return int(spectra + min(n_workers, n_chunks) * task + reduction)
+
+
+def schedule_lags(
+    taus: np.ndarray,
+    num_frames: int,
+    shape: Tuple[int, int],
+    max_memory: float = None,
+    chunk_frames: int = None,
+    rfft: bool = False,
+    n_workers: int = None,
+) -> List[LagBatch]:
+    """Group lag times into batches with an estimated peak memory below a budget
+
+    Parameters
+    ----------
+    taus : np.ndarray
+        array of lag times (in frames)
+    num_frames : int
+        number of frames in the image stack
+    shape : Tuple[int, int]
+        (height, width) of the frames
+    max_memory : float, optional
+        memory budget per batch in bytes, by default half of the available RAM
+    chunk_frames : int, optional
+        number of frames per chunk, by default all frames
+    rfft : bool, optional
+        spectra are calculated with the real-input FFT, by default False
+    n_workers : int, optional
+        number of chunks processed concurrently, by default the number of CPU cores
+
+    Returns
+    -------
+    List[LagBatch]
+        batches of lag times with their estimated peak memory
+    """
+    taus = np.asarray(taus)
+    max_memory = get_available_ram() / 2 if max_memory is None else max_memory
+
+    def memory(batch):
+        # The halo of a batch is its largest lag time
+        return estimate_memory(
+            num_frames, shape, len(batch), chunk_frames, rfft, n_workers, batch.max()
+        )
+
+    single = memory(taus[[np.argmax(taus)]])
+    if single > max_memory:
+        warnings.warn(
+            f"A single lag time needs up to an estimated {single / 1024**3:.2f} GB,"
+            " which exceeds `max_memory`. Lag times will be calculated one at a time.",
+            RuntimeWarning,
+        )
+
+    # Largest number of consecutive lag times per batch within the memory budget
+    batches = []
+    start = 0
+    while start < len(taus):
+        stop = start + 1
+        while stop < len(taus) and memory(taus[start : stop + 1]) <= max_memory:
+            stop += 1
+        batches.append(LagBatch(taus[start:stop], memory(taus[start:stop])))
+        start = stop
+    return batches
+
+
+def time_chunks(
+    num_frames: int,
+    shape: Tuple[int, int],
+    max_tau: int = 1,
+    itemsize: int = 2,
+    max_memory: float = None,
+    n_workers: int = None,
+) -> Tuple[int, ...]:
+    """Time chunk sizes of an image stack from the largest lag time and the available RAM
+
+    Every chunk, together with a halo of max_tau frames from the next chunk, its
+    complex64 spectra, the temporary differences and the float64 sums of up to
+    max_tau lag times, fits in the memory budget of a single worker. Every chunk
+    is at least max_tau frames long, so the halo of a chunk always comes from the
+    next chunk only and every lag difference is chunk-local.
+
+    Parameters
+    ----------
+    num_frames : int
+        number of frames in the image stack
+    shape : Tuple[int, int]
+        (height, width) of the frames
+    max_tau : int, optional
+        largest lag time (in frames), by default 1
+    itemsize : int, optional
+        bytes per pixel of the raw images, by default 2
+    max_memory : float, optional
+        memory budget in bytes, by default half of the available RAM
+    n_workers : int, optional
+        number of chunks processed concurrently, by default the number of CPU cores
+
+    Returns
+    -------
+    Tuple[int, ...]
+        balanced chunk sizes that add up to num_frames
+    """
+    max_memory = get_available_ram() / 2 if max_memory is None else max_memory
+    n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+    n_pixels = shape[0] * shape[1]
+
+    # raw frame, complex64 spectrum, complex64 difference and float32 magnitude
+    frame_bytes = n_pixels * (itemsize + 8 + 12)
+    sums = max_tau * n_pixels * np.dtype(np.float64).itemsize
+    chunk = int((max_memory / n_workers - sums) // frame_bytes) - max_tau
+    if chunk < max_tau:
+        warnings.warn(
+            f"Chunks of max_tau={max_tau} frames exceed the memory budget per worker."
+            " Chunks of max_tau frames will be used.",
+            RuntimeWarning,
+        )
+        chunk = max_tau
+
+    # Equal chunks of at most chunk frames, but never shorter than max_tau
+    n_chunks = int(np.ceil(num_frames / chunk))
+    if num_frames // n_chunks < max_tau:
+        n_chunks = max(1, num_frames // max_tau)
+    return tuple(int(len(c)) for c in np.array_split(np.arange(num_frames), n_chunks))
+
+
+def frame_pairs(
+    num_frames: int,
+    tau: int,
+    max_pairs: int = None,
+    pair_stride: int = 1,
+    sampling: str = "even",
+) -> np.ndarray:
+    """Select the first frame of every frame pair that is averaged for a lag time
+
+    Parameters
+    ----------
+    num_frames : int
+        number of frames in the image stack
+    tau : int
+        lag time (in frames)
+    max_pairs : int, optional
+        maximum number of frame pairs, by default all frame pairs
+    pair_stride : int, optional
+        step between the first frames of consecutive frame pairs, by default 1
+    sampling : str, optional
+        "even" for evenly spaced or "random" for randomly selected frame pairs
+        when there are more than max_pairs frame pairs, by default "even"
+
+    Returns
+    -------
+    np.ndarray
+        sorted array of first frames, the second frames are the first frames + tau
+
+    Raises
+    ------
+    ValueError
+        sampling is not supported
+    """
+    if sampling not in SUPPORTED_PAIR_SAMPLING:
+        raise ValueError(
+            f"{sampling} is not a supported frame pair sampling. The currently supported samplings are {SUPPORTED_PAIR_SAMPLING}."
+        )
+
+    starts = np.arange(0, num_frames - tau, pair_stride)
+    if max_pairs is not None and len(starts) > max_pairs:
+        if sampling == "even":
+            starts = starts[
+                np.round(np.linspace(0, len(starts) - 1, max_pairs)).astype(int)
+            ]
+        else:
+            starts = np.sort(np.random.choice(starts, max_pairs, replace=False))
+    return starts
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Iterator, Tuple
 
 import numpy as np
 from sdt.sim import simulate_gauss
@@ -22,11 +22,29 @@ def generate_images(
     np.array
         3D array of simulated microscopy images
     """
-    stack = []
-    for i in tqdm(range(tracks.shape[-1])):
-        frame = util.invert(generate_frame(tracks[:, :, i], window))
-        stack.append(frame)
-    return np.asarray(stack).astype(np.uint16)
+    stack = list(tqdm(stream_images(tracks, window), total=tracks.shape[-1]))
+    return np.asarray(stack)
+
+
+def stream_images(
+    tracks: np.ndarray, window: Tuple[int, int] = (512, 512)
+) -> Iterator[np.ndarray]:
+    """Generate simulated microscopy images one at a time, as a stand-in for a live camera
+
+    Parameters
+    ----------
+    tracks : np.array
+        3D array with particle tracks with shape (n_particles, 2, time points)
+    window : Tuple[int, int], optional
+        size of the simulated image in pixels, by default (512, 512)
+
+    Yields
+    ------
+    np.array
+        2D simulated microscopy image
+    """
+    for i in range(tracks.shape[-1]):
+        yield util.invert(generate_frame(tracks[:, :, i], window)).astype(np.uint16)
 
 
 def generate_tracks(
@@ -101,7 +119,7 @@ def generate_frame(
     amplitudes = 1000  # amplitude of the PSF
     sigmas = 2  # sigma of the amplitude
     img = simulate_gauss(window, coords, amplitudes, sigmas)
-    img_noisy = np.array(np.random.poisson(img), dtype="float16")  # add shot noise
+    img_noisy = np.array(np.random.poisson(img), dtype="float32")  # add shot noise
     img_noisy += np.random.normal(200, 20, img_noisy.shape)  # add camera noise
     return img_noisy
 
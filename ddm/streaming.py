@@ -0,0 +1,227 @@
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple, Union
+
+import dask
+import numpy as np
+
+from .processing import calc_AB, calc_radial_stack, fft2, get_radial_binner
+
+
+class StreamingDDM:
+    """Online DDM accumulator for image stacks that do not fit in memory
+
+    Frames are added one at a time or in chunks. Only the spectra of the last
+    max(taus) frames are kept in a ring buffer, together with the running sums of
+    the squared frame differences per lag time. The memory usage is therefore
+    independent of the number of frames, and the DDM matrix of all frames added so
+    far is available at any moment. The mean power spectrum of the frames is
+    accumulated in the same pass, so A(q) and B are available as well.
+
+    Parameters
+    ----------
+    taus : np.ndarray
+        array of lag times (in frames)
+    shape : Tuple[int, int]
+        (height, width) of the frames
+    rfft : bool, optional
+        Use the real-input FFT, by default False
+
+    Examples
+    --------
+    >>> stream = StreamingDDM(np.arange(1, 50), data.shape[1:])
+    >>> stream.consume(data)
+    >>> ddmMatrix = stream.matrix()
+    >>> A, B = stream.AB()
+    """
+
+    def __init__(self, taus: np.ndarray, shape: Tuple[int, int], rfft: bool = False):
+        self.taus = np.asarray(taus)
+        if self.taus.min() < 1:
+            raise ValueError("Cannot calculate 0 lag time, please start range at 1")
+        self.shape = tuple(shape)
+        self.rfft = rfft
+        self.max_tau = int(self.taus.max())
+        self.num_frames = 0
+
+        height, width = self.shape
+        fft_shape = (height, width // 2 + 1) if rfft else (height, width)
+        self._buffer = np.zeros((self.max_tau,) + fft_shape, dtype=np.complex64)
+        self._sums = np.zeros((len(self.taus),) + fft_shape, dtype=np.float64)
+        self.counts = np.zeros(len(self.taus), dtype=int)
+        self._power = np.zeros(fft_shape, dtype=np.float64)
+
+    def update(self, frames: Union[np.ndarray, dask.array.core.Array]):
+        """Add a single frame or a chunk of frames
+
+        Parameters
+        ----------
+        frames : Union[np.ndarray, dask.array.core.Array]
+            frame with shape (height, width) or chunk with shape (n, height, width)
+        """
+        for spectrum in self._spectra(frames):
+            self._add(spectrum)
+
+    def consume(
+        self,
+        source: Union[np.ndarray, dask.array.core.Array, Iterable],
+        n_readers: int = 2,
+        n_workers: int = 1,
+        max_prefetch: int = 4,
+        block_frames: int = 64,
+    ) -> "StreamingDDM":
+        """Add all frames from an image stack or an iterable of frames or chunks
+
+        The frames are processed in a pipeline: n_readers threads read chunks ahead
+        of time, n_workers threads Fourier transform them, and the spectra are
+        accumulated in order. Every stage holds at most max_prefetch chunks, so the
+        memory usage stays bounded when reading is faster than the calculation,
+        while the disk and the cores are kept busy.
+
+        Parameters
+        ----------
+        source : Union[np.ndarray, dask.array.core.Array, Iterable]
+            image stack (numpy, dask or xarray), which is read chunk by chunk, or
+            an iterable, e.g. a generator, that yields frames or chunks of frames
+        n_readers : int, optional
+            number of threads that read chunks of a dask array, by default 2. With
+            0, the chunks are read and transformed without threads.
+        n_workers : int, optional
+            number of threads that Fourier transform the chunks, by default 1
+        max_prefetch : int, optional
+            maximum number of chunks per stage that are read or transformed ahead
+            of the accumulation, by default 4
+        block_frames : int, optional
+            number of frames per chunk of a numpy array, by default 64
+
+        Returns
+        -------
+        StreamingDDM
+        """
+        if hasattr(source, "dims"):  # xarray.DataArray
+            source = source.data
+        if isinstance(source, dask.array.core.Array):
+            bounds = np.cumsum((0,) + source.chunks[0])
+            # Every reader thread computes its own chunk, without nested parallelism
+            chunks = prefetch(
+                lambda b: source[b[0] : b[1]].compute(scheduler="synchronous"),
+                zip(bounds[:-1], bounds[1:]),
+                n_readers,
+                max_prefetch,
+            )
+        elif isinstance(source, np.ndarray):
+            source = source[np.newaxis] if source.ndim == 2 else source
+            chunks = (
+                source[start : start + block_frames]
+                for start in range(0, len(source), block_frames)
+            )
+        else:
+            chunks = source
+
+        if n_readers < 1:
+            n_workers = 0
+        for spectra in prefetch(self._spectra, chunks, n_workers, max_prefetch):
+            for spectrum in spectra:
+                self._add(spectrum)
+        return self
+
+    def matrix(self) -> np.ndarray:
+        """DDM matrix of all frames added so far
+
+        Returns
+        -------
+        np.ndarray
+            ddm matrix with shape (taus, q). Lag times without frame pairs are NaN.
+        """
+        fft_shift = (
+            self._sums if self.rfft else np.fft.fftshift(self._sums, axes=(-2, -1))
+        )
+        binner = get_radial_binner(self.shape, rfft=self.rfft)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = calc_radial_stack(
+                fft_shift, self.num_frames, self.taus, binner, self.counts
+            )
+        out[self.counts == 0] = np.nan
+        return out
+
+    def AB(self) -> Tuple[np.ndarray, float]:
+        """A(q) and B from the mean power spectrum of all frames added so far
+
+        Returns
+        -------
+        A : np.ndarray
+            array containing A(q), the pre-factor of the image structure function
+        B : float
+            the magnitude of the noise of the image data
+        """
+        return calc_AB(self._power / max(self.num_frames, 1), self.shape, self.rfft)
+
+    def _spectra(self, frames: Union[np.ndarray, dask.array.core.Array]) -> np.ndarray:
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        if frames.shape[1:] != self.shape:
+            raise ValueError(
+                f"Frames with shape {frames.shape[1:]} do not match shape {self.shape}"
+            )
+        return fft2(frames, self.rfft)
+
+    def _add(self, spectrum: np.ndarray):
+        valid = self.taus <= self.num_frames
+        if valid.any():
+            previous = self._buffer[(self.num_frames - self.taus[valid]) % self.max_tau]
+            self._sums[valid] += np.abs(previous - spectrum) ** 2
+            self.counts[valid] += 1
+        self._buffer[self.num_frames % self.max_tau] = spectrum
+        self._power += np.abs(spectrum) ** 2
+        self.num_frames += 1
+
+
+def prefetch(
+    func: Callable, items: Iterable, n_workers: int = 2, max_prefetch: int = 4
+) -> Iterator:
+    """Apply func to items in a pool of threads ahead of the consumer
+
+    A bounded producer-consumer stage: at most max_prefetch results are being
+    calculated or waiting for the consumer, so a slow consumer stalls the producer
+    instead of filling the memory. The results are returned in the order of items.
+
+    Parameters
+    ----------
+    func : Callable
+        function applied to every item, e.g. to read a chunk
+    items : Iterable
+        items to process, consumed lazily
+    n_workers : int, optional
+        number of threads, by default 2. With 0, func is applied in the calling
+        thread when the consumer asks for the next result.
+    max_prefetch : int, optional
+        maximum number of results calculated ahead of the consumer, by default 4
+
+    Yields
+    ------
+    Iterator
+        func(item) for every item
+    """
+    items = iter(items)
+    if n_workers < 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(n_workers) as pool:
+        pending = collections.deque(
+            pool.submit(func, item)
+            for item in itertools.islice(items, max(max_prefetch, 1))
+        )
+        try:
+            while pending:
+                result = pending.popleft().result()
+                # Refill the queue before handing over the result, so the
+                # threads keep working while the consumer processes it
+                for item in itertools.islice(items, 1):
+                    pending.append(pool.submit(func, item))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
@@ -31,8 +31,74 @@ def print_cpu_count():
     print(f"We have {ncpus} cores to work on!")
 
 
+def get_available_ram() -> int:
+    """Available system memory in bytes"""
+    return psutil.virtual_memory().available
+
+
+def start_local_cluster(
+    n_workers: int = None,
+    memory_limit: float = None,
+    threads_per_worker: int = 1,
+    local_directory: str = None,
+    **kwargs,
+):
+    """Start a dask.distributed LocalCluster with a memory limit per worker
+
+    Every worker is a separate process, so the numpy code is not limited by the
+    GIL. Workers spill data to local_directory when they reach their memory limit.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        number of worker processes, by default the number of CPU cores
+    memory_limit : float, optional
+        memory limit per worker in bytes, by default 80% of the available RAM
+        divided over the workers
+    threads_per_worker : int, optional
+        number of threads per worker, by default 1
+    local_directory : str, optional
+        folder for data spilled to disk, by default the dask temporary directory
+    **kwargs
+        passed on to distributed.LocalCluster
+
+    Returns
+    -------
+    distributed.Client
+        client connected to the cluster, to be passed to ddm(..., client=client)
+
+    Raises
+    ------
+    ImportError
+        dask.distributed is not installed
+    """
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError:
+        raise ImportError(
+            "A local cluster requires dask.distributed, install it with `pip install distributed`"
+        )
+
+    n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+    if memory_limit is None:
+        memory_limit = 0.8 * get_available_ram() / n_workers
+    cluster = LocalCluster(
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        memory_limit=int(memory_limit),
+        local_directory=local_directory,
+        **kwargs,
+    )
+    client = Client(cluster)
+    print(
+        f"Started a local cluster with {n_workers} workers of {memory_limit / 1024**3:.2f} GB,"
+        f" dashboard at {client.dashboard_link}"
+    )
+    return client
+
+
 def print_available_ram():
-    available_ram = psutil.virtual_memory().available / 1024**3
+    available_ram = get_available_ram() / 1024**3
     used_ram = psutil.virtual_memory().used / 1024**3
     percentage = (available_ram / (used_ram + available_ram)) * 100
     print(f"Available ram: {available_ram:.2f} GB ({percentage:.1f}%)")
@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+
+@pytest.fixture
+def random_stack():
+    """Factory of seeded Poisson image stacks (T, Y, X) of uint16"""
+
+    def make(num_frames=20, height=16, width=16, seed=0):
+        rng = np.random.default_rng(seed)
+        data = rng.poisson(100, (num_frames, height, width)).astype(np.uint16)
+        return xr.DataArray(data, dims=["T", "Y", "X"])
+
+    return make
@@ -0,0 +1,78 @@
+import numpy
+import pytest
+import xarray
+
+from ddm.data_handling import export_data
+from ddm.data_handling.exporting import append_lag_times
+from ddm.data_handling.zarr_io import read_zarr_group
+
+
+def test_export_unsupported_type(tmp_path):
+    with pytest.raises(ValueError):
+        export_data(
+            str(tmp_path), numpy.ones((3, 4)), [1, 2, 3], "a.tif", export_type="hdf5"
+        )
+    with pytest.raises(ValueError):
+        export_data(
+            str(tmp_path), numpy.ones((3, 4)), [1, 2, 3], "a.tif", A=numpy.ones(4)
+        )
+
+
+def test_export_zarr(tmp_path):
+    pytest.importorskip("zarr")
+    data = numpy.arange(12, dtype=float).reshape(3, 4)
+    fits = xarray.Dataset({"tau": ("q", numpy.ones(4))})
+    export_data(
+        str(tmp_path),
+        data[:2],
+        [1, 2],
+        "sample.tif",
+        export_type="zarr",
+        A=numpy.arange(4.0),
+        B=2.0,
+        fits=fits,
+    )
+    # New lag times are merged with the stored matrix, A, B and fits are kept
+    export_data(str(tmp_path), data[2:], [3], "sample.tif", export_type="zarr")
+
+    stored = read_zarr_group(str(tmp_path / "sample_matrix.zarr"))
+    assert numpy.array_equal(stored["ddm"].tau, [1, 2, 3])
+    assert numpy.array_equal(stored["ddm"].values, data)
+    assert numpy.array_equal(stored["A"], numpy.arange(4.0))
+    assert stored["B"] == 2.0
+    assert numpy.array_equal(stored["fits"].tau, numpy.ones(4))
+
+
+def test_append_lag_times(tmp_path):
+    pathname = str(tmp_path / "sample_matrix.nc")
+    data = numpy.arange(20, dtype=float).reshape(5, 4)
+    append_lag_times(pathname, data[:3], [1, 2, 3], "sample.tif", [9, 8, 7])
+    # Stored lag times are skipped
+    appended = append_lag_times(
+        pathname, data[1:], [2, 3, 4, 5], "sample.tif", [8, 7, 6, 5]
+    )
+    assert numpy.array_equal(appended.tau, [4, 5])
+
+    with xarray.open_dataarray(pathname) as stored:
+        assert numpy.array_equal(stored.tau, [1, 2, 3, 4, 5])
+        assert numpy.array_equal(stored.values, data)
+        assert numpy.array_equal(stored.pairs, [9, 8, 7, 6, 5])
+    csv = numpy.loadtxt(tmp_path / "sample_matrix.csv", delimiter=",", skiprows=1)
+    assert numpy.array_equal(csv[:, 0], [1, 2, 3, 4, 5])
+    assert numpy.array_equal(csv[:, 1:], data)
+
+
+def test_append_lag_times_counts(tmp_path):
+    pathname = str(tmp_path / "sample_matrix.nc")
+    data = numpy.ones((2, 4))
+    append_lag_times(pathname, data, [1, 2], "sample.tif", [9, 8])
+    # Counts are validated before anything is written
+    with pytest.raises(ValueError):
+        append_lag_times(pathname, data, [3, 4], "sample.tif")
+    with xarray.open_dataarray(pathname) as stored:
+        assert numpy.array_equal(stored.tau, [1, 2])
+
+    pathname = str(tmp_path / "other_matrix.nc")
+    append_lag_times(pathname, data, [1, 2], "other.tif")
+    with pytest.raises(ValueError):
+        append_lag_times(pathname, data, [3, 4], "other.tif", [7, 6])
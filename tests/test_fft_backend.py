@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+import dask.array as da
+
+from ddm import fft_backend
+from ddm.fitting import compute_AB
+from ddm.processing import ddm
+
+BACKENDS = [
+    name for name in fft_backend.SUPPORTED_BACKENDS if fft_backend._is_installed(name)
+]
+
+
+def test_unsupported_backend():
+    with pytest.raises(ValueError) as exc_info:
+        fft_backend.set_backend("foo")
+    assert "not a supported FFT backend" in str(exc_info.value)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("rfft", [False, True])
+def test_backend_matches_numpy(backend, rfft, random_stack):
+    data = random_stack().data
+    expected = np.fft.rfft2(data) if rfft else np.fft.fft2(data)
+    result = fft_backend.fft2(data, rfft, backend, workers=2)
+    assert result.dtype == np.complex64
+    assert np.allclose(result, expected, rtol=1e-4, atol=1e-2)
+    result_dask = fft_backend.fft2(
+        da.from_array(data, chunks=(6, 16, 16)), rfft, backend
+    )
+    assert np.allclose(result_dask.compute(), result)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_use_backend(backend, random_stack):
+    data = random_stack(10, 128, 128)
+    taus = np.arange(1, 5)
+    expected = ddm(data, taus)
+    expected_a, expected_b = compute_AB(data)
+    with fft_backend.use_backend(backend, workers=2):
+        assert fft_backend.get_backend() == (backend, 2)
+        assert np.allclose(ddm(data, taus), expected, rtol=1e-4)
+        a, b = compute_AB(data)
+    assert fft_backend.get_backend()[0] == "scipy"
+    assert b == pytest.approx(expected_b, rel=1e-4)
+    assert np.allclose(a, expected_a, rtol=1e-4)
+
+
+@pytest.mark.parametrize("rfft", [False, True])
+def test_default_backend_single_precision(rfft, random_stack):
+    # The transform itself is single precision, not only its cast output
+    backend, workers = fft_backend.get_backend()
+    frames = random_stack().data.astype(np.float32)
+    result = fft_backend._transform(frames, rfft, backend, workers)
+    assert result.dtype == np.complex64
+
+
+def test_dask_single_thread_per_chunk(monkeypatch, random_stack):
+    calls = []
+
+    def record(data, rfft, backend, workers):
+        calls.append(workers)
+        return np.zeros(data.shape, dtype=np.complex64)
+
+    monkeypatch.setattr(fft_backend, "_fft2_block", record)
+    data = da.from_array(random_stack().data, chunks=(5, 16, 16))
+    fft_backend.fft2(data, backend="scipy").compute()
+    assert calls and set(calls) == {1}
+    fft_backend.fft2(data, backend="scipy", workers=3).compute()
+    assert calls[-1] == 3
+
+
+class DeviceArray:
+    """Duck array that, like CuPy, dispatches numpy functions but refuses np.asarray"""
+
+    def __init__(self, data):
+        self.data = np.asarray(data)
+        self.shape, self.dtype, self.ndim = (
+            self.data.shape,
+            self.data.dtype,
+            self.data.ndim,
+        )
+
+    def __array__(self, *args, **kwargs):
+        raise TypeError("Implicit conversion to a NumPy array is not allowed")
+
+    def __array_function__(self, func, types, args, kwargs):
+        def unwrap(x):
+            if isinstance(x, (list, tuple)):
+                return type(x)(unwrap(y) for y in x)
+            return x.data if isinstance(x, DeviceArray) else x
+
+        out = func(*unwrap(args), **unwrap(kwargs))
+        return DeviceArray(out) if isinstance(out, np.ndarray) else out
+
+    def __getitem__(self, key):
+        return DeviceArray(self.data[key])
+
+    def __len__(self):
+        return len(self.data)
+
+    def astype(self, dtype, copy=True):
+        return DeviceArray(self.data.astype(dtype, copy=copy))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("rfft", [False, True])
+def test_backend_device_array(backend, rfft, random_stack):
+    data = random_stack().data
+    expected = fft_backend.fft2(data, rfft, "numpy")
+    result = fft_backend.fft2(DeviceArray(data), rfft, backend)
+    assert isinstance(result, DeviceArray)
+    assert result.dtype == np.complex64
+    assert np.allclose(result.data, expected, rtol=1e-4, atol=1e-2)
+
+    chunks = da.from_array(DeviceArray(data), chunks=(6, 16, 16), asarray=False)
+    blocks = fft_backend.fft2(chunks, rfft, backend).to_delayed().ravel()
+    result = np.concatenate([block.compute().data for block in blocks])
+    assert np.allclose(result, expected, rtol=1e-4, atol=1e-2)
+
+
+def test_benchmark():
+    result = fft_backend.benchmark((32, 32), num_frames=4, backends=["numpy"], repeat=1)
+    assert result["numpy"] > 0
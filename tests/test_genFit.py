@@ -1,8 +1,11 @@
 import pytest
 
 import numpy as np
+import xarray as xr
+import dask.array as da
 
-from ddm.fitting import genFit
+from ddm.processing import fft2
+from ddm.fitting import genFit, compute_AB, fit_all_q, fit_parallel, FIT_MODELS
 
 def test_unsupported_function():
     with pytest.raises(ValueError) as exc_info:
@@ -38,3 +41,97 @@ def test_fitting_linear():
     with pytest.raises(ValueError) as exc_info:
         genFit(isfData, tData, 'singleExp')
     assert "very little decorrelation" in str(exc_info.value)
+
+def test_compute_AB_rfft():
+    data = xr.DataArray(np.random.poisson(100, (10, 128, 126)).astype(np.uint16))
+    a, b = compute_AB(data)
+    a_rfft, b_rfft = compute_AB(data, rfft=True)
+    assert np.allclose(a_rfft, a, rtol=1e-5, equal_nan=True)
+    assert b_rfft == pytest.approx(b, rel=1e-5)
+
+
+@pytest.mark.parametrize("model, params", [
+    ("singleExp", [0.5, 0.9]),
+    ("doubleExp", [0.2, 2., 0.4, 1.2, 1.5]),
+    ("schultz", [0.5, 0.3, 0.6, 0.9, 5.]),
+])
+def test_jacobian_finite_differences(model, params):
+    func, jacobian, names, _ = FIT_MODELS[model]
+    tData = np.logspace(-2, 1, 30)
+    numerical = []
+    for i in range(len(params)):
+        step = 1e-6*max(abs(params[i]), 1.)
+        up, down = list(params), list(params)
+        up[i] += step
+        down[i] -= step
+        numerical.append((func(tData, *up) - func(tData, *down))/(2.*step))
+    assert np.allclose(jacobian(tData, *params), np.stack(numerical, axis=-1), atol=1e-7)
+
+def test_fit_all_q_singleExp():
+    q = np.arange(1, 21)
+    tData = np.logspace(-2, 1, 40)
+    tau = 3./q**2
+    isfData = np.exp(-1.*(tData/tau[:, np.newaxis])**0.9)
+    isfData += np.random.default_rng(0).normal(0.0, 1e-3, isfData.shape)
+    isfData[3, 5] = np.nan
+    result = fit_all_q(isfData, tData, 'singleExp')
+    assert result.converged.all()
+    # Decays faster than the first lag times are only loosely determined
+    resolved = tau > 2.*tData[0]
+    assert np.allclose(result.tau[resolved], tau[resolved], rtol=1e-2)
+    assert np.allclose(result.tau, tau, rtol=1e-1)
+    assert np.allclose(result.S, 0.9, rtol=2e-2)
+    assert (result.tau_err > 0).all()
+
+def test_fit_all_q_matches_genFit():
+    tData = np.linspace(0., 2000., 1000)
+    isfData = np.exp(-1.*(tData/1000.)**2.)
+    isfData += np.random.normal(0.0, isfData/100., 1000)
+    popt, errs = genFit(isfData, tData, 'singleExp')
+    result = fit_all_q(isfData, tData, 'singleExp')
+    assert np.allclose([result.tau[0], result.S[0]], popt, rtol=1e-5)
+    assert np.allclose([result.tau_err[0], result.S_err[0]], errs, rtol=1e-3)
+
+def test_fit_all_q_unsupported_function():
+    with pytest.raises(ValueError) as exc_info:
+        fit_all_q(np.ones((2, 10)), np.arange(10), "foo")
+    assert "fitting function" in str(exc_info.value)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_fit_parallel_singleExp(n_workers):
+    q = np.arange(1, 21)
+    tData = np.logspace(-2, 1, 40)
+    tau = 3./q**2
+    isfData = np.exp(-1.*(tData/tau[:, np.newaxis])**0.9)
+    isfData += np.random.default_rng(0).normal(0.0, 1e-3, isfData.shape)
+    result = fit_parallel(isfData, tData, 'singleExp', q=q, n_workers=n_workers)
+    assert result.success.all()
+    # Decays faster than the first lag times are only loosely determined
+    resolved = tau > 2.*tData[0]
+    assert np.allclose(result.tau[resolved], tau[resolved], rtol=1e-2)
+    assert np.allclose(result.tau, tau, rtol=1e-1)
+    assert (result.nfev > 0).all()
+    for i in [0, 10, 19]:
+        popt, errs = genFit(isfData[i], tData, 'singleExp')
+        assert np.allclose([result.tau[i], result.S[i]], popt, rtol=1e-4)
+
+def test_genFit_p0():
+    tData = np.linspace(0.,2000.,1000)
+    isfData = np.exp(-1.*(tData/1000.)**2.)
+    popt, errs, nfev = genFit(isfData, tData, 'singleExp', p0=[900., 1.8], return_nfev=True)
+    popt_default, errs_default, nfev_default = genFit(isfData, tData, 'singleExp', return_nfev=True)
+    assert np.allclose(popt, popt_default)
+    assert nfev < nfev_default
+
+
+def test_compute_AB_spectra():
+    data = xr.DataArray(np.random.poisson(100, (10, 128, 126)).astype(np.uint16))
+    a, b = compute_AB(data)
+    a_fft, b_fft = compute_AB(data, img_fft=fft2(data.data))
+    assert np.allclose(a_fft, a, rtol=1e-5, equal_nan=True)
+    assert b_fft == pytest.approx(b, rel=1e-5)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(3, 128, 126)))
+    a_dask, b_dask = compute_AB(data_dask)
+    assert np.allclose(a_dask, a, rtol=1e-5, equal_nan=True)
+    assert b_dask == pytest.approx(b, rel=1e-5)
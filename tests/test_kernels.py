@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from ddm import kernels
+
+
+def random_spectra(num_frames=40, height=40, width=40):
+    rng = np.random.default_rng(0)
+    real, imag = rng.normal(size=(2, num_frames, height, width))
+    return (real + 1j * imag).astype(np.complex64)
+
+
+@pytest.mark.parametrize("parallel", [True, False])
+def test_diff_sq_sums(parallel):
+    frames = random_spectra()
+    taus = np.array([1, 4, 15, 39, 45])
+    n_pairs = np.maximum(len(frames) - taus, 0)
+    expected = kernels._diff_sq_sums_numpy(frames, taus, n_pairs)
+    sums = kernels.diff_sq_sums(frames, taus, parallel=parallel)
+    assert sums.shape == (5, 40, 40)
+    assert np.allclose(sums, expected, rtol=1e-5)
+    assert np.all(sums[-1] == 0)
+
+
+def test_diff_sq_sums_pairs():
+    frames = random_spectra()
+    taus = np.array([1, 10])
+    n_pairs = np.array([5, 30])
+    sums = kernels.diff_sq_sums(frames, taus, n_pairs)
+    assert np.allclose(sums, kernels._diff_sq_sums_numpy(frames, taus, n_pairs))
+
+    starts = [np.array([0, 7, 30]), np.array([2, 29])]
+    sums = kernels.diff_sq_sums(frames, taus, starts=starts)
+    expected = kernels._diff_sq_sums_numpy(frames, taus, n_pairs, starts)
+    assert np.allclose(sums, expected, rtol=1e-5)
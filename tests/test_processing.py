@@ -0,0 +1,306 @@
+import numpy as np
+import pytest
+import xarray as xr
+import dask
+import dask.array as da
+
+from ddm.data_handling.fft_cache import FFTCache
+from ddm.processing import (
+    ddm,
+    fft2,
+    get_radial_binner,
+    lag_sums,
+    prepare_frames,
+    radial_profile,
+    time_halo,
+)
+
+
+def test_unsupported_method(random_stack):
+    with pytest.raises(ValueError) as exc_info:
+        ddm(random_stack(), np.arange(1, 5), method="foo")
+    assert "not a supported method" in str(exc_info.value)
+
+
+def test_fft_method_numpy(random_stack):
+    data = random_stack()
+    taus = np.arange(1, 10)
+    expected = ddm(data, taus)
+    result = ddm(data, taus, method="fft")
+    assert result.shape == expected.shape
+    assert np.allclose(result, expected, rtol=1e-4)
+
+
+def test_fft_method_dask(random_stack):
+    data = random_stack()
+    taus = np.array([1, 3, 7, 15])
+    expected = ddm(data, taus)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    result = ddm(data_dask, taus, method="fft")
+    assert np.allclose(result, expected, rtol=1e-4)
+
+
+def test_radial_binner_matches_bincount():
+    rng = np.random.default_rng(1)
+    data = rng.random((12, 17))
+    centre = (6.0, 8.5)
+    x, y = np.indices(data.shape)
+    r = np.sqrt((x - centre[0]) ** 2 + (y - centre[1]) ** 2).astype(int)
+    expected = np.bincount(r.ravel(), data.ravel()) / np.bincount(r.ravel())
+    assert np.allclose(radial_profile(data, centre), expected)
+
+
+def test_radial_binner_apply_stack():
+    rng = np.random.default_rng(2)
+    stack = rng.random((5, 16, 16))
+    binner = get_radial_binner((16, 16))
+    assert get_radial_binner((16, 16)) is binner
+    result = binner.apply(stack)
+    assert result.shape == (5, binner.n_bins)
+    assert np.allclose(result, [binner(frame) for frame in stack])
+
+
+def test_dask_matches_numpy(random_stack):
+    data = random_stack()
+    taus = np.arange(1, 8)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    assert np.allclose(ddm(data_dask, taus), ddm(data, taus), rtol=1e-5)
+
+
+@pytest.mark.parametrize("shape", [(16, 16), (15, 18), (12, 13)])
+def test_rfft_matches_fft(shape, random_stack):
+    data = random_stack(12, *shape)
+    taus = np.arange(1, 6)
+    expected = ddm(data, taus)
+    assert np.allclose(ddm(data, taus, rfft=True), expected, rtol=1e-5)
+    assert np.allclose(ddm(data, taus, method="fft", rfft=True), expected, rtol=1e-4)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(4,) + shape))
+    assert np.allclose(ddm(data_dask, taus, rfft=True), expected, rtol=1e-5)
+
+
+def test_batched_lag_times(random_stack):
+    data = random_stack()
+    taus = np.arange(1, 10)
+    expected = ddm(data, taus)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    assert np.allclose(ddm(data_dask, taus, max_memory=1e5), expected, rtol=1e-5)
+    assert np.allclose(ddm(data, taus, max_memory=1e5), expected, rtol=1e-5)
+
+
+def test_batched_by_available_ram(random_stack, monkeypatch, capsys):
+    data = random_stack()
+    taus = np.arange(1, 10)
+    expected = ddm(data, taus)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    # Without max_memory, lag times that do not fit into the RAM are batched
+    monkeypatch.setattr("ddm.scheduling.get_available_ram", lambda: 2e5)
+    assert np.allclose(ddm(data_dask, taus), expected, rtol=1e-5)
+    assert "Batch 2/" in capsys.readouterr().out
+
+
+def test_lag_time_scheme(random_stack):
+    data = random_stack(40)
+    result = ddm(data, "quasi-log")
+    assert result.shape[0] == 10
+
+
+def test_max_pairs(random_stack):
+    data = random_stack(40)
+    taus = np.arange(1, 10)
+    expected = ddm(data, taus)
+    result, counts = ddm(data, taus, max_pairs=40, return_counts=True)
+    assert np.allclose(result, expected, rtol=1e-5)
+    assert np.array_equal(counts, 40 - taus)
+
+    result, counts = ddm(data, taus, max_pairs=10, return_counts=True)
+    assert np.all(counts == 10)
+    assert result.shape == expected.shape
+    assert np.allclose(
+        result[:, 1:].mean(axis=1), expected[:, 1:].mean(axis=1), rtol=0.2
+    )
+
+
+def test_pair_stride_dask(random_stack):
+    data = random_stack(40)
+    taus = np.arange(1, 10)
+    expected = ddm(data, taus, pair_stride=3)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    result, counts = ddm(data_dask, taus, pair_stride=3, return_counts=True)
+    assert np.allclose(result, expected, rtol=1e-5)
+    assert np.array_equal(counts, (40 - taus + 2) // 3)
+
+
+def test_fft_cache(tmp_path, random_stack):
+    source = tmp_path / "stack.tif"
+    source.write_bytes(b"stack")
+    data = random_stack()
+    data.attrs.update(file=str(source), experiment=0)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    taus = np.arange(1, 8)
+    expected = ddm(data, taus)
+
+    cache_dir = tmp_path / "cache"
+    assert np.allclose(ddm(data_dask, taus, fft_cache=cache_dir), expected, rtol=1e-5)
+    assert len(list(cache_dir.glob("stack_*.npy"))) == 1
+    assert np.allclose(ddm(data_dask, taus, fft_cache=cache_dir), expected, rtol=1e-5)
+    assert np.allclose(
+        ddm(data_dask, taus, method="fft", fft_cache=cache_dir), expected, rtol=1e-4
+    )
+    assert len(list(cache_dir.glob("stack_*.npy"))) == 1
+
+    ddm(data, taus, rfft=True, fft_cache=cache_dir)
+    assert len(list(cache_dir.glob("stack_*.npy"))) == 2
+
+
+@pytest.mark.parametrize("scheduler", ["threads", "processes"])
+def test_fft_cache_store(tmp_path, random_stack, scheduler):
+    source = tmp_path / "stack.tif"
+    source.write_bytes(b"stack")
+    data = random_stack()
+    data.attrs.update(file=str(source), experiment=0)
+    data = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    img_fft = fft2(data.data)
+    cache = FFTCache(tmp_path / "cache")
+    with dask.config.set(scheduler=scheduler):
+        cached = cache.store(data, img_fft)
+    assert cached.chunks == img_fft.chunks
+    assert np.array_equal(cached.compute(), img_fft.compute())
+
+
+def test_resume_from(tmp_path, random_stack):
+    data = random_stack()
+    taus = np.arange(1, 10)
+    expected = ddm(data, taus)
+    pathname = tmp_path / "stack_matrix.nc"
+
+    assert np.allclose(ddm(data, taus[:4], resume_from=pathname), expected[:4])
+    result = ddm(data, taus[::-1], resume_from=pathname, max_memory=1e5)
+    assert np.allclose(result, expected[::-1], rtol=1e-5)
+
+    stored = xr.open_dataarray(pathname)
+    assert np.array_equal(np.sort(stored.tau), taus)
+    assert np.array_equal(stored.sortby("tau").pairs, 20 - taus)
+    stored.close()
+    csv = np.loadtxt(tmp_path / "stack_matrix.csv", delimiter=",", skiprows=1)
+    assert np.array_equal(np.sort(csv[:, 0]), taus)
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{}, {"method": "fft"}, {"max_memory": 1e7}, {"rfft": True}]
+)
+@pytest.mark.parametrize("delayed", [False, True])
+def test_return_AB(kwargs, delayed, random_stack):
+    data = random_stack(10, 128, 128)
+    sqFFT = 2 * np.abs(np.fft.fftshift(np.fft.fft2(data.data), axes=(-2, -1))) ** 2
+    sqFFTrad = radial_profile(sqFFT.mean(axis=0), (64, 64))
+    expected_b = np.mean(sqFFTrad[-100:-50])
+    if delayed:
+        data = data.copy(data=da.from_array(data.data, chunks=(3, 128, 128)))
+
+    taus = np.arange(1, 4)
+    result, a, b = ddm(data, taus, return_AB=True, **kwargs)
+    assert np.allclose(result, ddm(data, taus), rtol=1e-4)
+    assert b == pytest.approx(expected_b, rel=1e-5)
+    assert np.allclose(a, sqFFTrad - expected_b, rtol=1e-5)
+
+
+def test_lag_sums_fused_graph(random_stack):
+    data = random_stack(30)
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(4, 16, 16)))
+    # Lag times longer than a chunk need a halo of several following chunks
+    taus = np.array([1, 3, 9, 17, 25])
+    assert np.allclose(ddm(data_dask, taus), ddm(data, taus), rtol=1e-5)
+
+    img_fft = fft2(data_dask.data)
+    n_tasks = len(lag_sums(img_fft, taus).__dask_graph__())
+    assert len(lag_sums(img_fft, np.arange(1, 26)).__dask_graph__()) == n_tasks
+
+
+@pytest.mark.parametrize("scheduler", ["single-threaded", "processes"])
+def test_scheduler(scheduler, random_stack):
+    data = random_stack()
+    data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+    taus = np.arange(1, 8)
+    result = ddm(data_dask, taus, scheduler=scheduler)
+    assert np.allclose(result, ddm(data, taus), rtol=1e-5)
+
+
+def test_local_cluster(random_stack, capsys):
+    pytest.importorskip("distributed")
+    from ddm.utils import start_local_cluster
+
+    client = start_local_cluster(n_workers=2, memory_limit=2**29, processes=False)
+    try:
+        data = random_stack()
+        data_dask = data.copy(data=da.from_array(data.data, chunks=(5, 16, 16)))
+        taus = np.arange(1, 8)
+        result = ddm(data_dask, taus, client=client)
+        output = capsys.readouterr().out
+        assert output.count("Running analysis on") == 1
+        assert f"Running analysis on {client}" in output
+        assert np.allclose(result, ddm(data, taus), rtol=1e-5)
+    finally:
+        client.close()
+
+
+def test_time_halo(random_stack):
+    data = random_stack(30)
+    taus = np.array([1, 4, 6])
+    data_dask = data.copy(data=da.from_array(data.data, chunks=((8, 8, 7, 7), 16, 16)))
+    haloed = time_halo(data_dask.data, 6)
+    assert haloed.chunks[0] == (14, 14, 13, 7)
+    assert np.allclose(ddm(data_dask, taus), ddm(data, taus), rtol=1e-5)
+    with pytest.raises(ValueError):
+        time_halo(data_dask.data, 8)
+
+
+@pytest.mark.parametrize("delayed", [False, True])
+def test_tiles(delayed, random_stack):
+    data = random_stack(20, 32, 48)
+    if delayed:
+        data = data.copy(data=da.from_array(data.data, chunks=(5, 32, 48)))
+    taus = np.arange(1, 6)
+    result = ddm(data, taus, tile_size=16, tile_overlap=8)
+    assert result.tiles.shape == (15, 5, 12)
+    tile = result.tiles[(result.y == 8) & (result.x == 16)][0]
+    assert np.allclose(tile, ddm(data[:, 8:24, 16:32], taus), rtol=1e-5)
+    assert np.allclose(result.average, result.tiles.mean("tile"))
+
+
+def test_tiles_unsupported(random_stack):
+    with pytest.raises(ValueError):
+        ddm(random_stack(), np.arange(1, 5), tile_size=32)
+    with pytest.raises(ValueError):
+        ddm(random_stack(), np.arange(1, 5), tile_size=8, method="fft")
+
+
+@pytest.mark.parametrize("delayed", [False, True])
+def test_float32_matches_float64(delayed):
+    # Bright static background with small fluctuations, as in brightfield movies
+    rng = np.random.default_rng(1)
+    frames = 3000 + rng.poisson(50, (40, 32, 32)) + 500 * rng.random((32, 32))
+    data = xr.DataArray(frames.astype(np.uint16), dims=["T", "Y", "X"])
+    if delayed:
+        data = data.copy(data=da.from_array(data.data, chunks=(10, 32, 32)))
+    taus = np.array([1, 2, 5, 10, 19])
+    expected = ddm(data, taus, dtype="float64")
+    result = ddm(data, taus)
+    assert np.allclose(result, expected, rtol=1e-3)
+    subtracted = ddm(data, taus, background="mean")
+    assert np.allclose(subtracted, expected, rtol=1e-5)
+
+
+def test_prepare_frames(random_stack):
+    data = random_stack()
+    frames = prepare_frames(data.copy(data=da.from_array(data.data, chunks=5)))
+    assert frames.dtype == np.float32
+    assert fft2(frames.data).dtype == np.complex64
+    assert fft2(prepare_frames(data, "float64").data).dtype == np.complex128
+
+    frames = prepare_frames(data, background="mean")
+    assert np.allclose(frames.mean("T"), 0, atol=1e-3)
+    assert "background" in frames.attrs
+
+    with pytest.raises(ValueError) as exc_info:
+        prepare_frames(data, "float16")
+    assert "not a supported dtype" in str(exc_info.value)
@@ -4,7 +4,9 @@ import pytest
 import xarray
 import dask
 import numpy
+import tifffile
 
+from ddm.data_handling import dask_image, readers
 from ddm.data_handling.read_file import read_file
 from ddm.utils import verify_bioformats_jar
 
@@ -93,3 +95,213 @@ def test_custom_scales_lif():
     data = read_file(data_path, xscale=expected_result, tscale=expected_result)
     assert data.attrs["xyScale"] == expected_result
     assert data.attrs["tScale"] == expected_result
+
+
+def test_read_data_into_dask_reuses_handles(tmp_path, monkeypatch):
+    frames = numpy.arange(10 * 8 * 6, dtype=numpy.uint16).reshape(10, 8, 6)
+    tifffile.imwrite(tmp_path / "stack.tif", frames)
+
+    opened = []
+    open_reader = dask_image.open_reader
+    monkeypatch.setattr(
+        dask_image,
+        "open_reader",
+        lambda fn, experiment: opened.append(fn) or open_reader(fn, experiment),
+    )
+    dask_image.close_handles()
+    data = dask_image.read_data_into_dask(tmp_path / "stack.tif", 5)
+    assert data.chunks[0] == (5, 5)
+    assert numpy.array_equal(data.compute(), frames)
+    assert numpy.array_equal(data.compute(), frames)
+    assert len(opened) == 1
+    dask_image.close_handles()
+
+
+def test_evicted_handle_closed_after_last_read(tmp_path, monkeypatch):
+    closed = []
+
+    class Reader:
+        def __init__(self, fn):
+            self.fn = fn
+
+        def close(self):
+            closed.append(self.fn)
+
+    monkeypatch.setattr(dask_image, "open_reader", lambda fn, experiment: Reader(fn))
+    monkeypatch.setattr(dask_image, "_MAX_HANDLES", 1)
+    dask_image.close_handles()
+    for name in ["a.tif", "b.tif"]:
+        (tmp_path / name).touch()
+
+    with dask_image._use_handle(str(tmp_path / "a.tif")) as reader:
+        # Opening b.tif evicts a.tif, which is still being read
+        with dask_image._use_handle(str(tmp_path / "b.tif")):
+            pass
+        assert closed == []
+    assert closed == [reader.fn]
+    dask_image.close_handles()
+    assert closed == [reader.fn, str(tmp_path / "b.tif")]
+
+
+def test_read_data_into_dask_multiple_files(tmp_path):
+    frames = numpy.arange(5 * 8 * 6, dtype=numpy.uint16).reshape(5, 8, 6)
+    for i, frame in enumerate(frames):
+        tifffile.imwrite(tmp_path / f"frame{i}.tif", frame)
+    data = dask_image.read_data_into_dask(str(tmp_path / "frame*.tif"), 2)
+    assert numpy.array_equal(data.compute(), frames)
+
+
+def test_import_tif_native(tmp_path, monkeypatch):
+    frames = numpy.arange(10 * 8 * 6, dtype=numpy.uint16).reshape(10, 8, 6)
+    tifffile.imwrite(
+        tmp_path / "stack.tif",
+        frames,
+        imagej=True,
+        resolution=(2.0, 2.0),
+        metadata={"finterval": 0.02, "axes": "TYX"},
+    )
+
+    def no_jvm(*args, **kwargs):
+        raise AssertionError("Bioformats is only needed for .lif files")
+
+    monkeypatch.setattr("pims.Bioformats", no_jvm)
+    monkeypatch.setitem(read_file.__globals__, "verify_bioformats_jar", no_jvm)
+    data = read_file(str(tmp_path / "stack.tif"), chunk_size=5)
+    assert data.attrs["xyScale"] == 0.5
+    assert data.attrs["tScale"] == 20.0
+    assert data.shape == (10, 8, 6)
+    assert numpy.array_equal(data.compute(), frames)
+
+    data = read_file(
+        str(tmp_path / "stack.tif"), delayed=False, img_selection=slice(1, 8, 3)
+    )
+    assert numpy.array_equal(data, frames[1:8:3])
+
+
+@pytest.mark.parametrize("layout", ["contiguous", "pages", "compressed"])
+def test_tif_memmap(tmp_path, layout):
+    frames = numpy.arange(10 * 8 * 6, dtype=numpy.uint16).reshape(10, 8, 6)
+    data_path = tmp_path / "stack.tif"
+    if layout == "contiguous":
+        tifffile.imwrite(data_path, frames)
+    elif layout == "compressed":
+        tifffile.imwrite(data_path, frames, compression="zlib")
+    else:
+        # Every page has its own description, so the pages are not contiguous
+        with tifffile.TiffWriter(data_path) as tif:
+            for frame in frames:
+                tif.write(frame, contiguous=False, description="frame")
+
+    with readers.TiffReader(str(data_path)) as reader:
+        assert len(reader) == 10
+        assert reader.is_memmapped == (layout != "compressed")
+        block = reader.read(2, 9, 3)
+        assert numpy.array_equal(block, frames[2:9:3])
+        # Memory-mapped frames are read-only views of the file
+        assert block.flags.writeable == (layout == "compressed")
+
+
+@pytest.mark.parametrize("delayed", [True, False])
+def test_import_selection_roi_binning(tmp_path, delayed):
+    frames = numpy.arange(20 * 8 * 6, dtype=numpy.uint16).reshape(20, 8, 6)
+    tifffile.imwrite(
+        tmp_path / "stack.tif",
+        frames,
+        imagej=True,
+        resolution=(2.0, 2.0),
+        metadata={"finterval": 0.02, "axes": "TYX"},
+    )
+    data = read_file(
+        str(tmp_path / "stack.tif"),
+        delayed=delayed,
+        chunk_size=2,
+        img_selection=slice(2, 17, 3),
+        roi=(slice(1, 8), slice(0, 5)),
+        binning=2,
+    )
+    expected = frames[2:17:3, 1:7, 0:4].reshape(5, 3, 2, 2, 2).sum(axis=(2, 4))
+    assert data.shape == (5, 3, 2)
+    assert numpy.array_equal(data.values, expected)
+    assert data.attrs["xyScale"] == 1.0
+    assert data.attrs["tScale"] == 60.0
+    assert "selection" in data.attrs
+
+
+def test_crop_and_bin():
+    frames = numpy.full((2, 5, 5), 60000, dtype=numpy.uint16)
+    binned = dask_image.crop_and_bin(frames, binning=2)
+    assert binned.shape == (2, 2, 2)
+    assert numpy.all(binned == 240000)
+    with pytest.raises(ValueError):
+        dask_image.crop_and_bin(frames, binning=0)
+    with pytest.raises(ValueError):
+        dask_image.crop_and_bin(frames, roi=(slice(0, 4, 2), slice(None)))
+
+
+def test_convert_to_zarr(tmp_path):
+    pytest.importorskip("zarr")
+    from ddm.data_handling import convert_to_zarr
+
+    frames = numpy.arange(20 * 8 * 6, dtype=numpy.uint16).reshape(20, 8, 6)
+    tifffile.imwrite(
+        tmp_path / "stack.tif",
+        frames,
+        imagej=True,
+        resolution=(2.0, 2.0),
+        metadata={"finterval": 0.02, "axes": "TYX"},
+    )
+    zarr_path = convert_to_zarr(str(tmp_path / "stack.tif"), chunk_size=4)
+    assert zarr_path == str(tmp_path / "stack.zarr")
+
+    data = read_file(zarr_path)
+    assert data.data.chunks[0] == (4,) * 5
+    assert data.attrs["xyScale"] == 0.5
+    assert data.attrs["tScale"] == 20.0
+    assert numpy.array_equal(data.values, frames)
+
+    data = read_file(
+        zarr_path,
+        delayed=False,
+        img_selection=slice(2, 17, 3),
+        roi=(slice(1, 8), slice(0, 5)),
+        binning=2,
+    )
+    expected = frames[2:17:3, 1:7, 0:4].reshape(5, 3, 2, 2, 2).sum(axis=(2, 4))
+    assert numpy.array_equal(data.values, expected)
+    assert data.attrs["tScale"] == 60.0
+
+
+def test_zarr_missing_metadata(tmp_path):
+    zarr = pytest.importorskip("zarr")
+    frames = numpy.zeros((4, 8, 6), dtype=numpy.uint16)
+    zarr.save_array(str(tmp_path / "stack.zarr"), frames)
+    with pytest.warns(RuntimeWarning, match="No pixel size"):
+        with pytest.warns(RuntimeWarning, match="No frame time"):
+            data = read_file(str(tmp_path / "stack.zarr"))
+    assert data.attrs["xyScale"] == 1.0
+    assert data.attrs["tScale"] == 1.0
+
+
+def test_nd2_first_channel_and_position(monkeypatch):
+    # Time points of 2 positions with 3 channels per frame, positions loop fastest
+    frames = numpy.arange(4 * 2 * 3 * 8 * 6, dtype=numpy.uint16).reshape(4, 2, 3, 8, 6)
+
+    class ND2File:
+        sizes = {"T": 4, "P": 2, "C": 3, "Y": 8, "X": 6}
+        dtype = frames.dtype
+        loop_indices = tuple({"T": t, "P": p} for t in range(4) for p in range(2))
+
+        def __init__(self, filename):
+            pass
+
+        def read_frame(self, index):
+            return frames[index // 2, index % 2]
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(readers.nd2, "ND2File", ND2File)
+    with readers.open_reader("movie.nd2") as reader:
+        assert len(reader) == 4
+        assert reader.frame_shape == (8, 6)
+        assert numpy.array_equal(reader.read(0, 4), frames[:, 0, 0])
@@ -1,6 +1,8 @@
 from pathlib import Path
 
+import numpy as np
 import pytest
+import tifffile
 
 from ddm.data_handling.read_metadata import read_metadata
 from ddm.utils import verify_bioformats_jar
@@ -46,3 +48,60 @@ def test_read_metadata_multi_lif():
     data_path = THIS_DIR / "data/testData3series.lif"
     metadata = read_metadata(data_path)
     assert metadata["n_experiments"] == 3
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(imagej=True, resolution=(1 / 0.3, 1 / 0.3), metadata={"finterval": 0.05}),
+        dict(ome=True, metadata={"PhysicalSizeX": 0.3, "TimeIncrement": 0.05}),
+    ],
+)
+def test_read_metadata_tif_native(tmp_path, kwargs):
+    data_path = tmp_path / "stack.tif"
+    tifffile.imwrite(data_path, np.zeros((4, 8, 8), dtype=np.uint16), **kwargs)
+    metadata = read_metadata(data_path)
+    assert metadata["xscale"] == pytest.approx(0.3)
+    assert metadata["tscale"] == pytest.approx(50.0)
+
+
+OME_2013 = """<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2013-06">
+<Image ID="Image:0"><Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="uint16"
+SizeX="8" SizeY="8" SizeC="1" SizeZ="1" SizeT="4" PhysicalSizeX="300"
+PhysicalSizeXUnit="nm" TimeIncrement="50" TimeIncrementUnit="ms">
+<Channel ID="Channel:0:0" SamplesPerPixel="1"/><TiffData/></Pixels></Image></OME>"""
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(description=OME_2013, metadata=None, photometric="minisblack"),
+        dict(
+            imagej=True,
+            resolution=(1 / 300, 1 / 300),
+            metadata={"finterval": 50, "unit": "nm", "tunit": "ms"},
+        ),
+    ],
+)
+def test_read_metadata_tif_units(tmp_path, kwargs):
+    data_path = tmp_path / "stack.tif"
+    tifffile.imwrite(data_path, np.zeros((4, 8, 8), dtype=np.uint16), **kwargs)
+    metadata = read_metadata(data_path)
+    assert metadata["xscale"] == pytest.approx(0.3)
+    assert metadata["tscale"] == pytest.approx(50.0)
+
+
+def test_read_metadata_tif_resolution_tags(tmp_path):
+    data_path = tmp_path / "stack.tif"
+    tifffile.imwrite(
+        data_path,
+        np.zeros((4, 8, 8), dtype=np.uint16),
+        resolution=(10000 / 0.3, 10000 / 0.3),
+        resolutionunit="CENTIMETER",
+        photometric="minisblack",
+    )
+    with pytest.warns(RuntimeWarning, match="frame time"):
+        metadata = read_metadata(data_path)
+    assert metadata["xscale"] == pytest.approx(0.3)
+    assert metadata["tscale"] == 1.0
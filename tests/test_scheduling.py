@@ -0,0 +1,105 @@
+import tracemalloc
+
+import dask
+import dask.array as da
+import numpy as np
+import pytest
+import xarray as xr
+
+from ddm.processing import ddm
+from ddm.scheduling import (
+    estimate_memory,
+    frame_pairs,
+    lag_times,
+    schedule_lags,
+    time_chunks,
+)
+
+
+def test_unsupported_scheme():
+    with pytest.raises(ValueError) as exc_info:
+        lag_times(100, "foo")
+    assert "lag time scheme" in str(exc_info.value)
+
+
+def test_linear_lag_times():
+    assert np.array_equal(lag_times(100), np.arange(1, 50))
+
+
+@pytest.mark.parametrize("scheme", ["log", "quasi-log", "multi-tau"])
+def test_lag_times_sorted_unique(scheme):
+    taus = lag_times(10000, scheme, max_tau=5000)
+    assert taus[0] == 1
+    assert taus[-1] <= 5000
+    assert np.all(np.diff(taus) > 0)
+    assert len(taus) < 200
+
+
+def test_quasi_log_lag_times():
+    taus = lag_times(1000, "quasi-log", max_tau=100)
+    assert np.array_equal(taus, np.r_[np.arange(1, 10), np.arange(10, 100, 10), 100])
+
+
+def test_multi_tau_lag_times():
+    taus = lag_times(1000, "multi-tau", max_tau=40, channels=4)
+    assert np.array_equal(taus, [1, 2, 3, 4, 6, 8, 12, 16, 24, 32])
+
+
+def test_schedule_lags_memory_budget():
+    taus = np.arange(1, 100)
+    max_memory = estimate_memory(
+        1000, (64, 64), 10, chunk_frames=10, n_workers=4, max_tau=99
+    )
+    batches = schedule_lags(
+        taus, 1000, (64, 64), max_memory, chunk_frames=10, n_workers=4
+    )
+    assert all(batch.memory <= max_memory for batch in batches)
+    # Batches of small lag times have a smaller halo, and hold more lag times
+    assert all(len(batch.taus) >= 10 for batch in batches[:-1])
+    assert len(batches[0].taus) > len(batches[-2].taus)
+    assert np.array_equal(np.concatenate([batch.taus for batch in batches]), taus)
+
+
+def test_estimate_memory_bounds_peak():
+    data = xr.DataArray(
+        da.from_array(
+            np.random.default_rng(0).poisson(100, (400, 64, 64)).astype(np.uint16),
+            chunks=(10, 64, 64),
+        )
+    )
+    taus = np.arange(1, 191)
+    with dask.config.set(scheduler="single-threaded"):
+        ddm(data[:40], taus[:4], max_memory=1e12)  # compile the kernels
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            ddm(data, taus, max_memory=1e12)
+            peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+    estimate = estimate_memory(400, (64, 64), len(taus), chunk_frames=10, n_workers=1)
+    assert peak <= estimate
+    assert peak > estimate / 2
+
+
+def test_frame_pairs():
+    assert np.array_equal(frame_pairs(20, 5), np.arange(15))
+    assert np.array_equal(frame_pairs(20, 5, pair_stride=4), [0, 4, 8, 12])
+    assert np.array_equal(frame_pairs(20, 5, max_pairs=3), [0, 7, 14])
+    starts = frame_pairs(20, 5, max_pairs=3, sampling="random")
+    assert len(np.unique(starts)) == 3
+    assert starts.max() < 15
+
+
+def test_time_chunks():
+    chunks = time_chunks(1000, (64, 64), max_tau=30, max_memory=2**24, n_workers=1)
+    assert sum(chunks) == 1000
+    assert min(chunks) >= 30
+    assert max(chunks) - min(chunks) <= 1
+    assert len(chunks) > 1
+
+
+def test_time_chunks_budget_too_small():
+    with pytest.warns(RuntimeWarning):
+        chunks = time_chunks(100, (64, 64), max_tau=30, max_memory=1e5, n_workers=1)
+    assert min(chunks) >= 30
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import dask.array as da
+
+from ddm.fitting import compute_AB
+from ddm.processing import ddm
+from ddm.streaming import StreamingDDM, prefetch
+
+
+@pytest.mark.parametrize("rfft", [False, True])
+def test_streaming_matches_ddm(rfft, random_stack):
+    data = random_stack(30)
+    taus = np.array([1, 2, 5, 9])
+    expected = ddm(data, taus)
+    stream = StreamingDDM(taus, data.shape[1:], rfft=rfft)
+    stream.consume(data.copy(data=da.from_array(data.data, chunks=(7, 16, 16))))
+    assert stream.num_frames == 30
+    assert np.array_equal(stream.counts, 30 - taus)
+    assert np.allclose(stream.matrix(), expected, rtol=1e-5)
+
+
+def test_streaming_partial_matrix(random_stack):
+    data = random_stack(30)
+    taus = np.array([1, 10])
+    stream = StreamingDDM(taus, data.shape[1:])
+    stream.consume(frame for frame in data.data[:5])
+    partial = stream.matrix()
+    assert np.all(np.isnan(partial[1]))
+    assert np.allclose(partial[0], ddm(data[:5], np.array([1])), rtol=1e-5)
+
+
+def test_streaming_AB(random_stack):
+    data = random_stack(10, 128, 128)
+    stream = StreamingDDM(np.array([1, 2]), data.shape[1:])
+    stream.consume(data)
+    a, b = stream.AB()
+    expected_a, expected_b = compute_AB(data)
+    assert b == pytest.approx(expected_b, rel=1e-5)
+    assert np.allclose(a, expected_a, rtol=1e-5)
+
+
+@pytest.mark.parametrize("n_readers", [0, 3])
+def test_streaming_pipeline(n_readers, random_stack):
+    data = random_stack(40)
+    taus = np.array([1, 3, 12])
+    stream = StreamingDDM(taus, data.shape[1:])
+    dask_data = data.copy(data=da.from_array(data.data, chunks=(6, 16, 16)))
+    stream.consume(dask_data, n_readers=n_readers, n_workers=2, max_prefetch=2)
+    assert stream.num_frames == 40
+    assert np.allclose(stream.matrix(), ddm(data, taus), rtol=1e-5)
+
+    stream = StreamingDDM(taus, data.shape[1:]).consume(data.data, block_frames=7)
+    assert np.allclose(stream.matrix(), ddm(data, taus), rtol=1e-5)
+
+
+def test_prefetch_backpressure():
+    drawn = []
+
+    def items():
+        for i in range(20):
+            drawn.append(i)
+            yield i
+
+    results = prefetch(lambda x: x**2, items(), n_workers=3, max_prefetch=4)
+    assert next(results) == 0
+    # One result was consumed, so at most max_prefetch + 1 items were drawn
+    assert len(drawn) <= 5
+    assert list(results) == [i**2 for i in range(1, 20)]